@@ -0,0 +1,186 @@
+import base64
+import json
+from dataclasses import dataclass
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, transaction
+from django.forms import ModelChoiceField
+from django.forms.models import model_to_dict
+
+from .forms import *
+from .models import *
+from .refcache import ReferenceChoiceField, parse_pk
+
+
+@dataclass(frozen=True)
+class ApiResource:
+    # form - форма страницы add_* для проверки и сохранения записей, None - ресурс только для чтения
+    model: type
+    form: type = None
+
+    def fields(self):
+        return [field.attname for field in self.model._meta.concrete_fields if field.name != "search_vector"]
+
+
+API_RESOURCES = {resource.model._meta.model_name: resource for resource in (
+    ApiResource(Patient, CreatePatientForm),
+    ApiResource(ResearchResult, CreateDiagnosisForm),
+    ApiResource(CellType, CreateCellTypeForm),
+    ApiResource(Medication, AddMedicationForm),
+    ApiResource(DictCellsCharacteristics, AddDictForm),
+    ApiResource(CellCharacteristic, AddCellCharacteristicForm),
+    ApiResource(SystemSettings, AddSystemSettingsForm),
+    ApiResource(PatientResearch, AddPatientResearchForm),
+    ApiResource(Marker, AddMarkerForm),
+    ApiResource(Immunophenotyping, AddImmunophenotypingForm),
+    ApiResource(ResearchedObject, AddResearchedObjectForm),
+    ApiResource(CellImage),
+    ApiResource(Marking),
+    ApiResource(CellMarking),
+    ApiResource(Cell),
+)}
+
+
+class ApiError(Exception):
+    def __init__(self, message, status=400, **details):
+        super().__init__(message)
+        self.status = status
+        self.details = details
+
+
+def encode_cursor(pk):
+    return base64.urlsafe_b64encode(json.dumps({"after": pk}).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    try:
+        value = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))["after"]
+    except (ValueError, TypeError, KeyError):
+        raise ApiError("Неверный курсор")
+    if not isinstance(value, int):
+        raise ApiError("Неверный курсор")
+    return value
+
+
+def read_page(resource, fields=None, cursor=None, limit=None):
+    """Страница записей по возрастанию идентификатора: курсор - последний выданный
+    идентификатор, поэтому запрос идёт по индексу первичного ключа без OFFSET"""
+    allowed = resource.fields()
+    fields = fields or allowed
+    unknown = set(fields) - set(allowed)
+    if unknown:
+        raise ApiError("Неизвестные поля", fields=sorted(unknown), allowed=allowed)
+    limit = min(limit or settings.API_PAGE_SIZE, settings.API_MAX_PAGE_SIZE)
+
+    queryset = resource.model.objects.order_by("pk")
+    if cursor:
+        queryset = queryset.filter(pk__gt=decode_cursor(cursor))
+    # идентификатор нужен для курсора, даже если клиент его не запросил
+    rows = list(queryset.values(*dict.fromkeys(["id"] + list(fields)))[:limit + 1])
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    last = rows[-1]["id"] if rows else None
+    if "id" not in fields:
+        for row in rows:
+            del row["id"]
+    return {"results": rows, "next": encode_cursor(last) if has_more else None}
+
+
+class PreloadedChoiceField(ModelChoiceField):
+    """Поле выбора по объектам, загруженным одним запросом на всю пачку: проверка элементов
+    не обращается к БД за каждой ссылкой"""
+
+    def __init__(self, field, objects):
+        super().__init__(field.queryset, required=field.required, to_field_name=field.to_field_name)
+        self.objects = objects
+
+    def to_python(self, value):
+        if value in self.empty_values:
+            return None
+        obj = self.objects.get(parse_pk(value.pk if isinstance(value, models.Model) else value))
+        if obj is None:
+            raise ValidationError(self.error_messages["invalid_choice"], code="invalid_choice")
+        return obj
+
+
+def preload_choices(form_class, items):
+    choices = {}
+    for name, field in form_class.base_fields.items():
+        # ссылки по другим полям, кроме первичного ключа, проверяются обычным способом,
+        # ссылки на справочники - по их копии в памяти процесса
+        if not isinstance(field, ModelChoiceField) or isinstance(field, ReferenceChoiceField) \
+                or field.to_field_name not in (None, field.queryset.model._meta.pk.attname):
+            continue
+        ids = {parse_pk(item.get(name)) for item in items} - {None}
+        choices[name] = field.queryset.in_bulk(ids)
+    return choices
+
+
+def batch_form(form_class, choices):
+    """Форма ресурса, в которой ссылки проверяются по объектам, загруженным для всей пачки"""
+
+    class BatchForm(form_class):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            for name, objects in choices.items():
+                self.fields[name] = PreloadedChoiceField(self.fields[name], objects)
+
+        def _get_validation_exclusions(self):
+            # существование ссылок уже проверено полем формы: модель не повторяет запрос по каждой
+            return super()._get_validation_exclusions() | set(choices)
+
+    return BatchForm
+
+
+def write_batch(resource, items):
+    """Создаёт (элементы без id) и изменяет (с id, можно передать только меняющиеся поля)
+    записи через форму ресурса. Все элементы проверяются до сохранения; если хоть один
+    неверен, не сохраняется ничего, а в ответе - ошибки по каждому элементу"""
+    if resource.form is None:
+        raise ApiError("Ресурс доступен только для чтения", status=405)
+    if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+        raise ApiError("Ожидается список объектов в поле items")
+    if len(items) > settings.API_MAX_BATCH_SIZE:
+        raise ApiError("Слишком большая пачка", max_batch_size=settings.API_MAX_BATCH_SIZE)
+
+    update_ids = {parse_pk(item["id"]) for item in items if "id" in item} - {None}
+    instances = resource.model.objects.in_bulk(update_ids)
+    form_fields = list(resource.form._meta.fields)
+
+    prepared, results = [], [None] * len(items)
+    for index, item in enumerate(items):
+        instance = None
+        data = item
+        if "id" in item:
+            if parse_pk(item["id"]) is None:
+                results[index] = {"index": index, "ok": False, "errors": {"id": ["id должен быть целым числом"]}}
+                continue
+            instance = instances.get(parse_pk(item["id"]))
+            if instance is None:
+                results[index] = {"index": index, "ok": False, "errors": {"id": ["Запись не найдена"]}}
+                continue
+            data = dict(model_to_dict(instance, fields=form_fields), **item)
+        prepared.append((index, data, instance))
+
+    # ссылки загружаются по итоговым данным: у изменяемых записей в них есть и неизменённые поля
+    form_class = batch_form(resource.form, preload_choices(resource.form, [data for index, data, instance in prepared]))
+    forms = []
+    for index, data, instance in prepared:
+        form = form_class(data=data, instance=instance)
+        if form.is_valid():
+            forms.append((index, form, instance is None))
+            results[index] = {"index": index, "ok": True}
+        else:
+            results[index] = {"index": index, "ok": False, "errors": form.errors.get_json_data()}
+
+    if not all(result["ok"] for result in results):
+        return {"saved": False, "results": results}
+    try:
+        with transaction.atomic():
+            for index, form, created in forms:
+                results[index].update(id=form.save().pk, created=created)
+    except IntegrityError as error:
+        # нарушение ограничения между элементами одной пачки, которое форма не видит
+        raise ApiError("Пачка нарушает ограничения целостности", status=409, detail=str(error))
+    return {"saved": True, "results": results}
@@ -1,6 +1,23 @@
 from django.apps import AppConfig
+from django.contrib.staticfiles.apps import StaticFilesConfig
 
 
 class AnnotateApplicationConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'annotate_application'
+
+    def ready(self):
+        # обработчики сигналов, обновляющие миелограммы, счётчики клеток, перцептивные хэши
+        # изображений, версии оверлеев маркировок, ленту изменений, справочники в памяти процесса,
+        # кэш растров и хэши содержимого загружаемых изображений
+        from . import myelogram, counters, perceptual, overlays, changes, refcache, rasters, ingest
+
+
+class AnnotateStaticFilesConfig(StaticFilesConfig):
+    # из поставки Bootstrap в STATIC_ROOT попадают только подключаемые в шаблонах минимизированные
+    # bootstrap.min.css и bootstrap.min.js с их картами исходников; полные, RTL, grid, reboot,
+    # utilities, esm и bundle варианты не копируются
+    ignore_patterns = StaticFilesConfig.ignore_patterns + [
+        "*.rtl.*", "bootstrap-grid*", "bootstrap-reboot*", "bootstrap-utilities*", "bootstrap.esm*", "bootstrap.bundle*",
+        "bootstrap.css", "bootstrap.css.map", "bootstrap.js", "bootstrap.js.map", "test.css",
+    ]
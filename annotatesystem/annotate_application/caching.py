@@ -0,0 +1,124 @@
+import time
+
+from django.core.cache import cache, caches
+from django.db import transaction
+
+
+# версии хранятся в отдельном кэше без вытеснения (settings.CACHES), карточки пациентов - в default
+VERSIONS_CACHE = "versions"
+
+
+def _versions():
+    return caches[VERSIONS_CACHE]
+
+
+def _model_key(model):
+    return f"tablever:{model._meta.label_lower}"
+
+
+def _row_key(model, pk):
+    return f"rowver:{model._meta.label_lower}:{pk}"
+
+
+def _new_version():
+    # версия - время последнего изменения в наносекундах: после вытеснения ключа из кэша
+    # новое значение не совпадёт ни с одной из ранее выданных версий
+    return time.time_ns()
+
+
+def _get_versions(keys):
+    store = _versions()
+    versions = store.get_many(keys)
+    missing = [key for key in keys if key not in versions]
+    if missing:
+        store.set_many({key: _new_version() for key in missing}, timeout=None)
+        versions.update(store.get_many(missing))
+    return [versions.get(key, 0) for key in keys]
+
+
+async def _aget_versions(keys):
+    # то же для асинхронных представлений: обращения к файловому кэшу не блокируют цикл событий
+    store = _versions()
+    versions = await store.aget_many(keys)
+    missing = [key for key in keys if key not in versions]
+    if missing:
+        await store.aset_many({key: _new_version() for key in missing}, timeout=None)
+        versions.update(await store.aget_many(missing))
+    return [versions.get(key, 0) for key in keys]
+
+
+def get_model_version(model):
+    return _get_versions([_model_key(model)])[0]
+
+
+def get_models_version(*models):
+    """Общая версия набора таблиц, используется как часть ключа кэша списков и карточек"""
+    if not models:
+        return ""
+    return ".".join(str(version) for version in _get_versions([_model_key(model) for model in models]))
+
+
+def get_model_versions(models):
+    """Версии нескольких таблиц одним обращением к кэшу: {модель: версия}"""
+    return dict(zip(models, _get_versions([_model_key(model) for model in models])))
+
+
+async def aget_model_versions(models):
+    return dict(zip(models, await _aget_versions([_model_key(model) for model in models])))
+
+
+async def aget_models_version(*models):
+    if not models:
+        return ""
+    return ".".join(str(version) for version in await _aget_versions([_model_key(model) for model in models]))
+
+
+def bump_model_version(model):
+    _versions().set(_model_key(model), _new_version(), timeout=None)
+
+
+def get_row_version(model, pk):
+    return _get_versions([_row_key(model, pk)])[0]
+
+
+def bump_row_version(model, pk):
+    _versions().set(_row_key(model, pk), _new_version(), timeout=None)
+
+
+def get_named_version(name):
+    """Версия произвольного набора данных, не совпадающего с таблицей или строкой (например, оверлеи изображения)"""
+    return _get_versions([f"ver:{name}"])[0]
+
+
+def bump_named_version(name):
+    _versions().set(f"ver:{name}", _new_version(), timeout=None)
+
+
+# пути от записей, входящих в карточку пациента, к идентификатору пациента
+PATIENT_RECORD_PATHS = {
+    "annotate_application.patient": ("pk",),
+    "annotate_application.patientresearch": ("patient",),
+    "annotate_application.medication": ("patient", "patient_research__patient"),
+    "annotate_application.immunophenotyping": ("research__patient", "medication__patient_research__patient"),
+    "annotate_application.cellimage": ("patient", "medication__patient_research__patient"),
+    "annotate_application.researchresult": ("patient", "research__patient"),
+    "annotate_application.morphologicalresearch": ("medication__patient_research__patient",),
+}
+
+
+def patient_record_key(patient_id):
+    return f"patient_record:{patient_id}"
+
+
+def invalidate_patient_records(model, pk):
+    """Сбрасывает карточки пациентов записи pk или списка записей (массовые операции).
+    Пациенты определяются сразу, а карточки удаляются после фиксации транзакции: удалённую
+    раньше карточку другой процесс успел бы собрать заново по ещё старым данным"""
+    paths = PATIENT_RECORD_PATHS.get(model._meta.label_lower)
+    if paths is None or pk is None:
+        return
+    lookup = {"pk__in": pk} if isinstance(pk, (list, tuple, set)) else {"pk": pk}
+    rows = model.objects.filter(**lookup).values_list(*paths)
+    keys = [patient_record_key(patient_id) for row in rows for patient_id in row if patient_id is not None]
+    if keys:
+        transaction.on_commit(lambda: cache.delete_many(keys))
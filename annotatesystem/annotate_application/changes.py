@@ -0,0 +1,118 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Min
+from django.db.models.signals import post_delete, post_save
+from django.utils import timezone
+
+from .models import *
+
+# клинические таблицы, изменения которых попадают в ленту
+CHANGE_FEED_MODELS = {model._meta.model_name: model for model in (
+    Patient, PatientResearch, Medication, CellImage, Marking, Cell, CellCharacteristic)}
+# служебные поля, которые не передаются клиентам
+EXCLUDED_FIELDS = {"search_vector"}
+
+
+class ChangeFeedExpired(Exception):
+    """Токен клиента старше самых ранних сохранённых изменений: нужна полная выгрузка"""
+
+
+def record_changes(model, pks, operation):
+    """Записывает изменения в ленту одной вставкой; вызывается в транзакции изменения,
+    поэтому при откате записи ленты откатываются вместе с ним"""
+    ChangeLog.objects.bulk_create([ChangeLog(object_model=model._meta.model_name, object_id=pk, operation=operation)
+                                   for pk in pks])
+
+
+def is_closed(instance):
+    # запись SCD2 закрыта: у версии проставлена дата окончания или состояние "удалена"
+    return getattr(instance, "end_date", None) is not None or getattr(instance, "t_changed", None) == 2
+
+
+def record_saved(sender, instance, created, *args, **kwargs):
+    if kwargs.get("raw"):
+        return
+    if created:
+        operation = ChangeLog.INSERT
+    elif is_closed(instance):
+        operation = ChangeLog.CLOSE
+    else:
+        operation = ChangeLog.UPDATE
+    record_changes(sender, [instance.pk], operation)
+
+
+def record_deleted(sender, instance, *args, **kwargs):
+    record_changes(sender, [instance.pk], ChangeLog.DELETE)
+
+
+# приёмники подключаются только к таблицам ленты: post_delete без отправителя лишил бы
+# быстрого удаления любые queryset, в том числе очистку самой ленты (prune_change_log)
+for feed_model in CHANGE_FEED_MODELS.values():
+    post_save.connect(record_saved, sender=feed_model)
+    post_delete.connect(record_deleted, sender=feed_model)
+
+
+def feed_fields(model):
+    return [field.attname for field in model._meta.concrete_fields if field.name not in EXCLUDED_FIELDS]
+
+
+def get_changes(since=0, limit=None, models=None):
+    """Изменения с номером больше since, не больше limit штук. Из нескольких изменений одной
+    записи на странице остаётся последнее; текущее состояние записей читается одним запросом
+    на таблицу. Изменения моложе CHANGE_FEED_SETTLE_SECONDS не отдаются: номер выдаётся
+    при вставке, а видимым становится при фиксации транзакции, и более ранний номер
+    долгой транзакции мог бы появиться уже после выданного клиенту токена"""
+    limit = min(limit or settings.CHANGE_FEED_PAGE_SIZE, settings.CHANGE_FEED_MAX_PAGE_SIZE)
+    oldest = ChangeLog.objects.aggregate(oldest=Min("pk"))["oldest"]
+    if oldest is not None and since < oldest - 1:
+        raise ChangeFeedExpired(since)
+
+    entries = ChangeLog.objects.filter(
+        pk__gt=since, t_cdatetime__lte=timezone.now() - timedelta(seconds=settings.CHANGE_FEED_SETTLE_SECONDS))
+    if models:
+        entries = entries.filter(object_model__in=models)
+    entries = list(entries.order_by("pk").values_list("pk", "object_model", "object_id", "operation")[:limit + 1])
+    has_more = len(entries) > limit
+    entries = entries[:limit]
+
+    latest = {}
+    for seq, model_name, object_id, operation in entries:
+        latest.pop((model_name, object_id), None)
+        latest[(model_name, object_id)] = (seq, operation)
+
+    alive = {}
+    for model_name in {model_name for model_name, object_id in latest}:
+        model = CHANGE_FEED_MODELS[model_name]
+        ids = [object_id for name, object_id in latest if name == model_name]
+        alive[model_name] = {row["id"]: row for row in model.objects.filter(pk__in=ids).values(*feed_fields(model))}
+
+    changes = []
+    for (model_name, object_id), (seq, operation) in latest.items():
+        row = alive[model_name].get(object_id)
+        # запись удалена позже изменения на этой странице: клиент узнаёт об удалении сразу,
+        # повторное удаление со следующих страниц для него ничего не меняет
+        if row is None:
+            operation = ChangeLog.DELETE
+        changes.append({
+            "seq": seq,
+            "model": model_name,
+            "id": object_id,
+            "op": operation,
+            "data": row,
+        })
+    return {
+        "changes": changes,
+        "next": entries[-1][0] if entries else since,
+        "has_more": has_more,
+    }
+
+
+def head():
+    """Номер последнего изменения: с него продолжает клиент после полной выгрузки"""
+    return ChangeLog.objects.order_by("-pk").values_list("pk", flat=True).first() or 0
+
+
+def prune_changes(days):
+    """Удаляет изменения старше days дней; клиенты с более старым токеном получат ChangeFeedExpired"""
+    return ChangeLog.objects.filter(t_cdatetime__lt=timezone.now() - timedelta(days=days)).delete()[0]
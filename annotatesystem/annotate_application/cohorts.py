@@ -0,0 +1,231 @@
+import datetime
+import hashlib
+import json
+import math
+
+from django.conf import settings
+from django.contrib.postgres.search import SearchQuery
+from django.core.cache import cache
+from django.db.models import Exists, F, Func, IntegerField, OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from .api import ApiError, decode_cursor, encode_cursor
+from .caching import get_models_version
+from .models import *
+from .refcache import reference
+from .search import SEARCH_CONFIG, use_fulltext
+
+# Когорты пациентов по структурированному описанию:
+# {"match": "all" | "any", "conditions": [условие, ...]}, где условие - одно из
+#   {"type": "marker", "marker": "CD34" | id, "min": 20, "max": 80, "since": "2023-01-01", "until": ...}
+#       измерение иммунофенотипирования маркера с процентом в [min, max] в исследовании,
+#       начатом в [since, until);
+#   {"type": "diagnosis", "text": "острый лейкоз"} - заключение исследования или пациента
+#       (полнотекстовый поиск, как в search.py);
+#   {"type": "cells", "cell_type": "Бласт" | id, "min": 500, "since": ..., "until": ...} - не меньше
+#       min размеченных клеток типа, при since/until - в препаратах исследований этого периода;
+#   {"type": "sex", "value": 0 | 1}.
+# Любое условие с "exclude": true отбирает пациентов, у которых его нет. Описание переводится
+# в один запрос к al_patient с подзапросами EXISTS; в выдачу для каждого пациента добавляются
+# подсчёты по условиям коррелированными подзапросами, которые считаются только для строк страницы.
+
+# таблицы, от которых зависит результат: ключ кэша строится по их версиям
+COHORT_MODELS = (Patient, PatientResearch, Immunophenotyping, Marker, ResearchResult, Medication,
+                 PatientCellCount, MedicationCellCount, CellType)
+CONDITION_TYPES = ("marker", "diagnosis", "cells", "sex")
+
+
+def _scalar(queryset, function, field):
+    """Значение агрегата по строкам подзапроса без GROUP BY: COUNT/SUM по всем отобранным строкам"""
+    return Subquery(queryset.order_by().annotate(value=Func(F(field), function=function)).values("value"),
+                    output_field=IntegerField())
+
+
+def _number(condition, key, required=False, minimum=None):
+    value = condition.get(key)
+    if value is None:
+        if required:
+            raise ApiError(f"В условии {condition['type']} не задано {key}")
+        return None
+    # json.loads пропускает NaN и Infinity, которые не сравниваются с целочисленным полем
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+        raise ApiError(f"{key} должно быть числом")
+    if minimum is not None and value < minimum:
+        raise ApiError(f"{key} должно быть не меньше {minimum}")
+    return value
+
+
+def _moment(condition, key):
+    """Дата или дата и время ISO 8601; дата без времени - полночь часового пояса проекта"""
+    value = condition.get(key)
+    if value is None:
+        return None
+    parsed = None
+    if isinstance(value, str):
+        try:
+            parsed = parse_datetime(value) or parse_date(value)
+        except ValueError:
+            parsed = None
+    if parsed is None:
+        raise ApiError(f"{key} должно быть датой в формате ГГГГ-ММ-ДД")
+    if not isinstance(parsed, datetime.datetime):
+        parsed = datetime.datetime.combine(parsed, datetime.time.min)
+    if settings.USE_TZ and timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+def _reference_ids(model, name_field, value, label):
+    """Идентификаторы записей справочника по идентификатору или названию без учёта регистра"""
+    rows = reference(model).rows()
+    if isinstance(value, int) and not isinstance(value, bool):
+        ids = [row.id for row in rows if row.id == value]
+    elif isinstance(value, str) and value.strip():
+        ids = [row.id for row in rows if getattr(row, name_field).casefold() == value.strip().casefold()]
+    else:
+        raise ApiError(f"Не задан {label}")
+    if not ids:
+        raise ApiError(f"Неизвестный {label}", value=value)
+    return ids
+
+
+def _research_period(prefix, condition):
+    period = {}
+    since, until = _moment(condition, "since"), _moment(condition, "until")
+    if since is not None:
+        period[f"{prefix}date_begin__gte"] = since
+    if until is not None:
+        period[f"{prefix}date_begin__lt"] = until
+    return period
+
+
+def marker_condition(condition):
+    ids = _reference_ids(Marker, "marker_name", condition.get("marker"), "маркер")
+    lookups = dict(_research_period("research__", condition), marker__in=ids)
+    low, high = _number(condition, "min", minimum=0), _number(condition, "max", minimum=0)
+    if low is not None:
+        lookups["percent_positive_cells__gte"] = low
+    if high is not None:
+        lookups["percent_positive_cells__lte"] = high
+    rows = Immunophenotyping.objects.filter(research__patient=OuterRef("pk"), **lookups)
+    return Exists(rows), _scalar(rows, "COUNT", "pk")
+
+
+def diagnosis_condition(condition):
+    text = condition.get("text")
+    if not isinstance(text, str) or not text.strip():
+        raise ApiError("Не задан текст заключения")
+    # заключение привязано к исследованию или, если исследования нет, прямо к пациенту
+    rows = ResearchResult.objects.filter(Q(research__patient=OuterRef("pk")) | Q(patient=OuterRef("pk")))
+    if use_fulltext():
+        rows = rows.filter(search_vector=SearchQuery(text, config=SEARCH_CONFIG, search_type="websearch"))
+    else:
+        rows = rows.filter(conclusion__icontains=text.strip())
+    return Exists(rows), _scalar(rows, "COUNT", "pk")
+
+
+def cells_condition(condition):
+    ids = _reference_ids(CellType, "type_name", condition.get("cell_type"), "тип клетки")
+    minimum = _number(condition, "min", required=True, minimum=1)
+    period = _research_period("medication__patient_research__", condition)
+    if not period and len(ids) == 1:
+        # итог по пациенту уже посчитан в al_patient_cell_count (counters.py)
+        rows = PatientCellCount.objects.filter(patient=OuterRef("pk"), cell_type=ids[0])
+        return Exists(rows.filter(count__gte=minimum)), _scalar(rows, "SUM", "count")
+    rows = MedicationCellCount.objects.filter(medication__patient_research__patient=OuterRef("pk"),
+                                              cell_type__in=ids, **period)
+    # EXISTS по сгруппированному подзапросу: сумма по препаратам периода не меньше min
+    enough = rows.order_by().values("medication__patient_research__patient").annotate(
+        total=Sum("count")).filter(total__gte=minimum)
+    return Exists(enough), _scalar(rows, "SUM", "count")
+
+
+def sex_condition(condition):
+    value = condition.get("value")
+    if isinstance(value, bool) or not isinstance(value, int) or value not in dict(Patient.SEX_TYPE):
+        raise ApiError("value должно быть 0 или 1")
+    return Q(sex=value), None
+
+
+CONDITION_BUILDERS = {
+    "marker": marker_condition,
+    "diagnosis": diagnosis_condition,
+    "cells": cells_condition,
+    "sex": sex_condition,
+}
+
+
+def normalize_spec(spec):
+    """Проверенное описание когорты в каноническом виде (ключ кэша не зависит от порядка ключей)"""
+    if not isinstance(spec, dict):
+        raise ApiError("Описание когорты должно быть объектом JSON")
+    match = spec.get("match", "all")
+    if match not in ("all", "any"):
+        raise ApiError("match должно быть all или any")
+    conditions = spec.get("conditions")
+    if not isinstance(conditions, list) or not conditions:
+        raise ApiError("Не заданы условия когорты")
+    if len(conditions) > settings.COHORT_MAX_CONDITIONS:
+        raise ApiError(f"Условий не может быть больше {settings.COHORT_MAX_CONDITIONS}")
+    for condition in conditions:
+        if not isinstance(condition, dict) or condition.get("type") not in CONDITION_TYPES:
+            raise ApiError("Неизвестный тип условия", types=list(CONDITION_TYPES))
+    return {"match": match, "conditions": conditions}
+
+
+def compile_spec(spec):
+    """Запрос пациентов когорты: фильтр и подсчёты по условиям (имена matched_<номер условия>)"""
+    spec = normalize_spec(spec)
+    combined, counts = None, {}
+    for number, condition in enumerate(spec["conditions"]):
+        predicate, count = CONDITION_BUILDERS[condition["type"]](condition)
+        predicate = Q(predicate)
+        if condition.get("exclude"):
+            predicate = ~predicate
+        elif count is not None:
+            counts[f"matched_{number}"] = Coalesce(count, Value(0))
+        if combined is None:
+            combined = predicate
+        else:
+            combined = combined & predicate if spec["match"] == "all" else combined | predicate
+    return Patient.objects.filter(combined), counts
+
+
+def cohort_key(spec, cursor, limit):
+    canonical = json.dumps(normalize_spec(spec), sort_keys=True, ensure_ascii=False)
+    digest = hashlib.sha1(f"{canonical}|{cursor or ''}|{limit}".encode()).hexdigest()
+    return f"cohort:{digest}:{get_models_version(*COHORT_MODELS)}"
+
+
+def query_cohort(spec, cursor=None, limit=None):
+    """Страница когорты по возрастанию идентификатора пациента с курсором, как в api.read_page.
+    Первая страница содержит и общее число пациентов когорты. Результат кэшируется по описанию,
+    курсору и версиям таблиц, поэтому любое изменение исходных данных даёт новый ключ"""
+    limit = min(limit or settings.COHORT_PAGE_SIZE, settings.COHORT_MAX_PAGE_SIZE)
+    key = cohort_key(spec, cursor, limit)
+    page = cache.get(key)
+    if page is not None:
+        return page
+
+    queryset, counts = compile_spec(spec)
+    page_queryset = queryset.order_by("pk")
+    if cursor:
+        page_queryset = page_queryset.filter(pk__gt=decode_cursor(cursor))
+    rows = list(page_queryset.annotate(**counts).values("id", *counts)[:limit + 1])
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    results = []
+    for row in rows:
+        matched = [None] * len(spec["conditions"])
+        for name in counts:
+            matched[int(name.split("_")[1])] = row[name]
+        results.append({"id": row["id"], "matched": matched})
+    page = {
+        "results": results,
+        "next": encode_cursor(rows[-1]["id"]) if has_more else None,
+        "total": None if cursor else (len(rows) if not has_more else queryset.count()),
+    }
+    cache.set(key, page, timeout=settings.CARD_CACHE_TIMEOUT)
+    return page
@@ -0,0 +1,216 @@
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+
+from django.db import connection, transaction
+from django.db.models import Count, F, Max, Min, Q
+from django.db.models.functions import Coalesce
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from .caching import bump_model_version, bump_row_version
+from .models import *
+
+# владелец счётчика: поле в таблице счётчиков, модель таблицы и выражение от Cell до владельца
+COUNTER_TABLES = {
+    "image": (ImageCellCount, F("marking__image_id")),
+    "medication": (MedicationCellCount, F("marking__image__medication_id")),
+    "patient": (PatientCellCount, Coalesce("marking__image__patient_id",
+                                           "marking__image__medication__patient_research__patient_id")),
+}
+
+# модели владельцев счётчиков в порядке, в котором на их строки берутся блокировки
+OWNER_MODELS = {"image": CellImage, "medication": Medication, "patient": Patient}
+
+# пока установлен, обработчики сигналов Cell не меняют счётчики: массовая операция учитывает их сама
+_suspended = ContextVar("cell_counters_suspended", default=False)
+
+
+def image_owners(image_ids):
+    """Изображение, препарат и пациент для каждого изображения; пациент - как в COUNTER_TABLES"""
+    rows = CellImage.objects.filter(pk__in=image_ids).values_list(
+        "pk", "medication_id", "patient_id", "medication__patient_research__patient_id")
+    return {pk: {"image": pk, "medication": medication_id, "patient": patient_id or research_patient_id}
+            for pk, medication_id, patient_id, research_patient_id in rows}
+
+
+def lock_owners(name, **lookup):
+    """Блокирует строки владельцев счётчиков до конца транзакции. Изменение счётчиков и их сверка
+    берут эту блокировку первой, поэтому сверка не перезапишет прибавленную рядом разницу"""
+    owner_model = OWNER_MODELS[name]
+    list(owner_model.objects.select_for_update(no_key=True).filter(**lookup).order_by("pk").values_list(
+        "pk", flat=True))
+
+
+def apply_deltas(deltas):
+    """Применяет изменения {(изображение, тип клетки): разница} ко всем таблицам счётчиков.
+    Значения меняются выражением F() в БД, поэтому параллельные запросы не теряют обновлений;
+    строки с одинаковой разницей обновляются одним UPDATE"""
+    deltas = {key: delta for key, delta in deltas.items() if delta}
+    if not deltas:
+        return
+
+    with transaction.atomic():
+        owners = image_owners({image_id for image_id, cell_type_id in deltas})
+        for name in OWNER_MODELS:
+            lock_owners(name, pk__in={owner[name] for owner in owners.values() if owner[name] is not None})
+        changed = []
+        for name, (model, expression) in COUNTER_TABLES.items():
+            table_deltas = Counter()
+            for (image_id, cell_type_id), delta in deltas.items():
+                owner_id = owners.get(image_id, {}).get(name)
+                if owner_id is not None:
+                    table_deltas[(owner_id, cell_type_id)] += delta
+            if not table_deltas:
+                continue
+            model.objects.bulk_create([model(**{f"{name}_id": owner_id}, cell_type_id=cell_type_id, count=0)
+                                       for owner_id, cell_type_id in sorted(table_deltas)], ignore_conflicts=True)
+            by_delta = defaultdict(list)
+            for (owner_id, cell_type_id), delta in sorted(table_deltas.items()):
+                if delta:
+                    by_delta[delta].append(Q(**{f"{name}_id": owner_id}, cell_type_id=cell_type_id))
+            for delta, conditions in by_delta.items():
+                condition = conditions[0]
+                for other in conditions[1:]:
+                    condition |= other
+                model.objects.filter(condition).update(count=F("count") + delta)
+            changed.append(model)
+
+        # карточки изображений выводят счётчики: меняется версия строк и списка изображений.
+        # Версии меняются после фиксации транзакции вызывающего кода, как в models.bump_cache_versions
+        def bump():
+            for model in changed:
+                bump_model_version(model)
+            for image_id in owners:
+                bump_row_version(CellImage, image_id)
+            bump_model_version(CellImage)
+
+        transaction.on_commit(bump)
+
+
+def cell_deltas(queryset, sign):
+    """Разница для набора клеток, посчитанная группировкой в БД"""
+    rows = queryset.order_by().values("marking__image_id", "cell_type_id").annotate(cells=Count("pk"))
+    return Counter({(row["marking__image_id"], row["cell_type_id"]): sign * row["cells"] for row in rows})
+
+
+def count_created_cells(cells):
+    marking_images = dict(CellMarking.objects.filter(
+        pk__in={cell.marking_id for cell in cells}).values_list("pk", "image_id"))
+    apply_deltas(Counter((marking_images[cell.marking_id], cell.cell_type_id) for cell in cells))
+
+
+class suspended_counters:
+    def __enter__(self):
+        self.token = _suspended.set(True)
+
+    def __exit__(self, *exc_info):
+        _suspended.reset(self.token)
+
+
+@receiver(pre_save, sender=Cell)
+def remember_cell_owner(sender, instance, *args, **kwargs):
+    instance._counted_as = None
+    if instance.pk is not None:
+        instance._counted_as = Cell.objects.filter(pk=instance.pk).values_list(
+            "marking__image_id", "cell_type_id").first()
+
+
+@receiver(post_save, sender=Cell)
+def count_saved_cell(sender, instance, created, *args, **kwargs):
+    if _suspended.get():
+        return
+    current = (CellMarking.objects.filter(pk=instance.marking_id).values_list("image_id", flat=True).first(),
+               instance.cell_type_id)
+    previous = getattr(instance, "_counted_as", None)
+    if current == previous:
+        return
+    deltas = Counter({current: 1})
+    if previous is not None:
+        deltas[previous] -= 1
+    apply_deltas(deltas)
+
+
+@receiver(post_delete, sender=Cell)
+def count_deleted_cell(sender, instance, *args, **kwargs):
+    if _suspended.get():
+        return
+    image_id = CellMarking.objects.filter(pk=instance.marking_id).values_list("image_id", flat=True).first()
+    apply_deltas({(image_id, instance.cell_type_id): -1})
+
+
+@receiver(pre_save, sender=CellMarking)
+def remember_marking_image(sender, instance, *args, **kwargs):
+    instance._counted_image_id = None
+    if instance.pk is not None:
+        instance._counted_image_id = CellMarking.objects.filter(pk=instance.pk).values_list("image_id", flat=True).first()
+
+
+@receiver(post_save, sender=CellMarking)
+def move_marking_cells(sender, instance, created, *args, **kwargs):
+    # маркировку перенесли на другое изображение: её клетки переходят вместе с ней
+    previous = getattr(instance, "_counted_image_id", None)
+    if created or previous is None or previous == instance.image_id:
+        return
+    deltas = Counter()
+    for cell_type_id, cells in Cell.objects.filter(marking=instance).order_by().values_list(
+            "cell_type_id").annotate(cells=Count("pk")):
+        deltas[(previous, cell_type_id)] -= cells
+        deltas[(instance.image_id, cell_type_id)] += cells
+    apply_deltas(deltas)
+
+
+def reconcile_range(name, start, end):
+    """Сверяет счётчики владельцев с идентификаторами [start, end] с фактическим подсчётом клеток.
+    Подсчёт и запись идут в одной транзакции под блокировкой владельцев и строк счётчиков:
+    apply_deltas для этих владельцев ждёт её завершения и прибавляет разницу к сверенному значению"""
+    model, expression = COUNTER_TABLES[name]
+    owner_range = {f"{name}__gte": start, f"{name}__lte": end}
+    try:
+        with transaction.atomic():
+            lock_owners(name, pk__gte=start, pk__lte=end)
+            stored = {(getattr(row, f"{name}_id"), row.cell_type_id): row
+                      for row in model.objects.select_for_update().filter(**owner_range).order_by("pk")}
+            groups = Cell.objects.annotate(owner=expression).filter(owner__gte=start, owner__lte=end).order_by().values(
+                "owner", "cell_type_id").annotate(cells=Count("pk"))
+            actual = {(row["owner"], row["cell_type_id"]): row["cells"] for row in groups}
+
+            missing = [model(**{f"{name}_id": owner_id}, cell_type_id=cell_type_id, count=cells)
+                       for (owner_id, cell_type_id), cells in actual.items() if (owner_id, cell_type_id) not in stored]
+            changed = []
+            for key, row in stored.items():
+                if row.count != actual.get(key, 0):
+                    row.count = actual.get(key, 0)
+                    changed.append(row)
+            model.objects.bulk_create(missing, batch_size=1000, ignore_conflicts=True)
+            model.objects.bulk_update(changed, ["count"], batch_size=1000)
+            model.objects.filter(**owner_range, count=0).delete()
+        return len(missing) + len(changed)
+    finally:
+        # задачи выполняются в потоках пула, у каждого потока своё соединение с БД
+        connection.close()
+
+
+def reconcile_counters(workers=4, chunk=5000):
+    """Пересчитывает все таблицы счётчиков параллельно по диапазонам идентификаторов владельцев.
+    Возвращает количество исправленных строк по таблицам"""
+    tasks = []
+    for name, owner_model in OWNER_MODELS.items():
+        bounds = owner_model.objects.aggregate(low=Min("pk"), high=Max("pk"))
+        if bounds["low"] is None:
+            continue
+        for start in range(bounds["low"], bounds["high"] + 1, chunk):
+            tasks.append((name, start, min(start + chunk - 1, bounds["high"])))
+
+    if not connection.features.has_select_for_update:
+        # без блокировок строк (SQLite) база допускает одну пишущую транзакцию: диапазоны сверяются по очереди
+        workers = 1
+    fixed = Counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for (name, start, end), count in zip(tasks, pool.map(lambda task: reconcile_range(*task), tasks)):
+            fixed[name] += count
+
+    for name, (model, expression) in COUNTER_TABLES.items():
+        bump_model_version(model)
+    bump_model_version(CellImage)
+    return fixed
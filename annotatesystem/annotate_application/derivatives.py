@@ -0,0 +1,188 @@
+import hashlib
+import io
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from PIL import Image, ImageOps, features
+from django.conf import settings
+
+
+def _supported(name):
+    try:
+        return features.check(name)
+    except ValueError:
+        return False
+
+
+# форматы производных в порядке предпочтения: MIME, формат Pillow, расширение файла;
+# AVIF - только если Pillow собран с libavif
+MODERN_FORMATS = tuple(fmt for fmt in (("image/avif", "AVIF", ".avif"), ("image/webp", "WEBP", ".webp"))
+                       if _supported(fmt[1].lower()))
+PNG = ("image/png", "PNG", ".png")
+# виды производных: наибольшая сторона в пикселях, None - исходный размер
+KINDS = {"preview": lambda: settings.IMAGE_PREVIEW_SIZE, "full": lambda: None}
+# время последнего обращения к производной обновляется не чаще раза в час
+TOUCH_INTERVAL = 60 * 60
+# после очистки каталог занимает не больше этой доли IMAGE_DERIVATIVE_CACHE_BYTES
+EVICT_TO = 0.9
+
+
+def negotiate(accept, formats=MODERN_FORMATS):
+    """Лучший из форматов, явно перечисленных клиентом в Accept; None - только исходный формат.
+    */* не учитывается: так отвечают клиенты, которые не обязательно умеют декодировать AVIF"""
+    accepted = {}
+    for token in accept.lower().split(","):
+        mime, *params = [part.strip() for part in token.split(";")]
+        quality = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        accepted[mime] = quality
+    for fmt in formats:
+        if accepted.get(fmt[0], 0.0) > 0:
+            return fmt
+    return None
+
+
+def encode(image, fmt, lossless=False):
+    """Байты изображения Pillow в формате fmt: снимки сжимаются с потерями с качеством
+    IMAGE_DERIVATIVE_QUALITY, плитки оверлея с однотонными прямоугольниками - без потерь"""
+    buffer = io.BytesIO()
+    if fmt[1] == "PNG":
+        image.save(buffer, "PNG", optimize=True)
+    elif fmt[1] == "WEBP":
+        image.save(buffer, "WEBP", lossless=lossless, quality=100 if lossless else settings.IMAGE_DERIVATIVE_QUALITY,
+                   method=4)
+    else:
+        # скорость 8 из 10: кодирование AVIF по умолчанию в разы медленнее при почти том же размере
+        image.save(buffer, fmt[1], quality=100 if lossless else settings.IMAGE_DERIVATIVE_QUALITY, speed=8)
+    return buffer.getvalue()
+
+
+def derivative_name(path, kind, fmt):
+    """Путь производной относительно MEDIA_ROOT. Загруженные файлы не перезаписываются,
+    поэтому производная по пути оригинала никогда не устаревает"""
+    digest = hashlib.sha1(f"{kind}:{path}".encode()).hexdigest()
+    return f"{settings.IMAGE_DERIVATIVE_DIR}/{kind}/{digest[:2]}/{digest}{fmt[2]}"
+
+
+def transcode(path, kind, fmt):
+    """Записывает производную оригинала path и возвращает её размер в байтах. Файл пишется
+    во временный и переименовывается, поэтому параллельные запросы не видят его частично"""
+    full_path = os.path.join(settings.MEDIA_ROOT, derivative_name(path, kind, fmt))
+    with Image.open(os.path.join(settings.MEDIA_ROOT, path)) as picture:
+        picture = ImageOps.exif_transpose(picture)
+        if picture.mode not in ("RGB", "RGBA", "L"):
+            picture = picture.convert("RGBA" if "A" in picture.getbands() else "RGB")
+        side = KINDS[kind]()
+        if side is not None:
+            picture.thumbnail((side, side), Image.LANCZOS)
+        data = encode(picture, fmt)
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    temporary = f"{full_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temporary, "wb") as file:
+        file.write(data)
+    os.replace(temporary, full_path)
+    return len(data)
+
+
+class DerivativePool:
+    """Фоновое перекодирование: одна задача на производную, сколько бы запросов её ни ждали,
+    и очистка каталога от давно не запрашивавшихся файлов при превышении его размера"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.executor = None
+        # размер каталога, известный процессу: пересчитывается при очистке, между
+        # очистками к нему прибавляются записанные этим процессом файлы
+        self.size = None
+
+    def submit(self, path, kind, fmt):
+        name = derivative_name(path, kind, fmt)
+        with self.lock:
+            future = self.pending.get(name)
+            if future is None:
+                if self.executor is None:
+                    self.executor = ThreadPoolExecutor(max_workers=settings.IMAGE_DERIVATIVE_WORKERS,
+                                                       thread_name_prefix="derivative")
+                future = self.executor.submit(self.run, name, path, kind, fmt)
+                self.pending[name] = future
+        return future
+
+    def run(self, name, path, kind, fmt):
+        try:
+            written = transcode(path, kind, fmt)
+            with self.lock:
+                if self.size is not None:
+                    self.size += written
+                over = self.size is None or self.size > settings.IMAGE_DERIVATIVE_CACHE_BYTES
+            if over:
+                self.evict(keep=name)
+        finally:
+            with self.lock:
+                self.pending.pop(name, None)
+
+    def evict(self, keep=None):
+        """Удаляет производные с самым давним обращением, пока каталог больше EVICT_TO от предела;
+        keep - только что записанная производная, которую ждёт запрос"""
+        keep = keep and os.path.join(settings.MEDIA_ROOT, keep)
+        root = os.path.join(settings.MEDIA_ROOT, settings.IMAGE_DERIVATIVE_DIR)
+        files = []
+        for directory, _, names in os.walk(root):
+            for name in names:
+                try:
+                    file_stat = os.stat(os.path.join(directory, name))
+                except FileNotFoundError:
+                    continue
+                files.append((file_stat.st_mtime, file_stat.st_size, os.path.join(directory, name)))
+        total = sum(size for _, size, _ in files)
+        if total > settings.IMAGE_DERIVATIVE_CACHE_BYTES:
+            limit = settings.IMAGE_DERIVATIVE_CACHE_BYTES * EVICT_TO
+            for _, size, full_path in sorted(files):
+                if total <= limit:
+                    break
+                if full_path == keep:
+                    continue
+                try:
+                    os.remove(full_path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+        with self.lock:
+            self.size = total
+
+
+pool = DerivativePool()
+
+
+def get_derivative(path, kind, fmt, wait=None):
+    """Путь готовой производной относительно MEDIA_ROOT. Если её ещё нет, ставит
+    перекодирование в очередь и ждёт не дольше wait секунд; None - не успела или оригинал
+    не читается, запрос отдаёт оригинал"""
+    name = derivative_name(path, kind, fmt)
+    full_path = os.path.join(settings.MEDIA_ROOT, name)
+    try:
+        file_stat = os.stat(full_path)
+    except FileNotFoundError:
+        future = pool.submit(path, kind, fmt)
+        try:
+            future.result(timeout=settings.IMAGE_DERIVATIVE_WAIT_SECONDS if wait is None else wait)
+        except TimeoutError:
+            return None
+        except (OSError, ValueError, Image.DecompressionBombError):
+            return None
+        return name
+    # время изменения служит временем последнего обращения для очистки (atime часто отключён)
+    now = time.time()
+    if now - file_stat.st_mtime > TOUCH_INTERVAL:
+        try:
+            os.utime(full_path, (now, now))
+        except OSError:
+            pass
+    return name
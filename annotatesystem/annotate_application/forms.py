@@ -1,13 +1,25 @@
 from hashlib import shake_256
 from django import forms
+from django.db import transaction
 from django.contrib.auth.forms import UserCreationForm, AuthenticationForm
 from django.forms import ModelChoiceField
 from transliterate import translit
 from .models import *
+from .perceptual import find_duplicates
+from .refcache import ReferenceChoiceField
+from .widgets import AutocompleteSelect
 
 from .models import MEPHIUser
 
 
+class ReferenceFieldsMixin:
+    # существование записей справочников проверяет ReferenceChoiceField по копии в памяти,
+    # модель не повторяет эту проверку запросом к БД
+    def _get_validation_exclusions(self):
+        return super()._get_validation_exclusions() | {
+            name for name, field in self.fields.items() if isinstance(field, ReferenceChoiceField)}
+
+
 class DateInput(forms.DateInput):
     input_type = 'date'
 
@@ -75,13 +87,14 @@ class CreatePatientForm(forms.ModelForm):
                                     'birthday']) + str(data['sex'])
         data['t_md5'] = shake_256(hashed_str.encode()).hexdigest(16)
         data['t_changed'] = '0'
-        patient = Patient(number_ill_history=data['number_ill_history'],
-                          first_name=data['first_name'],
-                          last_name=data['last_name'],
-                          patronymic=data['patronymic'],
-                          birthday=data['birthday'],
-                          sex=data['sex']
-                          )
+        # форма изменяет переданный экземпляр: через неё же работает изменение записей в api.py
+        patient = self.instance
+        patient.number_ill_history = data['number_ill_history']
+        patient.first_name = data['first_name']
+        patient.last_name = data['last_name']
+        patient.patronymic = data['patronymic']
+        patient.birthday = data['birthday']
+        patient.sex = data['sex']
         if commit:
             patient.save()
         return patient
@@ -91,6 +104,9 @@ class CreateDiagnosisForm(forms.ModelForm):
     class Meta:
         model = ResearchResult
         fields = ('conclusion', 'patient')
+        widgets = {
+            'patient': AutocompleteSelect('patient'),
+        }
 
 
 class CreateCellTypeForm(forms.ModelForm):
@@ -100,6 +116,22 @@ class CreateCellTypeForm(forms.ModelForm):
 
 
 class AddImageForm(forms.ModelForm):
+    allow_duplicate = forms.BooleanField(label="Сохранить, даже если похожее изображение уже загружено", required=False)
+
+    def clean(self):
+        cleaned_data = super().clean()
+        image = cleaned_data.get('image')
+        if image and not cleaned_data.get('allow_duplicate'):
+            try:
+                duplicates = find_duplicates(CellImage, image)
+            except (OSError, ValueError):
+                duplicates = []
+            if duplicates:
+                self.add_error('image', forms.ValidationError(
+                    "Похожее изображение уже загружено: %(images)s",
+                    code='duplicate', params={'images': ", ".join(f"#{pk}" for pk in duplicates)}))
+        return cleaned_data
+
     def save(self, commit=True):
         data = self.cleaned_data
         hashed_str = str(data['medication']) + str(data['scale']) + str(data['patient'])
@@ -113,18 +145,29 @@ class AddImageForm(forms.ModelForm):
                           t_changed=data['t_changed']
                           )
         if commit:
-            patient.save()
+            # в транзакции блокировка по хэшу содержимого (ingest.lock_digests) держится до
+            # фиксации записи, поэтому параллельная загрузка архива не добавит её дубликат
+            with transaction.atomic():
+                patient.save()
         return patient
 
     class Meta:
         model = CellImage
         fields = ('patient', 'image', 'medication', 'scale')
+        widgets = {
+            'patient': AutocompleteSelect('patient'),
+            'medication': AutocompleteSelect('medication'),
+        }
 
 
 class AddMedicationForm(forms.ModelForm):
     class Meta:
         model = Medication
         fields = ('medication_type', 'patient', 'patient_research')
+        widgets = {
+            'patient': AutocompleteSelect('patient'),
+            'patient_research': AutocompleteSelect('patient_research'),
+        }
 
 
 class AddDictForm(forms.ModelForm):
@@ -139,16 +182,26 @@ class AddTermForm(forms.ModelForm):
         fields = ('term_name', 'definition', 'definition')
 
 
-class AddCellCharacteristicForm(forms.ModelForm):
+class AddCellCharacteristicForm(ReferenceFieldsMixin, forms.ModelForm):
     class Meta:
         model = CellCharacteristic
         fields = ('dictcharcteristics', 'cell', 'value')
+        field_classes = {
+            'dictcharcteristics': ReferenceChoiceField,
+        }
+        widgets = {
+            'dictcharcteristics': AutocompleteSelect('dictcharcteristics'),
+            'cell': AutocompleteSelect('cell'),
+        }
 
 
 class AddSystemSettingsForm(forms.ModelForm):
     class Meta:
         model = SystemSettings
         fields = ('medication', 'conditions', 'glass_type', 'artifacts')
+        widgets = {
+            'medication': AutocompleteSelect('medication'),
+        }
 
 
 class AddPatientResearchForm(forms.ModelForm):
@@ -156,6 +209,8 @@ class AddPatientResearchForm(forms.ModelForm):
         model = PatientResearch
         fields = ('date_begin', 'date_end', 'patient', 'researcher')
         widgets = {
+            'patient': AutocompleteSelect('patient'),
+            'researcher': AutocompleteSelect('researcher'),
             'date_begin': DateInput(),
             'date_end': DateInput(),
         }
@@ -164,13 +219,21 @@ class AddPatientResearchForm(forms.ModelForm):
 class AddMarkerForm(forms.ModelForm):
     class Meta:
         model = Marker
-        fields = ('marker_name', 'marker_type')
+        fields = ('marker_name', 'marker_type', 'reference_min', 'reference_max')
 
 
-class AddImmunophenotypingForm(forms.ModelForm):
+class AddImmunophenotypingForm(ReferenceFieldsMixin, forms.ModelForm):
     class Meta:
         model = Immunophenotyping
         fields = ('marker', 'medication', 'research', 'percent_positive_cells')
+        field_classes = {
+            'marker': ReferenceChoiceField,
+        }
+        widgets = {
+            'marker': AutocompleteSelect('marker'),
+            'medication': AutocompleteSelect('medication'),
+            'research': AutocompleteSelect('patient_research'),
+        }
 
 
 class AddResearchedObjectForm(forms.ModelForm):
@@ -0,0 +1,282 @@
+import csv
+import hashlib
+import io
+import json
+import os
+import re
+from dataclasses import dataclass
+from hashlib import shake_256
+
+from PIL import Image
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models.signals import pre_save
+from django.dispatch import receiver
+
+from .models import *
+from .perceptual import image_hashes, to_signed
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".tif", ".tiff", ".bmp")
+# путь файла относительно корня архива по умолчанию: <пациент>/<препарат>/<файл>
+DEFAULT_PATTERN = r"(?P<patient>\d+)/(?P<medication>\d+)/[^/]+$"
+DIGEST_CHUNK = 1 << 20
+
+
+@dataclass(frozen=True)
+class IngestTask:
+    # path - путь относительно корня архива, name - имя файла в MEDIA_ROOT по upload_to модели
+    path: str
+    source: str
+    name: str
+    medication_id: int
+    patient_id: int
+    scale: int
+    t_md5: str
+
+
+def file_digest(file):
+    digest = hashlib.sha256()
+    file.seek(0)
+    while chunk := file.read(DIGEST_CHUNK):
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+
+def lock_digests(digests):
+    """Блокировки PostgreSQL (pg_advisory_xact_lock) по хэшам содержимого до конца транзакции:
+    проверка дубликатов и вставка параллельных загрузок одного содержимого выполняются по очереди.
+    Ключи берутся в порядке возрастания, поэтому пачки не блокируют друг друга взаимно"""
+    keys = sorted({to_signed(int(digest[:16], 16)) for digest in digests})
+    if not keys or connection.vendor != "postgresql":
+        return
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_advisory_xact_lock(key) FROM (SELECT unnest(%s::bigint[]) AS key ORDER BY 1) keys",
+                       [keys])
+
+
+@receiver(pre_save, sender=CellImage)
+def compute_content_digest(sender, instance, *args, **kwargs):
+    # загрузка через форму: хэш содержимого считается, пока новый файл ещё не сохранён.
+    # В транзакции блокировка по хэшу держится до фиксации, и загрузка архива увидит эту запись
+    if not instance.image or getattr(instance.image, "_committed", True):
+        return
+    instance.content_digest = file_digest(instance.image.file)
+    if connection.in_atomic_block:
+        lock_digests([instance.content_digest])
+
+
+def scan(root):
+    """Файлы изображений архива: пути относительно корня с разделителем "/" в порядке обхода"""
+    for directory, directories, names in os.walk(root):
+        directories.sort()
+        for name in sorted(names):
+            if name.lower().endswith(IMAGE_EXTENSIONS) and not name.startswith("."):
+                yield os.path.relpath(os.path.join(directory, name), root).replace(os.sep, "/")
+
+
+def pattern_mapper(pattern, scale=None):
+    """Сопоставление по регулярному выражению с группами medication и, необязательно, patient и scale"""
+    regex = re.compile(pattern)
+
+    def mapping(path):
+        match = regex.search(path)
+        if match is None:
+            return None
+        groups = match.groupdict()
+        return {
+            "medication": groups.get("medication"),
+            "patient": groups.get("patient"),
+            "scale": groups.get("scale") or scale,
+        }
+
+    return mapping
+
+
+def manifest_mapper(manifest, scale=None):
+    """Сопоставление по CSV-манифесту со столбцами path, medication и необязательными patient, scale"""
+    with open(manifest, newline="", encoding="utf-8-sig") as file:
+        rows = {row["path"].strip().replace("\\", "/"): row for row in csv.DictReader(file)}
+
+    def mapping(path):
+        row = rows.get(path)
+        if row is None:
+            return None
+        return {
+            "medication": row.get("medication"),
+            "patient": row.get("patient") or None,
+            "scale": row.get("scale") or scale,
+        }
+
+    return mapping
+
+
+def record_hash(medication, scale, patient):
+    # так же, как AddImageForm.save
+    return shake_256((str(medication) + str(scale) + str(patient)).encode()).hexdigest(16)
+
+
+def plan(root, paths, mapping):
+    """Задачи загрузки и отвергнутые файлы с причиной. Препараты и пациенты загружаются одним
+    запросом; пациент файла должен совпадать с пациентом препарата"""
+    mapped, rejected = [], []
+    for path in paths:
+        values = mapping(path)
+        try:
+            medication_id = int(values["medication"])
+            patient_id = int(values["patient"]) if values["patient"] is not None else None
+            scale = int(values["scale"])
+        except (TypeError, ValueError):
+            rejected.append((path, "не сопоставлен с препаратом и масштабом"))
+            continue
+        mapped.append((path, medication_id, patient_id, scale))
+
+    medications = Medication.objects.select_related("patient").in_bulk({item[1] for item in mapped})
+    patients = Patient.objects.in_bulk({item[2] for item in mapped if item[2] is not None})
+    image_field = CellImage._meta.get_field("image")
+    tasks = []
+    for path, medication_id, patient_id, scale in mapped:
+        medication = medications.get(medication_id)
+        if medication is None:
+            rejected.append((path, f"препарат {medication_id} не найден"))
+            continue
+        if patient_id is None:
+            patient = medication.patient
+        elif medication.patient_id is not None and patient_id != medication.patient_id:
+            rejected.append((path, f"препарат {medication_id} принадлежит другому пациенту"))
+            continue
+        elif patient_id not in patients:
+            rejected.append((path, f"пациент {patient_id} не найден"))
+            continue
+        else:
+            patient = patients[patient_id]
+        patient_id = patient.pk if patient is not None else None
+        t_md5 = record_hash(medication, scale, patient)
+        instance = CellImage(medication=medication, patient=patient, scale=scale, t_md5=t_md5)
+        tasks.append(IngestTask(path=path, source=os.path.join(root, path),
+                                name=image_field.generate_filename(instance, os.path.basename(path)),
+                                medication_id=medication_id, patient_id=patient_id, scale=scale, t_md5=t_md5))
+    return tasks, rejected
+
+
+# хэши содержимого уже загруженных изображений: передаются процессам пула один раз при запуске
+_known_digests = frozenset()
+
+
+def init_worker(known_digests):
+    global _known_digests
+    _known_digests = known_digests
+
+
+def store(data, name, digest):
+    """Записывает файл в MEDIA_ROOT под именем name, а если оно занято - с хэшем содержимого
+    в имени. Файл пишется во временный и появляется под итоговым именем через link, который
+    не перезаписывает существующий файл, поэтому параллельные процессы не мешают друг другу"""
+    full_path = os.path.join(settings.MEDIA_ROOT, name)
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    temporary = f"{full_path}.{os.getpid()}.part"
+    with open(temporary, "wb") as file:
+        file.write(data)
+    stem, extension = os.path.splitext(name)
+    try:
+        for candidate in (name, f"{stem}_{digest[:8]}{extension}", f"{stem}_{digest}{extension}"):
+            try:
+                os.link(temporary, os.path.join(settings.MEDIA_ROOT, candidate))
+                return candidate
+            except FileExistsError:
+                continue
+        raise FileExistsError(full_path)
+    finally:
+        os.remove(temporary)
+
+
+def ingest_file(task):
+    """Выполняется в процессе пула: читает файл один раз, считает SHA-256, проверяет, что это
+    изображение, считает перцептивные хэши и копирует в MEDIA_ROOT. К БД не обращается"""
+    result = {"path": task.path}
+    try:
+        with open(task.source, "rb") as file:
+            data = file.read()
+    except OSError as error:
+        return dict(result, status="unreadable", error=str(error))
+    digest = hashlib.sha256(data).hexdigest()
+    result["digest"] = digest
+    if digest in _known_digests:
+        return dict(result, status="duplicate")
+    try:
+        with Image.open(io.BytesIO(data)) as picture:
+            picture.verify()
+        phash, dhash = image_hashes(io.BytesIO(data))
+    except (OSError, ValueError, SyntaxError, Image.DecompressionBombError) as error:
+        return dict(result, status="invalid", error=str(error))
+    try:
+        name = store(data, task.name, digest)
+    except OSError as error:
+        return dict(result, status="unwritable", error=str(error))
+    return dict(result, status="stored", name=name, phash=to_signed(phash), dhash=to_signed(dhash))
+
+
+def save_batch(tasks, results):
+    """Создаёт записи изображений пачки одним bulk_create. Содержимое, уже загруженное
+    параллельной загрузкой или повторённое внутри пачки, не сохраняется, его копия удаляется"""
+    stored = [result for result in results if result["status"] == "stored"]
+    with transaction.atomic():
+        # без блокировки параллельная загрузка того же содержимого, ещё не зафиксированная,
+        # не видна этой проверке, и обе вставили бы по записи
+        lock_digests([result["digest"] for result in stored])
+        existing = set(CellImage.objects.filter(content_digest__in=[result["digest"] for result in stored])
+                       .values_list("content_digest", flat=True))
+        rows = []
+        for result in stored:
+            if result["digest"] in existing:
+                os.remove(os.path.join(settings.MEDIA_ROOT, result["name"]))
+                result.update(status="duplicate", name=None)
+                continue
+            existing.add(result["digest"])
+            task = tasks[result["path"]]
+            rows.append((result, CellImage(image=result["name"], medication_id=task.medication_id,
+                                           patient_id=task.patient_id, scale=task.scale, t_md5=task.t_md5,
+                                           t_changed=0, phash=result["phash"], dhash=result["dhash"],
+                                           content_digest=result["digest"])))
+        CellImage.objects.bulk_create([row for result, row in rows])
+    for result, row in rows:
+        result.update(status="ingested", id=row.pk)
+    return results
+
+
+class IngestJournal:
+    """Журнал загрузки архива: по строке JSON на обработанный файл. Строки дописываются после
+    фиксации транзакции пачки, поэтому повторный запуск пропускает записанные файлы, а файлы
+    пачки, прерванной до записи в журнал, отсекаются по хэшу содержимого"""
+
+    def __init__(self, path):
+        self.path = path
+
+    @classmethod
+    def for_root(cls, root):
+        digest = hashlib.sha1(os.path.abspath(root).encode()).hexdigest()[:16]
+        return cls(os.path.join(settings.INGEST_JOURNAL_DIR, f"{digest}.jsonl"))
+
+    def load(self):
+        done = {}
+        try:
+            with open(self.path, encoding="utf-8") as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # строка, недописанная при аварийном завершении
+                        continue
+                    done[entry["path"]] = entry
+        except FileNotFoundError:
+            pass
+        return done
+
+    def append(self, results):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as file:
+            for result in results:
+                file.write(json.dumps({key: result.get(key) for key in ("path", "status", "digest", "id", "error")},
+                                      ensure_ascii=False) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
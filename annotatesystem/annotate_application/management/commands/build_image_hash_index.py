@@ -0,0 +1,49 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from annotate_application.caching import bump_model_version
+from annotate_application.models import Cell, CellImage
+from annotate_application.perceptual import HASH_INDEXES, hashes_changed, image_hashes, to_signed
+
+
+def hash_rows(model, rows):
+    # Pillow освобождает GIL при декодировании и масштабировании, поэтому потоки работают параллельно
+    updated = []
+    try:
+        for pk, name in rows:
+            try:
+                with model._meta.get_field("image").storage.open(name) as file:
+                    phash, dhash = image_hashes(file)
+            except (OSError, ValueError):
+                continue
+            updated.append(model(pk=pk, phash=to_signed(phash), dhash=to_signed(dhash)))
+        model.objects.bulk_update(updated, ["phash", "dhash"])
+    finally:
+        connection.close()
+    return len(updated)
+
+
+class Command(BaseCommand):
+    help = "Считает недостающие перцептивные хэши изображений и сохраняет снимки индекса близких дубликатов"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=4, help="количество параллельных потоков")
+        parser.add_argument("--batch", type=int, default=200, help="изображений в одной задаче")
+
+    def handle(self, *args, **options):
+        for model in (CellImage, Cell):
+            rows = list(model.objects.filter(phash__isnull=True).exclude(image="").values_list("pk", "image"))
+            batches = [rows[start:start + options["batch"]] for start in range(0, len(rows), options["batch"])]
+            with ThreadPoolExecutor(max_workers=options["workers"]) as pool:
+                hashed = sum(pool.map(lambda batch: hash_rows(model, batch), batches))
+            if hashed:
+                # bulk_update не отправляет сигналов: индексы работающих процессов перечитают таблицу
+                hashes_changed(model)
+                bump_model_version(model)
+            index = HASH_INDEXES[model]
+            index.rebuild()
+            index.save()
+            self.stdout.write(f"{model._meta.verbose_name_plural}: посчитано хэшей {hashed}, в индексе {len(index.pks)}")
+        self.stdout.write(self.style.SUCCESS("Индекс перцептивных хэшей сохранён"))
@@ -0,0 +1,36 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from annotate_application.models import CellImage
+from annotate_application.rasters import RasterUnavailable, cache_size, evict, rasters
+
+
+def build(image_id):
+    # декодирование в Pillow и запись массивов освобождают GIL, поэтому потоки работают параллельно
+    try:
+        rasters.get(image_id)
+        return True
+    except RasterUnavailable:
+        return False
+    finally:
+        connection.close()
+
+
+class Command(BaseCommand):
+    help = "Заранее декодирует изображения в кэш растров для чтения областей и очищает его по размеру"
+
+    def add_arguments(self, parser):
+        parser.add_argument("images", nargs="*", type=int, help="идентификаторы изображений, по умолчанию все")
+        parser.add_argument("--workers", type=int, default=4, help="количество параллельных потоков")
+        parser.add_argument("--evict-only", action="store_true", help="только удалить давно не читавшиеся растры")
+
+    def handle(self, *args, **options):
+        if not options["evict_only"]:
+            images = options["images"] or CellImage.objects.exclude(image="").values_list("pk", flat=True).order_by("pk")
+            with ThreadPoolExecutor(max_workers=options["workers"]) as pool:
+                results = list(pool.map(build, images))
+            self.stdout.write(f"Растров готово: {sum(results)}, без файла или не декодируется: {results.count(False)}")
+        removed = evict()
+        self.stdout.write(self.style.SUCCESS(f"Удалено растров: {removed}, размер кэша: {cache_size()} байт"))
@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+
+from annotate_application.models import Cell, CellImage
+from annotate_application.perceptual import HASH_INDEXES
+
+
+class Command(BaseCommand):
+    help = "Находит группы близких дубликатов среди загруженных изображений"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--cells", action="store_true", help="искать среди изображений клеток, а не препаратов")
+        parser.add_argument("--distance", type=int, default=None,
+                            help="максимальное расстояние Хэмминга между pHash (по умолчанию IMAGE_PHASH_DISTANCE)")
+
+    def handle(self, *args, **options):
+        index = HASH_INDEXES[Cell if options["cells"] else CellImage]
+        index.refresh()
+
+        # система непересекающихся множеств по найденным парам
+        parent = {}
+
+        def find(pk):
+            parent.setdefault(pk, pk)
+            while parent[pk] != pk:
+                parent[pk] = parent[parent[pk]]
+                pk = parent[pk]
+            return pk
+
+        for pk, phash, dhash in zip(index.pks.tolist(), index.hashes.tolist(), index.dhashes.tolist()):
+            for other, distance in index.search(phash, dhash, distance=options["distance"], exclude=pk):
+                parent[find(other)] = find(pk)
+
+        clusters = {}
+        for pk in parent:
+            clusters.setdefault(find(pk), []).append(pk)
+        clusters = sorted((sorted(members) for members in clusters.values() if len(members) > 1), key=len, reverse=True)
+        for members in clusters:
+            self.stdout.write(", ".join(f"#{pk}" for pk in members))
+        self.stdout.write(self.style.SUCCESS(f"Групп дубликатов: {len(clusters)}"))
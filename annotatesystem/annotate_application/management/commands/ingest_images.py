@@ -0,0 +1,81 @@
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from annotate_application.ingest import (DEFAULT_PATTERN, IngestJournal, ingest_file, init_worker, manifest_mapper,
+                                         pattern_mapper, plan, save_batch, scan)
+from annotate_application.models import CellImage
+
+
+class Command(BaseCommand):
+    help = ("Загружает каталог с изображениями препаратов: файлы сопоставляются с препаратами по манифесту "
+            "или шаблону пути, проверяются и копируются в MEDIA_ROOT пулом процессов, записи создаются пачками")
+
+    def add_arguments(self, parser):
+        parser.add_argument("root", help="корень каталога с изображениями")
+        parser.add_argument("--manifest", help="CSV со столбцами path, medication и необязательными patient, scale")
+        parser.add_argument("--pattern", default=DEFAULT_PATTERN,
+                            help="регулярное выражение для пути относительно корня с группами medication, "
+                                 "patient, scale (по умолчанию <пациент>/<препарат>/<файл>)")
+        parser.add_argument("--scale", type=int, default=None, help="масштаб для файлов, где он не указан")
+        parser.add_argument("--workers", type=int, default=os.cpu_count(), help="количество процессов")
+        parser.add_argument("--batch", type=int, default=500, help="записей в одной вставке")
+        parser.add_argument("--journal", help="файл журнала загрузки (по умолчанию в INGEST_JOURNAL_DIR)")
+        parser.add_argument("--dry-run", action="store_true", help="только сопоставить файлы и вывести итог")
+
+    def handle(self, *args, **options):
+        root = options["root"]
+        if not os.path.isdir(root):
+            raise CommandError(f"Каталог {root} не найден")
+        mapping = (manifest_mapper(options["manifest"], options["scale"]) if options["manifest"]
+                   else pattern_mapper(options["pattern"], options["scale"]))
+        journal = IngestJournal(options["journal"]) if options["journal"] else IngestJournal.for_root(root)
+        done = journal.load()
+
+        paths = [path for path in scan(root) if path not in done]
+        tasks, rejected = plan(root, paths, mapping)
+        if options["verbosity"] > 1:
+            for path, reason in rejected:
+                self.stderr.write(f"{path}: {reason}")
+        self.stdout.write(f"Файлов к загрузке: {len(tasks)}, уже в журнале: {len(done)}, "
+                          f"не сопоставлено: {len(rejected)} (список - с --verbosity 2)")
+        if options["dry_run"] or not tasks:
+            return
+
+        known = frozenset(CellImage.objects.exclude(content_digest=None).values_list("content_digest", flat=True))
+        by_path = {task.path: task for task in tasks}
+        totals, batch, started, copied = {}, [], time.monotonic(), 0
+        # процессы пула создаются копированием родителя с уже настроенным Django (fork);
+        # открытые соединения с БД не должны им достаться
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=options["workers"], mp_context=multiprocessing.get_context("fork"),
+                                 initializer=init_worker, initargs=(known,)) as pool:
+            for result in pool.map(ingest_file, tasks, chunksize=4):
+                batch.append(result)
+                if len(batch) >= options["batch"]:
+                    copied += self.flush(journal, by_path, batch, totals)
+                    batch = []
+            copied += self.flush(journal, by_path, batch, totals)
+
+        elapsed = time.monotonic() - started
+        self.stdout.write(", ".join(f"{status}: {count}" for status, count in sorted(totals.items())))
+        self.stdout.write(self.style.SUCCESS(
+            f"Загружено {totals.get('ingested', 0)} изображений за {elapsed:.1f} с "
+            f"({copied / max(elapsed, 1e-6) / 2 ** 20:.1f} МБ/с)"))
+
+    def flush(self, journal, by_path, batch, totals):
+        if not batch:
+            return 0
+        save_batch(by_path, batch)
+        journal.append(batch)
+        copied = 0
+        for result in batch:
+            totals[result["status"]] = totals.get(result["status"], 0) + 1
+            if result["status"] == "ingested":
+                copied += os.path.getsize(by_path[result["path"]].source)
+        self.stdout.write(f"обработано {sum(totals.values())}")
+        return copied
@@ -0,0 +1,125 @@
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from annotate_application.caching import bump_model_version, bump_row_version, invalidate_patient_records
+from annotate_application.changes import record_changes
+from annotate_application.media_paths import is_sharded, sharded_name
+from annotate_application.models import Cell, CellImage, ChangeLog, MediaMove
+
+
+def link_file(old, key):
+    """Создаёт для файла второе имя в раскладке по хэшу (жёсткая ссылка, без копирования
+    данных), прежнее имя остаётся рабочим. None - исходного файла нет"""
+    source = os.path.join(settings.MEDIA_ROOT, old)
+    if not os.path.isfile(source):
+        return None
+    new = sharded_name(old, key)
+    stem, extension = os.path.splitext(new)
+    # одноимённые файлы разных дней с одинаковым ключом различаются хэшем прежнего пути
+    for candidate in (new, f"{stem}_{hashlib.sha1(old.encode()).hexdigest()[:8]}{extension}"):
+        target = os.path.join(settings.MEDIA_ROOT, candidate)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        try:
+            os.link(source, target)
+            return candidate
+        except FileExistsError:
+            # ссылка осталась от прерванного запуска
+            if os.path.samefile(source, target):
+                return candidate
+    raise FileExistsError(new)
+
+
+def remove_old(old, new):
+    """Удаляет прежнее имя файла, если новое указывает на те же данные, и опустевшие каталоги"""
+    source, target = os.path.join(settings.MEDIA_ROOT, old), os.path.join(settings.MEDIA_ROOT, new)
+    try:
+        if not os.path.samefile(source, target):
+            return False
+        os.remove(source)
+    except FileNotFoundError:
+        return False
+    directory, top = os.path.dirname(source), os.path.join(settings.MEDIA_ROOT, old.split("/")[0])
+    while directory != top and directory.startswith(top):
+        try:
+            os.rmdir(directory)
+        except OSError:
+            break
+        directory = os.path.dirname(directory)
+    return True
+
+
+class Command(BaseCommand):
+    help = ("Переносит файлы изображений в раскладку по хэшу без остановки приложения: файлы получают "
+            "новое имя жёсткой ссылкой, записи обновляются пачками, прежние адреса перенаправляются на новые. "
+            "С --finish удаляет прежние имена уже перенесённых файлов")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch", type=int, default=500, help="записей в одной транзакции")
+        parser.add_argument("--workers", type=int, default=8, help="потоков работы с файлами")
+        parser.add_argument("--finish", action="store_true", help="удалить прежние имена перенесённых файлов")
+
+    def handle(self, *args, **options):
+        with ThreadPoolExecutor(max_workers=options["workers"]) as pool:
+            if options["finish"]:
+                self.finish(pool, options["batch"])
+                return
+            for model in (CellImage, Cell):
+                moved, missing = self.migrate(model, pool, options["batch"])
+                self.stdout.write(f"{model._meta.verbose_name_plural}: перенесено {moved}, файлов нет {missing}")
+        self.stdout.write(self.style.SUCCESS("Перенос завершён; прежние имена удаляются запуском с --finish"))
+
+    def migrate(self, model, pool, batch):
+        fields = ("pk", "image", "content_digest") if model is CellImage else ("pk", "image")
+        last, moved, missing = 0, 0, 0
+        while True:
+            # ключевая пагинация по первичному ключу: без OFFSET и без долгой транзакции на всю таблицу
+            rows = list(model.objects.filter(pk__gt=last).exclude(image="").order_by("pk").values_list(*fields)[:batch])
+            if not rows:
+                return moved, missing
+            last = rows[-1][0]
+            rows = [row for row in rows if not is_sharded(row[1])]
+            links = list(pool.map(lambda row: link_file(row[1], row[2] if len(row) > 2 else None), rows))
+            missing += links.count(None)
+            planned = {row[0]: (row[1], new) for row, new in zip(rows, links) if new is not None}
+            if not planned:
+                continue
+
+            with transaction.atomic():
+                # запись могла получить новый файл, пока создавались ссылки: её не трогаем
+                current = dict(model.objects.select_for_update().filter(pk__in=planned).values_list("pk", "image"))
+                changed = {pk: names for pk, names in planned.items() if current.get(pk) == names[0]}
+                model.objects.bulk_update([model(pk=pk, image=new) for pk, (old, new) in changed.items()], ["image"])
+                MediaMove.objects.bulk_create([MediaMove(old_name=old, new_name=new) for old, new in changed.values()],
+                                              ignore_conflicts=True)
+                # у клеток изменения в ленту записывает CellQuerySet.update, через который идёт bulk_update
+                if model is CellImage:
+                    record_changes(model, list(changed), ChangeLog.UPDATE)
+            for pk in changed:
+                bump_row_version(model, pk)
+            bump_model_version(model)
+            invalidate_patient_records(model, list(changed))
+            for pk in set(planned) - set(changed):
+                os.remove(os.path.join(settings.MEDIA_ROOT, planned[pk][1]))
+            moved += len(changed)
+            self.stdout.write(f"{model._meta.verbose_name_plural}: до id {last}, перенесено {moved}")
+
+    def finish(self, pool, batch):
+        removed, last = 0, 0
+        while True:
+            moves = list(MediaMove.objects.filter(pk__gt=last).order_by("pk").values_list("pk", "old_name", "new_name")
+                         [:batch])
+            if not moves:
+                break
+            last = moves[-1][0]
+            olds = [old for _, old, _ in moves]
+            # прежнее имя снова занято записью (например, загружен файл с тем же путём): не удаляем
+            referenced = set(CellImage.objects.filter(image__in=olds).values_list("image", flat=True)) | \
+                set(Cell.objects.filter(image__in=olds).values_list("image", flat=True))
+            removed += sum(pool.map(lambda move: remove_old(move[1], move[2]),
+                                    [move for move in moves if move[1] not in referenced]))
+        self.stdout.write(self.style.SUCCESS(f"Удалено прежних имён файлов: {removed}"))
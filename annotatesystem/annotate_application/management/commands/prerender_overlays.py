@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from annotate_application.models import CellMarking
+from annotate_application.overlays import prerender
+
+
+class Command(BaseCommand):
+    help = "Заранее рисует и кэширует плитки оверлеев маркировок для изображений с маркировками"
+
+    def add_arguments(self, parser):
+        parser.add_argument("images", nargs="*", type=int, help="идентификаторы изображений, по умолчанию все")
+        parser.add_argument("--workers", type=int, default=None, help="количество потоков отрисовки")
+
+    def handle(self, *args, **options):
+        images = options["images"] or CellMarking.objects.values_list("image_id", flat=True).distinct().order_by(
+            "image_id")
+        total = 0
+        for image_id in images:
+            total += prerender(image_id, workers=options["workers"])
+        self.stdout.write(self.style.SUCCESS(f"Отрисовано плиток: {total}"))
@@ -0,0 +1,16 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from annotate_application.changes import prune_changes
+
+
+class Command(BaseCommand):
+    help = "Удаляет из ленты изменений записи старше срока хранения"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, default=settings.CHANGE_FEED_RETENTION_DAYS,
+                            help="срок хранения изменений в днях")
+
+    def handle(self, *args, **options):
+        deleted = prune_changes(options["days"])
+        self.stdout.write(self.style.SUCCESS(f"Удалено изменений: {deleted}"))
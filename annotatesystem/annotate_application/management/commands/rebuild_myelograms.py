@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from annotate_application.myelogram import rebuild_myelograms, refresh_myelograms
+
+
+class Command(BaseCommand):
+    help = "Пересчитывает таблицу миелограмм по записям морфологического исследования"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--medication", type=int, nargs="+",
+                            help="пересчитать только указанные препараты")
+
+    def handle(self, *args, **options):
+        if options["medication"]:
+            refresh_myelograms(options["medication"])
+        else:
+            rebuild_myelograms()
+        self.stdout.write(self.style.SUCCESS("Миелограммы пересчитаны"))
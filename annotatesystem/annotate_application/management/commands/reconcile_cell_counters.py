@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from annotate_application.counters import reconcile_counters
+
+
+class Command(BaseCommand):
+    help = "Сверяет счётчики клеток по типам (изображения, препараты, пациенты) с таблицей клеток"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=4, help="количество параллельных потоков")
+        parser.add_argument("--chunk", type=int, default=5000,
+                            help="размер диапазона идентификаторов, сверяемого одной задачей")
+
+    def handle(self, *args, **options):
+        fixed = reconcile_counters(workers=options["workers"], chunk=options["chunk"])
+        for name, count in sorted(fixed.items()):
+            self.stdout.write(f"{name}: исправлено строк {count}")
+        self.stdout.write(self.style.SUCCESS("Счётчики клеток сверены"))
@@ -0,0 +1,103 @@
+import json
+import os
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from annotate_application.models import CellImage
+from annotate_application.scrub import (MISSING, ORPHAN, diff, file_sha256, is_settled, media_files, quarantine,
+                                        referenced_files)
+
+
+class Command(BaseCommand):
+    help = ("Сверяет файлы MEDIA_ROOT со ссылками изображений в БД: находит отсутствующие файлы, "
+            "файлы без записей (по желанию переносит в карантин) и файлы с изменившимся содержимым")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--quarantine", action="store_true", help="перенести файлы без записей в карантин")
+        parser.add_argument("--min-age", type=float, default=24,
+                            help="файлы моложе стольких часов не считаются лишними (по умолчанию 24)")
+        parser.add_argument("--no-verify", action="store_true", help="не сверять хэши содержимого")
+        parser.add_argument("--fill-digests", action="store_true",
+                            help="сохранить хэш содержимого изображениям, у которых его нет")
+        parser.add_argument("--workers", type=int, default=8, help="потоков хэширования")
+        parser.add_argument("--report", help="файл JSONL со списком найденных проблем")
+
+    def handle(self, *args, **options):
+        self.counts = Counter()
+        self.verbosity = options["verbosity"]
+        self.report = open(options["report"], "w", encoding="utf-8") if options["report"] else None
+        self.digests = []
+        batch = timezone.now().strftime("%Y%m%d-%H%M%S")
+        min_age = options["min_age"] * 60 * 60
+        verify = not options["no_verify"]
+        fill = options["fill_digests"]
+
+        # очередь хэширования ограничена, поэтому в памяти не больше нескольких задач на поток
+        pending = deque()
+        try:
+            with ThreadPoolExecutor(max_workers=options["workers"]) as pool:
+                for state, reference, file in diff(referenced_files(), media_files()):
+                    if state == MISSING:
+                        self.problem("missing", reference.name, model=reference.model._meta.model_name, id=reference.pk)
+                    elif state == ORPHAN:
+                        name, full_path = file
+                        if not is_settled(full_path, min_age):
+                            self.counts["recent"] += 1
+                            continue
+                        self.problem("orphan", name)
+                        if options["quarantine"]:
+                            quarantine(name, batch)
+                            self.counts["quarantined"] += 1
+                    else:
+                        self.counts["present"] += 1
+                        if (verify and reference.digest) or (fill and reference.model is CellImage
+                                                             and reference.digest is None):
+                            pending.append((reference, pool.submit(file_sha256, file[1])))
+                            if len(pending) >= options["workers"] * 4:
+                                self.check(*pending.popleft())
+                while pending:
+                    self.check(*pending.popleft())
+            self.save_digests()
+        finally:
+            if self.report:
+                self.report.close()
+
+        self.stdout.write(", ".join(f"{key}: {value}" for key, value in sorted(self.counts.items())))
+        if options["quarantine"] and self.counts["quarantined"]:
+            self.stdout.write(f"Карантин: {os.path.join(settings.MEDIA_ROOT, settings.MEDIA_QUARANTINE_DIR, batch)}")
+        style = self.style.SUCCESS if not (self.counts["missing"] or self.counts["corrupt"]) else self.style.ERROR
+        self.stdout.write(style(f"Отсутствует файлов: {self.counts['missing']}, "
+                                f"с изменённым содержимым: {self.counts['corrupt']}"))
+
+    def check(self, reference, future):
+        try:
+            digest = future.result()
+        except OSError as error:
+            self.problem("unreadable", reference.name, id=reference.pk, error=str(error))
+            return
+        if reference.digest is None:
+            self.digests.append(CellImage(pk=reference.pk, content_digest=digest))
+            if len(self.digests) >= 500:
+                self.save_digests()
+        elif digest != reference.digest:
+            self.problem("corrupt", reference.name, model=reference.model._meta.model_name, id=reference.pk,
+                         expected=reference.digest, actual=digest)
+        else:
+            self.counts["verified"] += 1
+
+    def save_digests(self):
+        if self.digests:
+            CellImage.objects.bulk_update(self.digests, ["content_digest"])
+            self.counts["digests_filled"] += len(self.digests)
+            self.digests = []
+
+    def problem(self, kind, name, **details):
+        self.counts[kind] += 1
+        if kind != "orphan" or self.verbosity > 1:
+            self.stderr.write(f"{kind}: {name}")
+        if self.report:
+            self.report.write(json.dumps(dict(kind=kind, name=name, **details), ensure_ascii=False) + "\n")
@@ -0,0 +1,178 @@
+import io
+import mimetypes
+import os
+import re
+import stat
+from urllib.parse import quote
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import FileResponse, Http404, HttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date, parse_etags, parse_http_date_safe
+
+from .staticfiles import select_variant
+
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+class FileRange(io.RawIOBase):
+    # окно [start, start + length) открытого файла. fileno() отдаётся как есть, чтобы
+    # wsgi.file_wrapper сервера (gunicorn) мог передать окно через os.sendfile без копирования
+    def __init__(self, file, start, length):
+        super().__init__()
+        self.file = file
+        self.name = file.name
+        self.remaining = length
+        self.file.seek(start)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def tell(self):
+        return self.file.tell()
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        return self.file.seek(offset, whence)
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+        super().close()
+
+
+def parse_range(header, size):
+    """Разбирает заголовок Range с одним диапазоном, возвращает (start, end) включительно.
+    None - заголовок нужно проигнорировать и отдать файл целиком, ValueError - диапазон вне файла"""
+    match = RANGE_RE.match(header.strip())
+    if not match:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        start, end = max(size - int(last), 0), size - 1
+    else:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise ValueError(header)
+    return start, end
+
+
+def serve_file(request, full_path, relative_path, max_age=None, immutable=False):
+    """Отдаёт файл из MEDIA_ROOT: 304 по ETag/Last-Modified без чтения файла, затем передача
+    фронтенд-серверу (X-Accel-Redirect/X-Sendfile) или потоковая отдача с поддержкой Range"""
+    try:
+        file_stat = os.stat(full_path)
+    except OSError:
+        raise Http404
+    if not stat.S_ISREG(file_stat.st_mode):
+        raise Http404
+
+    etag = f'"{file_stat.st_mtime_ns:x}-{file_stat.st_size:x}"'
+    last_modified = int(file_stat.st_mtime)
+    content_type, encoding = mimetypes.guess_type(full_path)
+    content_type = content_type or "application/octet-stream"
+
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        if settings.MEDIA_SERVE_MODE == "x-accel":
+            response = HttpResponse(content_type=content_type)
+            response.headers["X-Accel-Redirect"] = quote(settings.MEDIA_ACCEL_PREFIX + relative_path)
+        elif settings.MEDIA_SERVE_MODE == "x-sendfile":
+            response = HttpResponse(content_type=content_type)
+            response.headers["X-Sendfile"] = full_path
+        else:
+            response = _stream_file(request, full_path, file_stat.st_size, content_type, etag, last_modified)
+    response.headers["ETag"] = etag
+    response.headers["Last-Modified"] = http_date(last_modified)
+    if max_age is not None and immutable:
+        patch_cache_control(response, private=True, max_age=max_age, immutable=True)
+    elif max_age is not None:
+        patch_cache_control(response, private=True, max_age=max_age)
+
+    return response
+
+
+def serve_static(request, full_path, immutable=False):
+    """Отдаёт файл из STATIC_ROOT, выбирая заранее сжатый при collectstatic вариант (.br, .gz) по
+    Accept-Encoding. Файлы с хэшем содержимого в имени кэшируются браузером и прокси на год"""
+    if not os.path.isfile(full_path):
+        raise Http404
+    path, encoding = select_variant(full_path, request.META.get("HTTP_ACCEPT_ENCODING", ""))
+    file_stat = os.stat(path)
+    etag = f'"{file_stat.st_mtime_ns:x}-{file_stat.st_size:x}"'
+    last_modified = int(file_stat.st_mtime)
+
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        content_type, _ = mimetypes.guess_type(full_path)
+        response = FileResponse(open(path, "rb"), content_type=content_type or "application/octet-stream")
+        if encoding:
+            response.headers["Content-Encoding"] = encoding
+    response.headers["ETag"] = etag
+    response.headers["Last-Modified"] = http_date(last_modified)
+    patch_vary_headers(response, ("Accept-Encoding",))
+    if immutable:
+        patch_cache_control(response, public=True, max_age=60 * 60 * 24 * 365, immutable=True)
+    else:
+        patch_cache_control(response, public=True, no_cache=True)
+
+    return response
+
+
+def _stream_file(request, full_path, size, content_type, etag, last_modified):
+    byte_range = None
+    range_header = request.META.get("HTTP_RANGE")
+    if range_header and request.method == "GET" and _if_range_passes(request, etag, last_modified):
+        try:
+            byte_range = parse_range(range_header, size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response.headers["Content-Range"] = f"bytes */{size}"
+            return response
+
+    file = open(full_path, "rb")
+    if byte_range is None:
+        response = FileResponse(file, content_type=content_type)
+    else:
+        start, end = byte_range
+        response = FileResponse(FileRange(file, start, end - start + 1), content_type=content_type, status=206)
+        response.headers["Content-Length"] = str(end - start + 1)
+        response.headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    response.headers["Accept-Ranges"] = "bytes"
+
+    return response
+
+
+def _if_range_passes(request, etag, last_modified):
+    if_range = request.META.get("HTTP_IF_RANGE")
+    if not if_range:
+        return True
+    if if_range.startswith(('"', 'W/"')):
+        return etag in parse_etags(if_range)
+    return parse_http_date_safe(if_range) == last_modified
+
+
+async def aiter_file(file, block_size):
+    # асинхронная отдача файла под ASGI: чтение блоками в пуле потоков вместо
+    # загрузки всего файла в память при потреблении синхронного итератора
+    read = sync_to_async(file.read, thread_sensitive=False)
+    try:
+        while chunk := await read(block_size):
+            yield chunk
+    finally:
+        file.close()
@@ -0,0 +1,58 @@
+import datetime
+import hashlib
+import os
+import re
+import uuid
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+# Стратегии раскладки загружаемых файлов по каталогам MEDIA_ROOT: функция (префикс, запись,
+# имя файла) -> путь. Выбирается настройкой MEDIA_PATH_STRATEGY.
+SHARDED_RE = re.compile(r"^[^/]+/[0-9a-f]{2}/[0-9a-f]{2}/[^/]+$")
+
+
+def _file_name(instance, filename):
+    # у клеток нет хэша записи
+    t_md5 = getattr(instance, "t_md5", None)
+    return f"{t_md5}-{filename}" if t_md5 else filename
+
+
+def dated_path(prefix, instance, filename):
+    """Прежняя раскладка: <префикс>/<год>/<месяц>/<день>/<хэш записи>-<имя>. За один
+    загруженный день в каталоге собираются десятки тысяч файлов"""
+    today = datetime.date.today()
+    return f"{prefix}/{today.year}/{today.month}/{today.day}/{_file_name(instance, filename)}"
+
+
+def shard(key):
+    digest = hashlib.sha1(key.encode()).hexdigest()
+    return f"{digest[:2]}/{digest[2:4]}"
+
+
+def sharded_path(prefix, instance, filename):
+    """<префикс>/<xx>/<yy>/<хэш записи>-<имя>: два уровня по 256 каталогов по хэшу содержимого
+    (если он уже посчитан) или случайному ключу, поэтому каталоги заполняются равномерно"""
+    key = getattr(instance, "content_digest", None) or uuid.uuid4().hex
+    return f"{prefix}/{shard(key)}/{_file_name(instance, filename)}"
+
+
+def media_path(prefix, instance, filename):
+    return import_string(settings.MEDIA_PATH_STRATEGY)(prefix, instance, filename)
+
+
+def is_sharded(name):
+    return bool(SHARDED_RE.match(name))
+
+
+def sharded_name(name, key=None):
+    """Путь файла name в раскладке по хэшу: префикс и имя файла сохраняются"""
+    prefix, _, rest = name.partition("/")
+    return f"{prefix}/{shard(key or name)}/{os.path.basename(rest)}"
+
+
+def moved_name(name):
+    """Новый путь файла, перенесённого командой migrate_media_layout; None - файл не переносился"""
+    from .models import MediaMove
+
+    return MediaMove.objects.filter(old_name=name).values_list("new_name", flat=True).first()
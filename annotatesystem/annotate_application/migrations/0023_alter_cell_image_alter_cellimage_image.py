@@ -0,0 +1,24 @@
+# Generated by Django 4.2.5 on 2026-10-19 13:08
+
+import annotate_application.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('annotate_application', '0022_cellimage_begin_date_cellimage_end_date_and_more'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='cell',
+            name='image',
+            field=models.ImageField(blank=True, db_index=True, upload_to=annotate_application.models.image_directory_path, verbose_name='Фото'),
+        ),
+        migrations.AlterField(
+            model_name='cellimage',
+            name='image',
+            field=models.ImageField(blank=True, db_index=True, upload_to=annotate_application.models.image_directory_path, verbose_name='Фото'),
+        ),
+    ]
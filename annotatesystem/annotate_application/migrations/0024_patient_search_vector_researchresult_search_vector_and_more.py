@@ -0,0 +1,85 @@
+# Generated by Django 4.2.5 on 2026-10-19 13:12
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.operations
+import django.contrib.postgres.search
+from django.db import migrations, models
+
+
+def fill_search_vectors(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    from django.contrib.postgres.search import SearchVector
+
+    sources = {
+        'Patient': [('last_name', 'A'), ('first_name', 'A'), ('patronymic', 'B')],
+        'Terms': [('term_name', 'A'), ('definition', 'B'), ('description', 'C')],
+        'ResearchResult': [('conclusion', 'A')],
+        'SystemLog': [('action_text', 'A'), ('description', 'B'), ('object_sender', 'C')],
+    }
+    for model_name, fields in sources.items():
+        vector = None
+        for field, weight in fields:
+            part = SearchVector(field, weight=weight, config='russian')
+            vector = part if vector is None else vector + part
+        apps.get_model('annotate_application', model_name).objects.update(search_vector=vector)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('annotate_application', '0023_alter_cell_image_alter_cellimage_image'),
+    ]
+
+    operations = [
+        django.contrib.postgres.operations.TrigramExtension(),
+        migrations.AddField(
+            model_name='patient',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='researchresult',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='systemlog',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='terms',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='patient',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='al_patient_search_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='patient',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['last_name'], name='al_patient_last_name_trgm_idx', opclasses=['gin_trgm_ops']),
+        ),
+        migrations.AddIndex(
+            model_name='patient',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['first_name'], name='al_patient_first_name_trgm_idx', opclasses=['gin_trgm_ops']),
+        ),
+        migrations.AddIndex(
+            model_name='patient',
+            index=models.Index(fields=['number_ill_history'], name='al_patient_ill_history_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='researchresult',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='al_research_result_search_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='systemlog',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='al_log_search_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='terms',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='al_term_search_idx'),
+        ),
+        migrations.RunPython(fill_search_vectors, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.5 on 2026-10-19 13:15
+
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+import django.db.models.functions.text
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('annotate_application', '0024_patient_search_vector_researchresult_search_vector_and_more'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='medication',
+            index=models.Index(django.contrib.postgres.indexes.OpClass(django.db.models.functions.text.Upper('medication_type'), name='text_pattern_ops'), name='al_medication_prefix_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='patient',
+            index=models.Index(django.contrib.postgres.indexes.OpClass(django.db.models.functions.text.Upper('last_name'), name='text_pattern_ops'), name='al_patient_lname_prefix_idx'),
+        ),
+    ]
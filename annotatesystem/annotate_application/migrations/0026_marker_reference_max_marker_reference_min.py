@@ -0,0 +1,23 @@
+# Generated by Django 4.2.5 on 2026-10-19 13:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('annotate_application', '0025_medication_al_medication_prefix_idx_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='marker',
+            name='reference_max',
+            field=models.FloatField(blank=True, db_comment='Верхняя граница референсного интервала процента позитивных клеток', null=True, verbose_name='Верхняя граница нормы, %'),
+        ),
+        migrations.AddField(
+            model_name='marker',
+            name='reference_min',
+            field=models.FloatField(blank=True, db_comment='Нижняя граница референсного интервала процента позитивных клеток', null=True, verbose_name='Нижняя граница нормы, %'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 4.2.5 on 2026-10-19 13:19
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('annotate_application', '0026_marker_reference_max_marker_reference_min'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Myelogram',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number_cells', models.IntegerField(db_comment='Сумма клеток объекта исследования в препарате', verbose_name='Количество клеток')),
+                ('records', models.IntegerField(db_comment='Количество записей морфологического исследования', verbose_name='Количество записей')),
+                ('percent', models.FloatField(db_comment='Доля клеток объекта от всех подсчитанных клеток препарата', verbose_name='Доля, %')),
+                ('norm_min', models.FloatField(db_comment='Нижняя граница нормы, разобранная из текста', null=True, verbose_name='Нижняя граница нормы')),
+                ('norm_max', models.FloatField(db_comment='Верхняя граница нормы, разобранная из текста', null=True, verbose_name='Верхняя граница нормы')),
+                ('deviation', models.FloatField(db_comment='Отклонение доли от ближайшей границы нормы, 0 - в норме, пусто - норма не разобрана', null=True, verbose_name='Отклонение от нормы')),
+                ('t_updated', models.DateTimeField(auto_now=True, db_comment='Дата пересчёта строки', verbose_name='дата пересчёта')),
+                ('medication', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='myelogram', to='annotate_application.medication')),
+                ('research_obj', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='myelogram', to='annotate_application.researchedobject')),
+            ],
+            options={
+                'verbose_name': 'миелограмма',
+                'verbose_name_plural': 'миелограммы',
+                'db_table': 'al_myelogram',
+                'db_table_comment': 'миелограмма препарата по объектам исследования',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='myelogram',
+            constraint=models.UniqueConstraint(fields=('medication', 'research_obj'), name='al_myelogram_unique'),
+        ),
+    ]
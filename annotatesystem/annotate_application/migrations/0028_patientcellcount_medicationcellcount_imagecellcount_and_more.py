@@ -0,0 +1,71 @@
+# Generated by Django 4.2.5 on 2026-10-19 13:21
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('annotate_application', '0027_myelogram_myelogram_al_myelogram_unique'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PatientCellCount',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('count', models.IntegerField(db_comment='Количество размеченных клеток типа', default=0, verbose_name='Количество клеток')),
+                ('cell_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='patientcount', to='annotate_application.celltype')),
+                ('patient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='cellcount', to='annotate_application.patient')),
+            ],
+            options={
+                'verbose_name': 'счётчик клеток пациента',
+                'verbose_name_plural': 'счётчики клеток пациентов',
+                'db_table': 'al_patient_cell_count',
+                'db_table_comment': 'количество клеток каждого типа у пациента',
+            },
+        ),
+        migrations.CreateModel(
+            name='MedicationCellCount',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('count', models.IntegerField(db_comment='Количество размеченных клеток типа', default=0, verbose_name='Количество клеток')),
+                ('cell_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='medicationcount', to='annotate_application.celltype')),
+                ('medication', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='cellcount', to='annotate_application.medication')),
+            ],
+            options={
+                'verbose_name': 'счётчик клеток препарата',
+                'verbose_name_plural': 'счётчики клеток препаратов',
+                'db_table': 'al_medication_cell_count',
+                'db_table_comment': 'количество клеток каждого типа в препарате',
+            },
+        ),
+        migrations.CreateModel(
+            name='ImageCellCount',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('count', models.IntegerField(db_comment='Количество размеченных клеток типа', default=0, verbose_name='Количество клеток')),
+                ('cell_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='imagecount', to='annotate_application.celltype')),
+                ('image', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='cellcount', to='annotate_application.cellimage')),
+            ],
+            options={
+                'verbose_name': 'счётчик клеток изображения',
+                'verbose_name_plural': 'счётчики клеток изображений',
+                'db_table': 'al_image_cell_count',
+                'db_table_comment': 'количество клеток каждого типа на изображении',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='patientcellcount',
+            constraint=models.UniqueConstraint(fields=('patient', 'cell_type'), name='al_patient_cell_count_unique'),
+        ),
+        migrations.AddConstraint(
+            model_name='medicationcellcount',
+            constraint=models.UniqueConstraint(fields=('medication', 'cell_type'), name='al_medication_cell_count_unique'),
+        ),
+        migrations.AddConstraint(
+            model_name='imagecellcount',
+            constraint=models.UniqueConstraint(fields=('image', 'cell_type'), name='al_image_cell_count_unique'),
+        ),
+    ]
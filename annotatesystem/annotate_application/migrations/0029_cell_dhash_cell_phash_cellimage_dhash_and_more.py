@@ -0,0 +1,33 @@
+# Generated by Django 4.2.5 on 2026-10-19 13:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('annotate_application', '0028_patientcellcount_medicationcellcount_imagecellcount_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cell',
+            name='dhash',
+            field=models.BigIntegerField(db_comment='dHash изображения для поиска близких дубликатов', editable=False, null=True, verbose_name='Разностный хэш'),
+        ),
+        migrations.AddField(
+            model_name='cell',
+            name='phash',
+            field=models.BigIntegerField(db_comment='pHash изображения для поиска близких дубликатов', editable=False, null=True, verbose_name='Перцептивный хэш'),
+        ),
+        migrations.AddField(
+            model_name='cellimage',
+            name='dhash',
+            field=models.BigIntegerField(db_comment='dHash изображения для поиска близких дубликатов', editable=False, null=True, verbose_name='Разностный хэш'),
+        ),
+        migrations.AddField(
+            model_name='cellimage',
+            name='phash',
+            field=models.BigIntegerField(db_comment='pHash изображения для поиска близких дубликатов', editable=False, null=True, verbose_name='Перцептивный хэш'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.5 on 2026-10-19 13:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('annotate_application', '0029_cell_dhash_cell_phash_cellimage_dhash_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChangeLog',
+            fields=[
+                ('id', models.BigAutoField(db_comment='Порядковый номер изменения', primary_key=True, serialize=False)),
+                ('object_model', models.CharField(db_comment='Модель изменённой записи', max_length=50, verbose_name='Таблица')),
+                ('object_id', models.BigIntegerField(db_comment='Идентификатор изменённой записи', verbose_name='Идентификатор записи')),
+                ('operation', models.CharField(choices=[('I', 'INSERT'), ('U', 'UPDATE'), ('D', 'DELETE'), ('C', 'CLOSE')], db_comment='Операция: I - добавление, U - изменение, D - удаление, C - закрытие версии записи (end_date/t_changed)', max_length=1, verbose_name='Операция')),
+                ('t_cdatetime', models.DateTimeField(auto_now_add=True, db_comment='Время изменения', verbose_name='Время изменения')),
+            ],
+            options={
+                'verbose_name': 'изменение',
+                'verbose_name_plural': 'лента изменений',
+                'db_table': 'al_change_log',
+                'db_table_comment': 'Лента изменений клинических таблиц для синхронизации клиентов',
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.5 on 2026-10-19 13:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('annotate_application', '0030_changelog'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cellimage',
+            name='content_digest',
+            field=models.CharField(db_comment='SHA-256 содержимого файла изображения для пропуска повторной загрузки', db_index=True, editable=False, max_length=64, null=True, verbose_name='Хэш содержимого'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.5 on 2026-10-19 13:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('annotate_application', '0031_cellimage_content_digest'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MediaMove',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('old_name', models.CharField(db_comment='Путь файла относительно MEDIA_ROOT до переноса', max_length=255, unique=True, verbose_name='Прежний путь')),
+                ('new_name', models.CharField(db_comment='Путь файла после переноса', max_length=255, verbose_name='Новый путь')),
+                ('t_cdatetime', models.DateTimeField(auto_now_add=True, db_comment='Время переноса', verbose_name='Время переноса')),
+            ],
+            options={
+                'verbose_name': 'перенос файла',
+                'verbose_name_plural': 'переносы файлов',
+                'db_table': 'al_media_move',
+                'db_table_comment': 'Перенесённые медиафайлы для перенаправления прежних адресов',
+            },
+        ),
+    ]
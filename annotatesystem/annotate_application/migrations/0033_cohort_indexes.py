@@ -0,0 +1,29 @@
+# Generated by Django 4.2.5 on 2026-10-19 13:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('annotate_application', '0032_mediamove'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='immunophenotyping',
+            index=models.Index(fields=['research', 'marker', 'percent_positive_cells'], name='al_immuno_research_marker_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='immunophenotyping',
+            index=models.Index(fields=['marker', 'percent_positive_cells'], name='al_immuno_marker_percent_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='patientcellcount',
+            index=models.Index(fields=['cell_type', 'count'], name='al_patient_cells_type_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='patientresearch',
+            index=models.Index(fields=['patient', 'date_begin'], name='al_research_patient_date_idx'),
+        ),
+    ]
@@ -0,0 +1,53 @@
+from django.db import migrations
+
+# search_vector поддерживается триггером BEFORE INSERT OR UPDATE: вектор обновляется и при
+# bulk_create, QuerySet.update и записи в обход Django, без лишнего UPDATE после каждого сохранения
+SOURCES = {
+    'al_patient': [('last_name', 'A'), ('first_name', 'A'), ('patronymic', 'B')],
+    'al_term': [('term_name', 'A'), ('definition', 'B'), ('description', 'C')],
+    'al_research_result': [('conclusion', 'A')],
+    'al_log': [('action_text', 'A'), ('description', 'B'), ('object_sender', 'C')],
+}
+
+
+def vector_sql(fields, prefix=''):
+    return ' || '.join(f"setweight(to_tsvector('russian', COALESCE({prefix}{field}::text, '')), '{weight}')"
+                       for field, weight in fields)
+
+
+def create_triggers(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for table, fields in SOURCES.items():
+        columns = ', '.join(field for field, weight in fields)
+        schema_editor.execute(f"""
+            CREATE OR REPLACE FUNCTION {table}_search_vector() RETURNS trigger AS $$
+            BEGIN
+                NEW.search_vector := {vector_sql(fields, 'NEW.')};
+                RETURN NEW;
+            END
+            $$ LANGUAGE plpgsql""")
+        schema_editor.execute(f"""
+            CREATE TRIGGER {table}_search_vector_trg BEFORE INSERT OR UPDATE OF {columns} ON {table}
+            FOR EACH ROW EXECUTE FUNCTION {table}_search_vector()""")
+        # строки, записанные массовыми операциями до появления триггера, остались без вектора
+        schema_editor.execute(f"UPDATE {table} SET search_vector = {vector_sql(fields)} WHERE search_vector IS NULL")
+
+
+def drop_triggers(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for table in SOURCES:
+        schema_editor.execute(f"DROP TRIGGER IF EXISTS {table}_search_vector_trg ON {table}")
+        schema_editor.execute(f"DROP FUNCTION IF EXISTS {table}_search_vector()")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('annotate_application', '0033_cohort_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_triggers, drop_triggers),
+    ]
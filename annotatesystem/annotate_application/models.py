@@ -1,21 +1,26 @@
-import datetime
-from django.db import models
+from django.db import models, transaction
+from django.contrib.postgres.indexes import GinIndex, OpClass
+from django.contrib.postgres.search import SearchVectorField
 from django.contrib.auth.models import AbstractBaseUser, PermissionsMixin, UserManager
 from django.db.models import UniqueConstraint
+from django.db.models.functions import Upper
 from django.utils.translation import gettext_lazy as _
 from django.urls import reverse
 from django.core.validators import RegexValidator
 
-from django.db.models.signals import pre_save
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete
 from django.dispatch import receiver
 
+from .caching import bump_model_version, bump_row_version, invalidate_patient_records
+from .media_paths import media_path
+
 
 def image_directory_path(instance, filename):
-    return f"image/{datetime.date.today().year}/{datetime.date.today().month}/{datetime.date.today().day}/{instance.t_md5}-{filename}"
+    return media_path("image", instance, filename)
 
 
 def cell_directory_path(instance, filename):
-    return f"cell/%Y/%m/%d/{instance.t_md5}-{filename}"
+    return media_path("cell", instance, filename)
 
 
 class SCD2ModelMixin:
@@ -118,6 +123,7 @@ class Patient(models.Model):
     patronymic = models.CharField(_("отчество"), max_length=50, null=True, db_comment="Отчество пользователя")
     birthday = models.DateTimeField(_("дата рождения"), db_comment="Дата рождения")
     sex = models.IntegerField(_("пол"), choices=SEX_TYPE, db_comment="Пол 1 - мужской, 0 - женский")
+    search_vector = SearchVectorField(null=True, editable=False)
 
     def __str__(self):
         return f"{self.first_name} {self.last_name}, номер истории болезни: {self.number_ill_history}"
@@ -127,6 +133,14 @@ class Patient(models.Model):
         db_table_comment = "таблица пациентов"
         verbose_name = _("пациент")
         verbose_name_plural = _("пациенты")
+        indexes = [
+            GinIndex(fields=['search_vector'], name='al_patient_search_idx'),
+            GinIndex(fields=['last_name'], opclasses=['gin_trgm_ops'], name='al_patient_last_name_trgm_idx'),
+            GinIndex(fields=['first_name'], opclasses=['gin_trgm_ops'], name='al_patient_first_name_trgm_idx'),
+            models.Index(fields=['number_ill_history'], name='al_patient_ill_history_idx'),
+            # поиск по началу фамилии без учёта регистра (поле автодополнения)
+            models.Index(OpClass(Upper('last_name'), name='text_pattern_ops'), name='al_patient_lname_prefix_idx'),
+        ]
 
 
 class Marker(models.Model):
@@ -138,6 +152,10 @@ class Marker(models.Model):
 
     marker_name = models.CharField(_("название маркера"), max_length=50, db_comment="Название маркера")
     marker_type = models.CharField(_("Тип маркера"), max_length=2, choices=MARKER_TYPES, db_comment="Тип маркера")
+    reference_min = models.FloatField(_("Нижняя граница нормы, %"), null=True, blank=True,
+                                      db_comment="Нижняя граница референсного интервала процента позитивных клеток")
+    reference_max = models.FloatField(_("Верхняя граница нормы, %"), null=True, blank=True,
+                                      db_comment="Верхняя граница референсного интервала процента позитивных клеток")
 
     def __str__(self):
         return self.marker_name
@@ -177,6 +195,7 @@ class Terms(models.Model, SCD2ModelMixin):
     term_name = models.CharField(_("Наименование термина"), max_length=50, db_comment="Наименование термина")
     definition = models.TextField(_("Определение"), db_comment="Определение")
     description = models.TextField(_("Описание"), blank=True, db_comment="Описание")
+    search_vector = SearchVectorField(null=True, editable=False)
 
     def __str__(self):
         return self.term_name
@@ -186,6 +205,9 @@ class Terms(models.Model, SCD2ModelMixin):
         db_table_comment = "таблица терминов и определений"
         verbose_name = _("термин")
         verbose_name_plural = _("термины")
+        indexes = [
+            GinIndex(fields=['search_vector'], name='al_term_search_idx'),
+        ]
 
 
 class DictCellsCharacteristics(models.Model):
@@ -225,6 +247,7 @@ class ResearchResult(models.Model):
     conclusion = models.TextField(_("Заключение"), db_comment="Заключение")
     research = models.ForeignKey("PatientResearch", related_name="researchresult", null=True, on_delete=models.PROTECT)
     patient = models.ForeignKey("Patient", related_name="researchresult", null=True, on_delete=models.PROTECT)
+    search_vector = SearchVectorField(null=True, editable=False)
 
     def __str__(self):
         return self.conclusion
@@ -234,6 +257,9 @@ class ResearchResult(models.Model):
         db_table_comment = "справочник результатов исследования"
         verbose_name = _("результат исследования")
         verbose_name_plural = _("результаты исследования")
+        indexes = [
+            GinIndex(fields=['search_vector'], name='al_research_result_search_idx'),
+        ]
 
 
 class PatientResearch(models.Model):
@@ -250,6 +276,10 @@ class PatientResearch(models.Model):
         db_table_comment = "справочник исследования пациента"
         verbose_name = _("исследование")
         verbose_name_plural = _("исследования")
+        indexes = [
+            # исследования пациента за период (когорты, cohorts.py)
+            models.Index(fields=['patient', 'date_begin'], name='al_research_patient_date_idx'),
+        ]
 
 
 class Medication(models.Model):
@@ -265,6 +295,9 @@ class Medication(models.Model):
         db_table_comment = "справочник препаратов"
         verbose_name = _("препарат")
         verbose_name_plural = _("препараты")
+        indexes = [
+            models.Index(OpClass(Upper('medication_type'), name='text_pattern_ops'), name='al_medication_prefix_idx'),
+        ]
 
 
 class Immunophenotyping(models.Model):
@@ -281,10 +314,40 @@ class Immunophenotyping(models.Model):
         db_table_comment = "справочник иммунофенотипирования"
         verbose_name = _("данные иммунофенотипирования")
         verbose_name_plural = _("данные иммунофенотипирования")
+        indexes = [
+            # условия когорт по маркеру: проверка исследований пациента и отбор по порогу процента
+            models.Index(fields=['research', 'marker', 'percent_positive_cells'], name='al_immuno_research_marker_idx'),
+            models.Index(fields=['marker', 'percent_positive_cells'], name='al_immuno_marker_percent_idx'),
+        ]
+
+
+class CellImageQuerySet(models.QuerySet):
+    # массовая загрузка изображений (команда ingest_images) обновляет ленту изменений, журнал
+    # системы, версию таблицы и карточки пациентов одним набором запросов на пачку, а не через
+    # сигналы по каждой записи
+    def bulk_create(self, objs, *args, **kwargs):
+        from .changes import record_changes
+
+        with transaction.atomic():
+            objs = super().bulk_create(objs, *args, **kwargs)
+            pks = [obj.pk for obj in objs if obj.pk is not None]
+            record_changes(CellImage, pks, ChangeLog.INSERT)
+            # те же записи, что cell_image_save пишет при сохранении одного изображения
+            if SystemParameters.objects.get(parameter_name="LOGGING").t_isactive:
+                SystemLog.objects.bulk_create([SystemLog(object_sender="CellImage",
+                                                         log_type="I",
+                                                         action_text="Сохранение изображения клетки",
+                                                         description=f"Сохранение изображения клетки {obj.image}",
+                                                         al_username="commita_bu",
+                                                         status_type="S"
+                                                         ) for obj in objs])
+        bump_model_version(CellImage)
+        invalidate_patient_records(CellImage, pks)
+        return objs
 
 
 class CellImage(models.Model):
-    image = models.ImageField(upload_to=image_directory_path, blank=True, verbose_name='Фото')
+    image = models.ImageField(upload_to=image_directory_path, blank=True, db_index=True, verbose_name='Фото')
     medication = models.ForeignKey(Medication, related_name="cellimage", on_delete=models.PROTECT)
     patient = models.ForeignKey(Patient, related_name='cellimage', null=True, on_delete=models.PROTECT)
     scale = models.IntegerField(_("Масштаб"), db_comment="Масштаб")
@@ -296,9 +359,17 @@ class CellImage(models.Model):
     t_changed = models.IntegerField(_("Состояние записи"), null=True,
                                     db_comment="Состояние записи 0 - добавлена, 1 - изменена 2 - удалена")
     t_md5 = models.CharField(_("Хэш"), null=True, max_length=32, db_comment="Хэш")
+    phash = models.BigIntegerField(_("Перцептивный хэш"), null=True, editable=False,
+                                   db_comment="pHash изображения для поиска близких дубликатов")
+    dhash = models.BigIntegerField(_("Разностный хэш"), null=True, editable=False,
+                                   db_comment="dHash изображения для поиска близких дубликатов")
+    content_digest = models.CharField(_("Хэш содержимого"), max_length=64, null=True, editable=False, db_index=True,
+                                      db_comment="SHA-256 содержимого файла изображения для пропуска повторной загрузки")
+
+    objects = CellImageQuerySet.as_manager()
 
     def __str__(self):
-        return self.image
+        return self.image.name
 
     class Meta:
         db_table = "al_cell_image"
@@ -345,14 +416,60 @@ class CellMarking(models.Model):
         verbose_name_plural = _("маркировки клеток")
 
 
+class CellQuerySet(models.QuerySet):
+    # массовые операции с клетками обновляют счётчики counters.py и ленту изменений changes.py
+    # одним набором запросов на всю операцию, а не через сигналы по каждой клетке
+    def bulk_create(self, objs, *args, **kwargs):
+        from .changes import record_changes
+        from .counters import count_created_cells
+
+        with transaction.atomic():
+            objs = super().bulk_create(objs, *args, **kwargs)
+            count_created_cells(objs)
+            record_changes(Cell, [obj.pk for obj in objs if obj.pk is not None], ChangeLog.INSERT)
+        return objs
+
+    def delete(self):
+        from .counters import apply_deltas, cell_deltas, suspended_counters
+
+        with transaction.atomic():
+            deltas = cell_deltas(self, -1)
+            with suspended_counters():
+                result = super().delete()
+            apply_deltas(deltas)
+        return result
+
+    def update(self, **kwargs):
+        from .changes import record_changes
+        from .counters import apply_deltas, cell_deltas
+
+        counted = {'marking', 'marking_id', 'cell_type', 'cell_type_id'} & set(kwargs)
+        with transaction.atomic():
+            pks = list(self.values_list('pk', flat=True))
+            if counted:
+                deltas = cell_deltas(Cell.objects.filter(pk__in=pks), -1)
+            rows = super().update(**kwargs)
+            if counted:
+                deltas.update(cell_deltas(Cell.objects.filter(pk__in=pks), 1))
+                apply_deltas(deltas)
+            record_changes(Cell, pks, ChangeLog.UPDATE)
+        return rows
+
+
 class Cell(models.Model):
     marking = models.ForeignKey(CellMarking, related_name="cell", on_delete=models.PROTECT)
-    image = models.ImageField(upload_to=image_directory_path, blank=True, verbose_name='Фото')
+    image = models.ImageField(upload_to=image_directory_path, blank=True, db_index=True, verbose_name='Фото')
     scale = models.IntegerField(_("Масштаб"), db_comment="Масштаб")
     cell_type = models.ForeignKey("CellType",  related_name="cell", on_delete=models.PROTECT)
+    phash = models.BigIntegerField(_("Перцептивный хэш"), null=True, editable=False,
+                                   db_comment="pHash изображения для поиска близких дубликатов")
+    dhash = models.BigIntegerField(_("Разностный хэш"), null=True, editable=False,
+                                   db_comment="dHash изображения для поиска близких дубликатов")
+
+    objects = CellQuerySet.as_manager()
 
     def __str__(self):
-        return self.image
+        return self.image.name
 
     class Meta:
         db_table = "al_cell"
@@ -401,6 +518,32 @@ class MorphologicalResearch(models.Model):
         verbose_name_plural = _("морфологические исследования")
 
 
+class Myelogram(models.Model):
+    # производная таблица: строится по MorphologicalResearch модулем myelogram.py, вручную не редактируется
+    medication = models.ForeignKey(Medication, related_name="myelogram", on_delete=models.CASCADE)
+    research_obj = models.ForeignKey(ResearchedObject, related_name="myelogram", on_delete=models.CASCADE)
+    number_cells = models.IntegerField(_("Количество клеток"), db_comment="Сумма клеток объекта исследования в препарате")
+    records = models.IntegerField(_("Количество записей"), db_comment="Количество записей морфологического исследования")
+    percent = models.FloatField(_("Доля, %"), db_comment="Доля клеток объекта от всех подсчитанных клеток препарата")
+    norm_min = models.FloatField(_("Нижняя граница нормы"), null=True, db_comment="Нижняя граница нормы, разобранная из текста")
+    norm_max = models.FloatField(_("Верхняя граница нормы"), null=True, db_comment="Верхняя граница нормы, разобранная из текста")
+    deviation = models.FloatField(_("Отклонение от нормы"), null=True,
+                                  db_comment="Отклонение доли от ближайшей границы нормы, 0 - в норме, пусто - норма не разобрана")
+    t_updated = models.DateTimeField(_("дата пересчёта"), auto_now=True, db_comment="Дата пересчёта строки")
+
+    def __str__(self):
+        return f"{self.medication_id}: {self.research_obj_id} {self.percent:.1f}%"
+
+    class Meta:
+        db_table = "al_myelogram"
+        db_table_comment = "миелограмма препарата по объектам исследования"
+        verbose_name = _("миелограмма")
+        verbose_name_plural = _("миелограммы")
+        constraints = [
+            UniqueConstraint(fields=['medication', 'research_obj'], name='al_myelogram_unique'),
+        ]
+
+
 class CellType(models.Model):
     type_name = models.CharField(_("Название типа"), max_length=50, db_comment="Название типа")
 
@@ -414,6 +557,67 @@ class CellType(models.Model):
         verbose_name_plural = _("типы клетки")
 
 
+class ImageCellCount(models.Model):
+    # счётчик клеток по типам, поддерживается counters.py при изменении Cell и CellMarking
+    image = models.ForeignKey(CellImage, related_name="cellcount", on_delete=models.CASCADE)
+    cell_type = models.ForeignKey(CellType, related_name="imagecount", on_delete=models.CASCADE)
+    count = models.IntegerField(_("Количество клеток"), default=0, db_comment="Количество размеченных клеток типа")
+
+    def __str__(self):
+        return f"{self.image_id}: {self.cell_type_id} x{self.count}"
+
+    class Meta:
+        db_table = "al_image_cell_count"
+        db_table_comment = "количество клеток каждого типа на изображении"
+        verbose_name = _("счётчик клеток изображения")
+        verbose_name_plural = _("счётчики клеток изображений")
+        constraints = [
+            UniqueConstraint(fields=['image', 'cell_type'], name='al_image_cell_count_unique'),
+        ]
+
+
+class MedicationCellCount(models.Model):
+    # счётчик клеток по типам, поддерживается counters.py при изменении Cell и CellMarking
+    medication = models.ForeignKey(Medication, related_name="cellcount", on_delete=models.CASCADE)
+    cell_type = models.ForeignKey(CellType, related_name="medicationcount", on_delete=models.CASCADE)
+    count = models.IntegerField(_("Количество клеток"), default=0, db_comment="Количество размеченных клеток типа")
+
+    def __str__(self):
+        return f"{self.medication_id}: {self.cell_type_id} x{self.count}"
+
+    class Meta:
+        db_table = "al_medication_cell_count"
+        db_table_comment = "количество клеток каждого типа в препарате"
+        verbose_name = _("счётчик клеток препарата")
+        verbose_name_plural = _("счётчики клеток препаратов")
+        constraints = [
+            UniqueConstraint(fields=['medication', 'cell_type'], name='al_medication_cell_count_unique'),
+        ]
+
+
+class PatientCellCount(models.Model):
+    # счётчик клеток по типам, поддерживается counters.py при изменении Cell и CellMarking
+    patient = models.ForeignKey(Patient, related_name="cellcount", on_delete=models.CASCADE)
+    cell_type = models.ForeignKey(CellType, related_name="patientcount", on_delete=models.CASCADE)
+    count = models.IntegerField(_("Количество клеток"), default=0, db_comment="Количество размеченных клеток типа")
+
+    def __str__(self):
+        return f"{self.patient_id}: {self.cell_type_id} x{self.count}"
+
+    class Meta:
+        db_table = "al_patient_cell_count"
+        db_table_comment = "количество клеток каждого типа у пациента"
+        verbose_name = _("счётчик клеток пациента")
+        verbose_name_plural = _("счётчики клеток пациентов")
+        constraints = [
+            UniqueConstraint(fields=['patient', 'cell_type'], name='al_patient_cell_count_unique'),
+        ]
+        indexes = [
+            # пациенты с не меньшим заданного количеством клеток типа (когорты)
+            models.Index(fields=['cell_type', 'count'], name='al_patient_cells_type_idx'),
+        ]
+
+
 class SystemLog(models.Model):
     LOG_TYPE = [
         ('I', "INFO"),
@@ -432,6 +636,7 @@ class SystemLog(models.Model):
     t_cdatetime = models.DateTimeField(_("Время создания записи"), auto_now_add=True, db_comment="Время создания записи")
     al_username = models.CharField(_("Имя пользователя, инициирующего действие"), db_comment="Имя пользователя, инициирующего действие")
     status_type = models.CharField(_("Статус выполнения"), max_length=1, choices=STATUS_TYPE, db_comment="Статус выполнения")
+    search_vector = SearchVectorField(null=True, editable=False)
 
     def __str__(self):
         return f"{self.object_sender}-({self.log_type}): {self.action_text} {self.t_cdatetime}"
@@ -441,6 +646,58 @@ class SystemLog(models.Model):
         db_table_comment = "Журнал логирования"
         verbose_name = _("Журнал логирования")
         verbose_name_plural = _("Журнал логирования")
+        indexes = [
+            GinIndex(fields=['search_vector'], name='al_log_search_idx'),
+        ]
+
+
+class MediaMove(models.Model):
+    # файлы, перенесённые командой migrate_media_layout: прежние адреса перенаправляются на новые
+    old_name = models.CharField(_("Прежний путь"), max_length=255, unique=True,
+                                db_comment="Путь файла относительно MEDIA_ROOT до переноса")
+    new_name = models.CharField(_("Новый путь"), max_length=255, db_comment="Путь файла после переноса")
+    t_cdatetime = models.DateTimeField(_("Время переноса"), auto_now_add=True, db_comment="Время переноса")
+
+    def __str__(self):
+        return f"{self.old_name} -> {self.new_name}"
+
+    class Meta:
+        db_table = "al_media_move"
+        db_table_comment = "Перенесённые медиафайлы для перенаправления прежних адресов"
+        verbose_name = _("перенос файла")
+        verbose_name_plural = _("переносы файлов")
+
+
+class ChangeLog(models.Model):
+    # порядковый номер изменения - первичный ключ: последовательность монотонно растёт
+    # на всех таблицах сразу и служит токеном ленты изменений для клиентов синхронизации
+    INSERT = 'I'
+    UPDATE = 'U'
+    DELETE = 'D'
+    CLOSE = 'C'
+    OPERATION_TYPE = [
+        (INSERT, "INSERT"),
+        (UPDATE, "UPDATE"),
+        (DELETE, "DELETE"),
+        (CLOSE, "CLOSE")
+    ]
+
+    id = models.BigAutoField(primary_key=True, db_comment="Порядковый номер изменения")
+    object_model = models.CharField(_("Таблица"), max_length=50, db_comment="Модель изменённой записи")
+    object_id = models.BigIntegerField(_("Идентификатор записи"), db_comment="Идентификатор изменённой записи")
+    operation = models.CharField(_("Операция"), max_length=1, choices=OPERATION_TYPE,
+                                 db_comment="Операция: I - добавление, U - изменение, D - удаление, "
+                                            "C - закрытие версии записи (end_date/t_changed)")
+    t_cdatetime = models.DateTimeField(_("Время изменения"), auto_now_add=True, db_comment="Время изменения")
+
+    def __str__(self):
+        return f"{self.id}: {self.operation} {self.object_model} {self.object_id}"
+
+    class Meta:
+        db_table = "al_change_log"
+        db_table_comment = "Лента изменений клинических таблиц для синхронизации клиентов"
+        verbose_name = _("изменение")
+        verbose_name_plural = _("лента изменений")
 
 
 class SystemParameters(models.Model):
@@ -743,3 +1000,46 @@ def user_category_save(sender, instance, *args, **kwargs):
                         status_type="S"
                         )
         log.save()
+
+
+# таблицы, от которых зависят кэши карточек, списков и справочников. Журналы (SystemLog, ChangeLog)
+# и MediaMove в них не входят: приёмник pre_delete/post_delete без отправителя лишает Django
+# быстрого удаления queryset - каждая строка загружалась бы и получала свой ключ в кэше
+CACHED_MODELS = (
+    MEPHIUserCategory, MEPHIUser, Patient, Marker, Marking, Terms, DictCellsCharacteristics, ResearchedObject,
+    ResearchResult, PatientResearch, Medication, Immunophenotyping, CellImage, SystemSettings, CellMarking, Cell,
+    CellCharacteristic, MorphologicalResearch, Myelogram, CellType, ImageCellCount, MedicationCellCount,
+    PatientCellCount, SystemParameters,
+)
+# таблицы, записи которых входят в карточку пациента (caching.PATIENT_RECORD_PATHS)
+PATIENT_RECORD_MODELS = (
+    Patient, PatientResearch, Medication, Immunophenotyping, CellImage, ResearchResult, MorphologicalResearch,
+)
+
+
+def bump_cache_versions(sender, instance, *args, **kwargs):
+    # сбрасываем кэш карточек и списков реестров при любом изменении записей приложения.
+    # Версии меняются после фиксации транзакции: иначе другой процесс успел бы по новой версии
+    # перечитать ещё старые строки и хранить их под ней до следующего изменения
+    pk = instance.pk
+
+    def bump():
+        bump_row_version(sender, pk)
+        bump_model_version(sender)
+
+    transaction.on_commit(bump)
+
+
+def invalidate_patient_record(sender, instance, *args, **kwargs):
+    # до сохранения сбрасывается карточка прежнего пациента записи, после - нового
+    invalidate_patient_records(sender, instance.pk)
+
+
+for cached_model in CACHED_MODELS:
+    post_save.connect(bump_cache_versions, sender=cached_model)
+    post_delete.connect(bump_cache_versions, sender=cached_model)
+
+for record_model in PATIENT_RECORD_MODELS:
+    pre_save.connect(invalidate_patient_record, sender=record_model)
+    post_save.connect(invalidate_patient_record, sender=record_model)
+    pre_delete.connect(invalidate_patient_record, sender=record_model)
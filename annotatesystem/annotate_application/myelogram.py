@@ -0,0 +1,177 @@
+import re
+import threading
+from functools import lru_cache
+
+from django.db import transaction
+from django.db.models import Count, Sum
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from .caching import bump_model_version, get_model_version
+from .models import *
+
+NUMBER = r"(\d+(?:[.,]\d+)?)"
+RANGE_RE = re.compile(rf"^(?:от\s*)?{NUMBER}\s*(?:-|–|—|\.\.\.?|до)\s*{NUMBER}$")
+UPPER_RE = re.compile(rf"^(?:<=?|≤|до|не более|менее)\s*{NUMBER}$")
+LOWER_RE = re.compile(rf"^(?:>=?|≥|от|не менее|более)\s*{NUMBER}$")
+SINGLE_RE = re.compile(rf"^{NUMBER}$")
+# сколько препаратов пересчитывается за один запрос при массовом построении
+BATCH_SIZE = 1000
+
+
+def _number(text):
+    return float(text.replace(",", "."))
+
+
+@lru_cache(maxsize=1024)
+def parse_norm(text):
+    """Текст нормы в интервал (нижняя граница, верхняя граница), отсутствующая граница - None.
+    Понимает "0,5-2", "от 1 до 3", "< 5", "не менее 10", "5 %"; нераспознанный текст - (None, None)"""
+    text = (text or "").strip().lower().rstrip("%").strip()
+    if match := RANGE_RE.match(text):
+        low, high = sorted((_number(match.group(1)), _number(match.group(2))))
+        return low, high
+    if match := UPPER_RE.match(text):
+        return None, _number(match.group(1))
+    if match := LOWER_RE.match(text):
+        return _number(match.group(1)), None
+    if match := SINGLE_RE.match(text):
+        return _number(match.group(1)), _number(match.group(1))
+    return None, None
+
+
+class NormCache:
+    """Разобранные нормы всех объектов исследования; перечитываются при изменении версии таблицы"""
+
+    def __init__(self):
+        self.version = None
+        self.norms = {}
+        self.lock = threading.Lock()
+
+    def get(self):
+        version = get_model_version(ResearchedObject)
+        if version != self.version:
+            with self.lock:
+                if version != self.version:
+                    self.norms = {pk: parse_norm(norm) for pk, norm in ResearchedObject.objects.values_list("pk", "norm")}
+                    self.version = version
+        return self.norms
+
+
+_norms = NormCache()
+
+
+def deviation(percent, low, high):
+    if low is None and high is None:
+        return None
+    if low is not None and percent < low:
+        return percent - low
+    if high is not None and percent > high:
+        return percent - high
+    return 0.0
+
+
+def compute_rows(medication_ids):
+    """Строки миелограммы для набора препаратов: суммы клеток считаются в БД через GROUP BY,
+    в Python остаётся только деление на итог препарата и сравнение с нормой"""
+    morf = MorphologicalResearch.objects.filter(medication_id__in=medication_ids)
+    totals = dict(morf.values("medication_id").annotate(total=Sum("number_cells")).values_list("medication_id", "total"))
+    groups = morf.values("medication_id", "research_obj_id").annotate(
+        cells=Sum("number_cells"), records=Count("pk")).order_by()
+    norms = _norms.get()
+
+    rows = []
+    for group in groups:
+        total = totals.get(group["medication_id"]) or 0
+        percent = group["cells"] * 100 / total if total else 0.0
+        low, high = norms.get(group["research_obj_id"], (None, None))
+        rows.append(Myelogram(medication_id=group["medication_id"], research_obj_id=group["research_obj_id"],
+                              number_cells=group["cells"], records=group["records"], percent=percent,
+                              norm_min=low, norm_max=high, deviation=deviation(percent, low, high)))
+    return rows
+
+
+def refresh_myelograms(medication_ids):
+    """Пересчитывает миелограммы указанных препаратов: старые строки удаляются, новые вставляются пачкой"""
+    medication_ids = list(set(medication_ids))
+    for start in range(0, len(medication_ids), BATCH_SIZE):
+        batch = medication_ids[start:start + BATCH_SIZE]
+        with transaction.atomic():
+            rows = compute_rows(batch)
+            Myelogram.objects.filter(medication_id__in=batch).delete()
+            Myelogram.objects.bulk_create(rows, batch_size=BATCH_SIZE)
+    if medication_ids:
+        bump_model_version(Myelogram)
+
+
+def rebuild_myelograms():
+    refresh_myelograms(MorphologicalResearch.objects.values_list("medication_id", flat=True).distinct())
+    # препараты, у которых не осталось записей морфологического исследования
+    Myelogram.objects.exclude(medication__morfresearch__isnull=False).delete()
+
+
+def summarize(rows):
+    sprouts = {}
+    for row in rows:
+        sprout = sprouts.setdefault(row.research_obj.sprout_type, {
+            "sprout_type": row.research_obj.get_sprout_type_display(), "number_cells": 0, "percent": 0.0, "objects": []})
+        sprout["number_cells"] += row.number_cells
+        sprout["percent"] += row.percent
+        sprout["objects"].append({
+            "research_obj_id": row.research_obj_id,
+            "norm": row.research_obj.norm,
+            "number_cells": row.number_cells,
+            "records": row.records,
+            "percent": row.percent,
+            "norm_min": row.norm_min,
+            "norm_max": row.norm_max,
+            "deviation": row.deviation,
+        })
+    return {
+        "number_cells": sum(sprout["number_cells"] for sprout in sprouts.values()),
+        "sprouts": list(sprouts.values()),
+    }
+
+
+def get_myelograms(medication_ids):
+    """Миелограммы набора препаратов из производной таблицы одним запросом"""
+    by_medication = {medication_id: [] for medication_id in medication_ids}
+    rows = Myelogram.objects.filter(medication_id__in=medication_ids).select_related("research_obj").order_by(
+        "medication_id", "research_obj__sprout_type", "research_obj_id")
+    for row in rows:
+        by_medication[row.medication_id].append(row)
+    return {medication_id: summarize(rows) for medication_id, rows in by_medication.items()}
+
+
+def get_myelogram(medication_id):
+    return get_myelograms([medication_id])[medication_id]
+
+
+@receiver(pre_save, sender=MorphologicalResearch)
+def remember_morf_medication(sender, instance, *args, **kwargs):
+    # при переносе записи в другой препарат пересчитать нужно оба
+    instance._previous_medication_id = None
+    if instance.pk is not None:
+        instance._previous_medication_id = MorphologicalResearch.objects.filter(
+            pk=instance.pk).values_list("medication_id", flat=True).first()
+
+
+@receiver(post_save, sender=MorphologicalResearch)
+@receiver(post_delete, sender=MorphologicalResearch)
+def update_myelogram(sender, instance, *args, **kwargs):
+    medication_ids = {instance.medication_id, getattr(instance, "_previous_medication_id", None)} - {None}
+    refresh_myelograms(medication_ids)
+
+
+@receiver(post_save, sender=ResearchedObject)
+def update_myelogram_norms(sender, instance, created, *args, **kwargs):
+    # текст нормы изменился: границы и отклонения пересчитываются без повторной агрегации клеток
+    if created:
+        return
+    low, high = parse_norm(instance.norm)
+    rows = list(Myelogram.objects.filter(research_obj=instance))
+    for row in rows:
+        row.norm_min, row.norm_max, row.deviation = low, high, deviation(row.percent, low, high)
+    Myelogram.objects.bulk_update(rows, ["norm_min", "norm_max", "deviation"], batch_size=BATCH_SIZE)
+    if rows:
+        bump_model_version(Myelogram)
@@ -0,0 +1,204 @@
+import math
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+import numpy as np
+from PIL import Image, ImageColor, ImageDraw
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .caching import bump_named_version, get_named_version
+from .derivatives import MODERN_FORMATS, PNG, encode
+from .models import *
+
+# прозрачность заливки прямоугольника маркировки; контур рисуется непрозрачным
+FILL_ALPHA = 64
+OUTLINE_WIDTH = 2
+DEFAULT_COLOUR = (255, 0, 0)
+# форматы плиток: PNG для всех клиентов и WebP без потерь для тех, кто его принимает
+TILE_FORMATS = (PNG,) + tuple(fmt for fmt in MODERN_FORMATS if fmt[1] == "WEBP")
+
+
+def overlay_version(image_id):
+    """Версия оверлея изображения: меняется при изменении его маркировок или файла"""
+    return get_named_version(f"overlay:{image_id}")
+
+
+def invalidate_overlay(image_id):
+    # версия меняется после фиксации транзакции: иначе другой процесс отрисовал бы ещё старые
+    # маркировки под новой версией, а плитка по такому адресу кэшируется клиентом навсегда
+    transaction.on_commit(lambda: bump_named_version(f"overlay:{image_id}"))
+
+
+def tile_key(image_id, version, zoom, x, y, fmt=PNG):
+    return f"overlay_tile:{image_id}:{version}:{zoom}:{x}:{y}{fmt[2]}"
+
+
+@lru_cache(maxsize=256)
+def parse_colour(colour):
+    try:
+        return ImageColor.getrgb(f"#{(colour or '').strip().lstrip('#')}")[:3]
+    except ValueError:
+        return DEFAULT_COLOUR
+
+
+def zoom_levels(width, height):
+    """Количество уровней масштаба: на уровне zoom изображение уменьшено в 2 ** zoom раз,
+    последний уровень целиком помещается в одну плитку"""
+    side = max(width, height, 1)
+    return max(math.ceil(math.log2(side / settings.OVERLAY_TILE_SIZE)), 0) + 1
+
+
+def tiles_count(width, height, zoom):
+    size = settings.OVERLAY_TILE_SIZE << zoom
+    return math.ceil(width / size), math.ceil(height / size)
+
+
+def load_overlay(image_id, version):
+    """Размер изображения и прямоугольники его маркировок в виде столбцов NumPy;
+    кэшируется под версией оверлея, чтобы плитки одного изображения не повторяли запросы"""
+    key = f"overlay:{image_id}:{version}"
+    overlay = cache.get(key)
+    if overlay is not None:
+        return overlay
+    image = CellImage.objects.filter(pk=image_id).values_list("image", flat=True).first()
+    if image is None:
+        return None
+    try:
+        with CellImage._meta.get_field("image").storage.open(image) as file, Image.open(file) as picture:
+            width, height = picture.size
+    except (OSError, ValueError, Image.DecompressionBombError):
+        width = height = 0
+
+    rows = list(Marking.objects.filter(cellmarking__image_id=image_id).order_by("pk").values_list(
+        "x1", "y1", "x2", "y2", "colour"))
+    coordinates = np.array([row[:4] for row in rows], dtype=np.int64).reshape(-1, 4)
+    overlay = {
+        "width": width,
+        "height": height,
+        # координаты могут быть заданы в любом порядке углов
+        "left": np.minimum(coordinates[:, 0], coordinates[:, 2]),
+        "top": np.minimum(coordinates[:, 1], coordinates[:, 3]),
+        "right": np.maximum(coordinates[:, 0], coordinates[:, 2]),
+        "bottom": np.maximum(coordinates[:, 1], coordinates[:, 3]),
+        "colours": [parse_colour(row[4]) for row in rows],
+    }
+    cache.set(key, overlay, timeout=settings.CARD_CACHE_TIMEOUT)
+    return overlay
+
+
+@lru_cache(maxsize=4)
+def empty_tile(fmt=PNG):
+    return encode(Image.new("RGBA", (settings.OVERLAY_TILE_SIZE, settings.OVERLAY_TILE_SIZE)), fmt, lossless=True)
+
+
+def render_tile(overlay, zoom, x, y, fmt=PNG):
+    """Плитка с прозрачным фоном в формате fmt: прямоугольники маркировок, пересекающие
+    плитку (x, y) уровня zoom"""
+    size = settings.OVERLAY_TILE_SIZE
+    scale = 1 << zoom
+    left, top = x * size * scale, y * size * scale
+    right, bottom = left + size * scale, top + size * scale
+    # с учётом толщины контура, который выходит за границу прямоугольника
+    margin = OUTLINE_WIDTH * scale
+    visible = np.flatnonzero((overlay["left"] - margin < right) & (overlay["right"] + margin >= left)
+                             & (overlay["top"] - margin < bottom) & (overlay["bottom"] + margin >= top))
+    if not len(visible):
+        return empty_tile(fmt)
+
+    tile = Image.new("RGBA", (size, size))
+    draw = ImageDraw.Draw(tile)
+    boxes = np.stack([(overlay["left"][visible] - left) / scale, (overlay["top"][visible] - top) / scale,
+                      (overlay["right"][visible] - left) / scale, (overlay["bottom"][visible] - top) / scale], axis=1)
+    for index, box in zip(visible.tolist(), boxes.tolist()):
+        colour = overlay["colours"][index]
+        draw.rectangle(box, fill=colour + (FILL_ALPHA,), outline=colour + (255,), width=OUTLINE_WIDTH)
+    return encode(tile, fmt, lossless=True)
+
+
+def get_tile(image_id, version, zoom, x, y, fmt=PNG):
+    """Плитка оверлея из кэша; None - изображения нет или плитка вне его границ"""
+    key = tile_key(image_id, version, zoom, x, y, fmt)
+    tile = cache.get(key)
+    if tile is not None:
+        return tile
+    overlay = load_overlay(image_id, version)
+    if overlay is None:
+        return None
+    columns, rows = tiles_count(overlay["width"], overlay["height"], zoom)
+    if zoom >= zoom_levels(overlay["width"], overlay["height"]) or x >= columns or y >= rows:
+        return None
+    tile = render_tile(overlay, zoom, x, y, fmt)
+    cache.set(key, tile, timeout=settings.CARD_CACHE_TIMEOUT)
+    return tile
+
+
+def get_manifest(image_id):
+    version = overlay_version(image_id)
+    overlay = load_overlay(image_id, version)
+    if overlay is None:
+        return None
+    levels = zoom_levels(overlay["width"], overlay["height"])
+    return {
+        "image_id": image_id,
+        "version": version,
+        "width": overlay["width"],
+        "height": overlay["height"],
+        "tile_size": settings.OVERLAY_TILE_SIZE,
+        "levels": levels,
+        "tiles": [tiles_count(overlay["width"], overlay["height"], zoom) for zoom in range(levels)],
+        "markings": len(overlay["colours"]),
+    }
+
+
+def prerender(image_id, workers=None):
+    """Рисует и кэширует все плитки изображения во всех форматах TILE_FORMATS параллельно:
+    кодирование в Pillow освобождает GIL. Возвращает количество плиток"""
+    version = overlay_version(image_id)
+    overlay = load_overlay(image_id, version)
+    if overlay is None:
+        return 0
+    tiles = []
+    for zoom in range(zoom_levels(overlay["width"], overlay["height"])):
+        columns, rows = tiles_count(overlay["width"], overlay["height"], zoom)
+        tiles.extend((zoom, x, y, fmt) for y in range(rows) for x in range(columns) for fmt in TILE_FORMATS)
+
+    def render(tile):
+        key = tile_key(image_id, version, *tile)
+        if cache.get(key) is None:
+            cache.set(key, render_tile(overlay, *tile), timeout=settings.CARD_CACHE_TIMEOUT)
+        # обращения к кэшу из потоков пула могут открыть соединение с БД (кэш в БД)
+        connection.close()
+
+    with ThreadPoolExecutor(max_workers=workers or settings.OVERLAY_RENDER_WORKERS) as pool:
+        list(pool.map(render, tiles))
+    return len(tiles)
+
+
+@receiver(post_save, sender=CellMarking)
+@receiver(post_delete, sender=CellMarking)
+def invalidate_marking_overlay(sender, instance, *args, **kwargs):
+    invalidate_overlay(instance.image_id)
+    # прежнее изображение перенесённой маркировки запоминает обработчик pre_save в counters.py
+    previous = getattr(instance, "_counted_image_id", None)
+    if previous is not None and previous != instance.image_id:
+        invalidate_overlay(previous)
+
+
+@receiver(post_save, sender=Marking)
+def invalidate_marking_images(sender, instance, created, *args, **kwargs):
+    # изменились координаты или цвет: устаревают оверлеи всех изображений с этой маркировкой
+    if created:
+        return
+    for image_id in CellMarking.objects.filter(marking=instance).values_list("image_id", flat=True):
+        invalidate_overlay(image_id)
+
+
+@receiver(post_save, sender=CellImage)
+def invalidate_image_overlay(sender, instance, created, *args, **kwargs):
+    # новый файл мог изменить размеры изображения
+    if not created:
+        invalidate_overlay(instance.pk)
@@ -0,0 +1,162 @@
+import json
+import struct
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+
+from .caching import get_model_version, get_row_version
+from .models import *
+from .overlays import overlay_version
+
+# Двоичный формат набора маркировок изображения (все числа little-endian):
+#   заголовок, 16 байт: b"AMRK", версия формата (u8), флаги (u8), 2 байта резерва,
+#     количество маркировок (u32), количество клеток (u32);
+#   затем секции в порядке SECTIONS, каждая: код типа (u8), 3 байта резерва, длина (u32) -
+#     количество элементов массива или байт строкового словаря, данные, выравнивание нулями
+#     до 8 байт, чтобы клиент мог читать массив через Int16Array/Int32Array прямо из буфера ответа.
+# Код типа - размер целого со знаком в байтах (1, 2, 4, 8) или 0 для строкового словаря,
+# который хранится как JSON-список в UTF-8. Цвета, комментарии и типы клеток передаются
+# индексами в словарях. Клетки маркировки i - элементы [cell_offsets[i], cell_offsets[i + 1]).
+# С флагом DELTA идентификаторы и x1, y1 хранятся разностью с предыдущей маркировкой,
+# а x2, y2 - шириной и высотой, поэтому для плотных изображений хватает int8/int16.
+MAGIC = b"AMRK"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<4sBBxxII")
+SECTION = struct.Struct("<BxxxI")
+DELTA = 1
+SECTIONS = ("ids", "marking_ids", "x1", "y1", "x2", "y2", "colour", "comment",
+            "cell_offsets", "cell_ids", "cell_type", "colours", "comments", "cell_types")
+DTYPES = {1: "<i1", 2: "<i2", 4: "<i4", 8: "<i8"}
+
+
+def load_markings(image_id):
+    """Маркировки изображения и их клетки двумя запросами values_list, в виде столбцов NumPy"""
+    rows = list(CellMarking.objects.filter(image_id=image_id).order_by("pk").values_list(
+        "pk", "marking_id", "marking__x1", "marking__y1", "marking__x2", "marking__y2", "marking__colour", "comment"))
+    cells = list(Cell.objects.filter(marking__image_id=image_id).order_by("marking_id", "pk").values_list(
+        "marking_id", "pk", "cell_type__type_name"))
+
+    numbers = np.array([row[:6] for row in rows], dtype=np.int64).reshape(-1, 6)
+    colours, colour_index = np.unique(np.array([row[6] for row in rows], dtype=object).astype(str),
+                                      return_inverse=True)
+    comments, comment_index = np.unique(np.array([row[7] for row in rows], dtype=object).astype(str),
+                                        return_inverse=True)
+    cell_markings = np.array([cell[0] for cell in cells], dtype=np.int64)
+    cell_types, cell_type_index = np.unique(np.array([cell[2] for cell in cells], dtype=object).astype(str),
+                                            return_inverse=True)
+    return {
+        "ids": numbers[:, 0],
+        "marking_ids": numbers[:, 1],
+        "x1": numbers[:, 2],
+        "y1": numbers[:, 3],
+        "x2": numbers[:, 4],
+        "y2": numbers[:, 5],
+        "colour": colour_index.reshape(-1),
+        "comment": comment_index.reshape(-1),
+        # клетки отсортированы по маркировке: границы находятся двоичным поиском
+        "cell_offsets": np.searchsorted(cell_markings, numbers[:, 0], side="left").tolist() + [len(cells)],
+        "cell_ids": np.array([cell[1] for cell in cells], dtype=np.int64),
+        "cell_type": cell_type_index.reshape(-1),
+        "colours": colours.tolist(),
+        "comments": comments.tolist(),
+        "cell_types": cell_types.tolist(),
+    }
+
+
+def _deltas(values):
+    return np.diff(values, prepend=0)
+
+
+def _narrowest(values):
+    if not len(values):
+        return 1
+    low, high = int(values.min()), int(values.max())
+    for size in (1, 2, 4):
+        limit = 1 << (size * 8 - 1)
+        if -limit <= low and high < limit:
+            return size
+    return 8
+
+
+def _section(values):
+    if isinstance(values, list) and (not values or isinstance(values[0], str)):
+        data = json.dumps(values, ensure_ascii=False).encode()
+        code, count = 0, len(data)
+    else:
+        values = np.asarray(values, dtype=np.int64)
+        code = _narrowest(values)
+        data, count = values.astype(DTYPES[code]).tobytes(), len(values)
+    return SECTION.pack(code, count) + data + bytes(-len(data) % 8)
+
+
+def encode_markings(markings, delta=True):
+    columns = dict(markings)
+    if delta:
+        columns["x2"] = markings["x2"] - markings["x1"]
+        columns["y2"] = markings["y2"] - markings["y1"]
+        for name in ("ids", "x1", "y1", "cell_ids"):
+            columns[name] = _deltas(markings[name])
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, DELTA if delta else 0, len(markings["ids"]), len(markings["cell_ids"]))
+    return header + b"".join(_section(columns[name]) for name in SECTIONS)
+
+
+def decode_markings(data):
+    """Обратное преобразование encode_markings: для проверки формата и отладки"""
+    magic, version, flags, boxes, cells = HEADER.unpack_from(data)
+    if magic != MAGIC or version != FORMAT_VERSION:
+        raise ValueError("Неизвестный формат набора маркировок")
+    offset, columns = HEADER.size, {}
+    for name in SECTIONS:
+        code, count = SECTION.unpack_from(data, offset)
+        offset += SECTION.size
+        if code:
+            size = count * code
+            columns[name] = np.frombuffer(data, dtype=DTYPES[code], count=count, offset=offset).astype(np.int64)
+        else:
+            size = count
+            columns[name] = json.loads(data[offset:offset + size].decode())
+        offset += size + (-size % 8)
+    if flags & DELTA:
+        for name in ("ids", "x1", "y1", "cell_ids"):
+            columns[name] = np.cumsum(columns[name])
+        columns["x2"] = columns["x2"] + columns["x1"]
+        columns["y2"] = columns["y2"] + columns["y1"]
+    return columns
+
+
+def markings_json(image_id, markings):
+    """Запасной JSON с объектом на каждую маркировку"""
+    offsets = markings["cell_offsets"]
+    return {
+        "image_id": image_id,
+        "markings": [{
+            "id": int(markings["ids"][i]),
+            "marking_id": int(markings["marking_ids"][i]),
+            "x1": int(markings["x1"][i]),
+            "y1": int(markings["y1"][i]),
+            "x2": int(markings["x2"][i]),
+            "y2": int(markings["y2"][i]),
+            "colour": markings["colours"][markings["colour"][i]],
+            "comment": markings["comments"][markings["comment"][i]],
+            "cells": [{"id": int(markings["cell_ids"][j]), "cell_type": markings["cell_types"][markings["cell_type"][j]]}
+                      for j in range(offsets[i], offsets[i + 1])],
+        } for i in range(len(markings["ids"]))],
+    }
+
+
+def payload_version(image_id):
+    # маркировки и комментарии меняют версию оверлея, клетки - версию строки изображения
+    # (обновление счётчиков), переименование типа клетки - версию справочника типов
+    return f"{overlay_version(image_id)}.{get_row_version(CellImage, image_id)}.{get_model_version(CellType)}"
+
+
+def get_markings_payload(image_id, delta=True):
+    """Двоичный набор маркировок изображения из кэша и его версия"""
+    version = payload_version(image_id)
+    key = f"markings_payload:{image_id}:{version}:{int(delta)}"
+    payload = cache.get(key)
+    if payload is None:
+        payload = encode_markings(load_markings(image_id), delta=delta)
+        cache.set(key, payload, timeout=settings.CARD_CACHE_TIMEOUT)
+    return payload, version
@@ -0,0 +1,272 @@
+import os
+import threading
+from functools import lru_cache
+from itertools import combinations
+
+import numpy as np
+from PIL import Image
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from .caching import bump_named_version, get_model_version, get_named_version
+from .models import *
+
+HASH_SIZE = 8
+# размер, к которому приводится изображение перед DCT для pHash
+DCT_SIZE = 32
+# 64-битный хэш делится на 4 части по 16 бит: при расстоянии <= r хотя бы одна часть
+# отличается не больше чем на r // 4 бит (принцип Дирихле), поэтому кандидатов ищем
+# точным совпадением частей с перебором их ближайших соседей
+CHUNKS = 4
+CHUNK_BITS = 64 // CHUNKS
+CHUNK_MASK = np.uint64((1 << CHUNK_BITS) - 1)
+
+
+def _dct_matrix(size):
+    k = np.arange(size)[:, None]
+    n = np.arange(size)[None, :]
+    matrix = np.sqrt(2 / size) * np.cos(np.pi * (2 * n + 1) * k / (2 * size))
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+
+DCT = _dct_matrix(DCT_SIZE)
+
+
+def _bits_to_int(bits):
+    value = 0
+    for bit in bits.ravel():
+        value = (value << 1) | int(bit)
+    return value
+
+
+def to_signed(value):
+    # BigIntegerField знаковый: 64-битный хэш хранится в дополнительном коде
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def to_unsigned(value):
+    return value + (1 << 64) if value < 0 else value
+
+
+def image_hashes(file):
+    """pHash (знаки низкочастотных коэффициентов DCT относительно медианы) и dHash
+    (знаки разностей соседних пикселей) изображения; оба - 64-битные целые"""
+    with Image.open(file) as image:
+        gray = image.convert("L")
+        pixels = np.asarray(gray.resize((DCT_SIZE, DCT_SIZE), Image.Resampling.LANCZOS), dtype=np.float64)
+        small = np.asarray(gray.resize((HASH_SIZE + 1, HASH_SIZE), Image.Resampling.LANCZOS), dtype=np.int16)
+    coefficients = (DCT @ pixels @ DCT.T)[:HASH_SIZE, :HASH_SIZE]
+    median = np.median(coefficients.ravel()[1:])
+    phash = _bits_to_int(coefficients > median)
+    dhash = _bits_to_int(small[:, 1:] > small[:, :-1])
+    return phash, dhash
+
+
+def popcount(values):
+    """Количество единичных бит в каждом элементе массива uint64"""
+    values = values - ((values >> np.uint64(1)) & np.uint64(0x5555555555555555))
+    values = (values & np.uint64(0x3333333333333333)) + ((values >> np.uint64(2)) & np.uint64(0x3333333333333333))
+    values = (values + (values >> np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    return ((values * np.uint64(0x0101010101010101)) >> np.uint64(56)).astype(np.int64)
+
+
+@lru_cache(maxsize=8)
+def _neighbour_masks(radius):
+    masks = [0]
+    for distance in range(1, radius + 1):
+        for bits in combinations(range(CHUNK_BITS), distance):
+            masks.append(sum(1 << bit for bit in bits))
+    return np.array(masks, dtype=np.uint64)
+
+
+class HashIndex:
+    """Мульти-индекс по расстоянию Хэмминга для pHash одной модели (CellImage или Cell).
+    Хранит отсортированные части хэшей в массивах NumPy; снимок сохраняется в файл
+    командой build_image_hash_index, после загрузки добираются только новые записи.
+    Удаление записей и смена хэша у существующих меняют версию changes_name (hashes_changed),
+    и тогда индекс перечитывается целиком"""
+
+    def __init__(self, model):
+        self.model = model
+        self.version = None
+        self.changes = None
+        self.max_pk = 0
+        self.pks = np.empty(0, dtype=np.int64)
+        self.hashes = np.empty(0, dtype=np.uint64)
+        self.dhashes = np.empty(0, dtype=np.uint64)
+        self.chunks = []
+        self.lock = threading.Lock()
+
+    @property
+    def changes_name(self):
+        return f"image_hashes:{self.model._meta.label_lower}"
+
+    @property
+    def path(self):
+        return os.path.join(settings.IMAGE_HASH_INDEX_DIR, f"{self.model._meta.model_name}.npz")
+
+    def _rows(self, queryset):
+        rows = list(queryset.filter(phash__isnull=False).order_by("pk").values_list("pk", "phash", "dhash"))
+        pks = np.array([row[0] for row in rows], dtype=np.int64)
+        hashes = np.array([to_unsigned(row[1]) for row in rows], dtype=np.uint64)
+        dhashes = np.array([to_unsigned(row[2] or 0) for row in rows], dtype=np.uint64)
+        return pks, hashes, dhashes
+
+    def _build_chunks(self):
+        self.chunks = []
+        for chunk in range(CHUNKS):
+            values = (self.hashes >> np.uint64(chunk * CHUNK_BITS)) & CHUNK_MASK
+            order = np.argsort(values, kind="stable")
+            self.chunks.append((values[order], order))
+
+    def _load_snapshot(self):
+        try:
+            with np.load(self.path) as snapshot:
+                self.pks, self.hashes, self.dhashes = snapshot["pks"], snapshot["hashes"], snapshot["dhashes"]
+                self.changes = int(snapshot["changes"])
+        except (OSError, KeyError, ValueError):
+            return
+        self.max_pk = int(self.pks.max()) if len(self.pks) else 0
+
+    def _reload(self):
+        self.pks, self.hashes, self.dhashes = self._rows(self.model.objects.all())
+        self.max_pk = int(self.pks.max()) if len(self.pks) else 0
+        self._build_chunks()
+
+    def refresh(self):
+        version = get_model_version(self.model)
+        if version == self.version:
+            return
+        with self.lock:
+            if version == self.version:
+                return
+            changes = get_named_version(self.changes_name)
+            if self.version is None:
+                self._load_snapshot()
+            if changes != self.changes:
+                # после снимка или прошлой сверки записи удалялись или меняли хэш: новых строк недостаточно
+                self._reload()
+                self.version, self.changes = version, changes
+                return
+            pks, hashes, dhashes = self._rows(self.model.objects.filter(pk__gt=self.max_pk))
+            if len(pks) or not self.chunks:
+                self.pks = np.concatenate([self.pks, pks])
+                self.hashes = np.concatenate([self.hashes, hashes])
+                self.dhashes = np.concatenate([self.dhashes, dhashes])
+                self.max_pk = int(self.pks.max()) if len(self.pks) else 0
+                self._build_chunks()
+            self.version = version
+
+    def rebuild(self):
+        with self.lock:
+            version, changes = get_model_version(self.model), get_named_version(self.changes_name)
+            self._reload()
+            self.version, self.changes = version, changes
+
+    def save(self):
+        os.makedirs(settings.IMAGE_HASH_INDEX_DIR, exist_ok=True)
+        temporary = f"{self.path}.{os.getpid()}.tmp.npz"
+        np.savez(temporary, pks=self.pks, hashes=self.hashes, dhashes=self.dhashes, changes=np.int64(self.changes or 0))
+        os.replace(temporary, self.path)
+
+    def candidates(self, phash, distance):
+        """Позиции записей, у которых хотя бы одна часть хэша близка к части запроса"""
+        masks = _neighbour_masks(distance // CHUNKS)
+        found = []
+        for chunk, (values, order) in enumerate(self.chunks):
+            probes = ((np.uint64(phash) >> np.uint64(chunk * CHUNK_BITS)) & CHUNK_MASK) ^ masks
+            left = np.searchsorted(values, probes, side="left")
+            right = np.searchsorted(values, probes, side="right")
+            hit = right > left
+            if not hit.any():
+                continue
+            lengths = right[hit] - left[hit]
+            offsets = np.repeat(left[hit] - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+            found.append(order[offsets])
+        return np.unique(np.concatenate(found)) if found else np.empty(0, dtype=np.int64)
+
+    def search(self, phash, dhash=None, distance=None, dhash_distance=None, exclude=None):
+        """Близкие дубликаты: [(pk, расстояние pHash)] по возрастанию расстояния"""
+        distance = settings.IMAGE_PHASH_DISTANCE if distance is None else distance
+        dhash_distance = settings.IMAGE_DHASH_DISTANCE if dhash_distance is None else dhash_distance
+        self.refresh()
+        positions = self.candidates(phash, distance)
+        distances = popcount(self.hashes[positions] ^ np.uint64(phash))
+        keep = distances <= distance
+        if dhash is not None:
+            keep &= popcount(self.dhashes[positions] ^ np.uint64(dhash)) <= dhash_distance
+        positions, distances = positions[keep], distances[keep]
+        result = sorted(zip(self.pks[positions].tolist(), distances.tolist()), key=lambda item: (item[1], item[0]))
+        return [(pk, value) for pk, value in result if pk != exclude]
+
+    def add(self, pk, phash, dhash):
+        # новые записи подхватит refresh() по pk > max_pk, а заменённый файл существующей
+        # записи добавляется сразу; старый хэш отсекается проверкой по БД в find_duplicates
+        with self.lock:
+            if self.version is None or pk > self.max_pk:
+                return
+            self.pks = np.append(self.pks, np.int64(pk))
+            self.hashes = np.append(self.hashes, np.uint64(phash))
+            self.dhashes = np.append(self.dhashes, np.uint64(dhash))
+            self.max_pk = max(self.max_pk, pk)
+            self._build_chunks()
+
+
+HASH_INDEXES = {CellImage: HashIndex(CellImage), Cell: HashIndex(Cell)}
+
+
+def hashes_changed(model):
+    """Отмечает не только добавление хэшей (удаление записей, замену файла, досчёт хэшей
+    существующих записей): индексы процессов перечитают таблицу. Версия меняется после фиксации"""
+    transaction.on_commit(lambda: bump_named_version(HASH_INDEXES[model].changes_name))
+
+
+def find_duplicates(model, file, exclude=None):
+    """Ранее сохранённые изображения, близкие к файлу; проверенные по текущим хэшам в БД"""
+    file.seek(0)
+    phash, dhash = image_hashes(file)
+    file.seek(0)
+    found = dict(HASH_INDEXES[model].search(phash, dhash, exclude=exclude))
+    if not found:
+        return []
+    # индекс мог устареть: удалённые записи и заменённые файлы отсекаются по БД
+    current = model.objects.filter(pk__in=found, phash__isnull=False).values_list("pk", "phash")
+    return sorted(pk for pk, value in current
+                  if int(popcount(np.array([to_unsigned(value) ^ phash], dtype=np.uint64))[0])
+                  <= settings.IMAGE_PHASH_DISTANCE)
+
+
+@receiver(pre_save, sender=CellImage)
+@receiver(pre_save, sender=Cell)
+def compute_image_hashes(sender, instance, *args, **kwargs):
+    # хэши считаются при загрузке нового файла, пока он ещё в памяти или во временном файле
+    if not instance.image or getattr(instance.image, "_committed", True):
+        return
+    instance._hashes_replaced = instance.pk is not None
+    try:
+        phash, dhash = image_hashes(instance.image.file)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        instance.phash = instance.dhash = None
+        return
+    finally:
+        instance.image.file.seek(0)
+    instance.phash, instance.dhash = to_signed(phash), to_signed(dhash)
+
+
+@receiver(post_save, sender=CellImage)
+@receiver(post_save, sender=Cell)
+def index_image_hashes(sender, instance, created, *args, **kwargs):
+    if not created and getattr(instance, "_hashes_replaced", False):
+        hashes_changed(sender)
+    if instance.phash is not None:
+        HASH_INDEXES[sender].add(instance.pk, to_unsigned(instance.phash), to_unsigned(instance.dhash or 0))
+
+
+@receiver(post_delete, sender=CellImage)
+@receiver(post_delete, sender=Cell)
+def forget_image_hashes(sender, instance, *args, **kwargs):
+    if instance.phash is not None:
+        hashes_changed(sender)
@@ -0,0 +1,300 @@
+import hashlib
+import io
+import json
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+from django.conf import settings
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+
+from .caching import get_row_version
+from .derivatives import PNG, encode
+from .models import *
+
+# Кэш растров: каждое изображение декодируется один раз и хранится несжатым в каталоге
+# RASTER_CACHE_DIR/<id изображения>/<хэш имени файла>/: meta.json с размерами уровней и файлы
+# level<N>.npy - массивы (ряды плиток, столбцы плиток, сторона, сторона, каналы) uint8, которые
+# открываются через numpy.memmap. Плитка лежит в файле непрерывно, поэтому чтение области
+# затрагивает только страницы её плиток. На уровне N изображение уменьшено в 2 ** N раз,
+# последний уровень целиком помещается в одну плитку (как у плиток оверлея).
+META = "meta.json"
+# время последнего обращения (mtime meta.json) обновляется не чаще раза в час
+TOUCH_INTERVAL = 60 * 60
+# после очистки кэш занимает не больше этой доли RASTER_CACHE_BYTES
+EVICT_TO = 0.9
+# открытые растры процесса: сколько изображений держать открытыми одновременно
+OPEN_RASTERS = 64
+
+
+class RasterUnavailable(Exception):
+    """У изображения нет файла или файл не декодируется"""
+
+
+class RegionTooLarge(ValueError):
+    """Запрошенная область больше RASTER_MAX_REGION_PIXELS"""
+
+
+def raster_dir(image_id, name):
+    # файл изображения не перезаписывается: новое имя - новый каталог, старый удаляется при сборке
+    return os.path.join(settings.RASTER_CACHE_DIR, str(image_id), hashlib.sha1(name.encode()).hexdigest()[:16])
+
+
+def to_tiles(pixels, tile_size):
+    """Массив (высота, ширина, каналы), дополненный нулями до целого числа плиток и
+    переставленный так, что каждая плитка лежит в памяти непрерывно"""
+    height, width, channels = pixels.shape
+    rows, columns = -(-height // tile_size), -(-width // tile_size)
+    padded = np.zeros((rows * tile_size, columns * tile_size, channels), dtype=np.uint8)
+    padded[:height, :width] = pixels
+    return padded.reshape(rows, tile_size, columns, tile_size, channels).swapaxes(1, 2)
+
+
+def normalize_mode(picture):
+    # палитровые, CMYK, 16-битные и прочие режимы приводятся к RGB(A) или L: иначе в массив
+    # попали бы индексы палитры, а reduce() не работает с режимом "P"
+    if picture.mode not in ("RGB", "RGBA", "L"):
+        picture = picture.convert("RGBA" if "A" in picture.getbands() or "transparency" in picture.info else "RGB")
+    return picture
+
+
+def check_region_size(width, height):
+    # ограничивается область после обрезки по границам: запрос с запасом (например, всё
+    # изображение на уровне N) допустим, если реально копируемая часть не слишком велика
+    if width * height > settings.RASTER_MAX_REGION_PIXELS:
+        raise RegionTooLarge(f"Область больше {settings.RASTER_MAX_REGION_PIXELS} пикселей")
+
+
+def build_raster(image_id, name):
+    """Декодирует файл изображения и записывает все уровни. Каталог собирается во временном
+    и переименовывается, поэтому другие процессы не видят растр частично"""
+    target = raster_dir(image_id, name)
+    temporary = f"{target}.{os.getpid()}.{threading.get_ident()}.tmp"
+    tile_size = settings.RASTER_TILE_SIZE
+    try:
+        with CellImage._meta.get_field("image").storage.open(name) as file, Image.open(file) as picture:
+            picture = normalize_mode(picture)
+            picture.load()
+            os.makedirs(temporary, exist_ok=True)
+            levels = []
+            while True:
+                pixels = np.asarray(picture).reshape(picture.height, picture.width, -1)
+                tiles = to_tiles(pixels, tile_size)
+                array = np.lib.format.open_memmap(os.path.join(temporary, f"level{len(levels)}.npy"), mode="w+",
+                                                  dtype=np.uint8, shape=tiles.shape)
+                array[:] = tiles
+                array.flush()
+                del array
+                levels.append([picture.width, picture.height])
+                if max(picture.size) <= tile_size:
+                    break
+                picture = picture.reduce(2)
+    except (OSError, ValueError, Image.DecompressionBombError) as error:
+        shutil.rmtree(temporary, ignore_errors=True)
+        raise RasterUnavailable(image_id) from error
+    with open(os.path.join(temporary, META), "w") as file:
+        json.dump({"image_id": image_id, "name": name, "tile_size": tile_size, "channels": pixels.shape[2],
+                   "levels": levels}, file)
+    try:
+        os.rename(temporary, target)
+    except OSError:
+        # растр уже собран параллельным процессом
+        shutil.rmtree(temporary, ignore_errors=True)
+    # растры прежних файлов этого изображения больше не понадобятся
+    for entry in os.scandir(os.path.dirname(target)):
+        if entry.path != target and not entry.name.endswith(".tmp"):
+            shutil.rmtree(entry.path, ignore_errors=True)
+    return target
+
+
+class Raster:
+    """Открытый растр изображения: уровни открываются через numpy.memmap при первом обращении"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META)) as file:
+            meta = json.load(file)
+        self.tile_size = meta["tile_size"]
+        self.channels = meta["channels"]
+        self.levels = [tuple(size) for size in meta["levels"]]
+        self.arrays = {}
+
+    def level(self, level):
+        array = self.arrays.get(level)
+        if array is None:
+            array = self.arrays[level] = np.load(os.path.join(self.path, f"level{level}.npy"), mmap_mode="r")
+        return array
+
+    def touch(self):
+        """Отмечает обращение к растру; False - растр удалён очисткой в другом процессе"""
+        meta = os.path.join(self.path, META)
+        now = time.time()
+        try:
+            if now - os.stat(meta).st_mtime > TOUCH_INTERVAL:
+                os.utime(meta, (now, now))
+        except OSError:
+            return False
+        return True
+
+    def region(self, x, y, width, height, level=0):
+        """Область уровня level в его координатах, обрезанная по границам изображения.
+        Область внутри одной плитки возвращается представлением memmap без копирования,
+        иначе копируются только пересекающиеся с ней части плиток"""
+        if not 0 <= level < len(self.levels):
+            raise ValueError(f"Уровень {level} вне диапазона 0..{len(self.levels) - 1}")
+        if width < 0 or height < 0:
+            raise ValueError("Ширина и высота области не могут быть отрицательными")
+        level_width, level_height = self.levels[level]
+        left, top = max(x, 0), max(y, 0)
+        right, bottom = min(x + width, level_width), min(y + height, level_height)
+        if right <= left or bottom <= top:
+            return np.empty((0, 0, self.channels), dtype=np.uint8)
+        check_region_size(right - left, bottom - top)
+
+        tiles, size = self.level(level), self.tile_size
+        first_column, first_row = left // size, top // size
+        last_column, last_row = (right - 1) // size, (bottom - 1) // size
+        if first_column == last_column and first_row == last_row:
+            tile_left, tile_top = first_column * size, first_row * size
+            return tiles[first_row, first_column, top - tile_top:bottom - tile_top, left - tile_left:right - tile_left]
+
+        region = np.empty((bottom - top, right - left, self.channels), dtype=np.uint8)
+        for row in range(first_row, last_row + 1):
+            tile_top = row * size
+            y1, y2 = max(top, tile_top), min(bottom, tile_top + size)
+            for column in range(first_column, last_column + 1):
+                tile_left = column * size
+                x1, x2 = max(left, tile_left), min(right, tile_left + size)
+                region[y1 - top:y2 - top, x1 - left:x2 - left] = \
+                    tiles[row, column, y1 - tile_top:y2 - tile_top, x1 - tile_left:x2 - tile_left]
+        return region
+
+
+class RasterCache:
+    """Растры, открытые процессом, с проверкой по версии строки изображения: новый файл
+    у изображения меняет версию, и растр открывается заново"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.opened = OrderedDict()
+
+    def get(self, image_id):
+        version = get_row_version(CellImage, image_id)
+        with self.lock:
+            entry = self.opened.get(image_id)
+            if entry is not None and entry[0] == version and entry[1].touch():
+                self.opened.move_to_end(image_id)
+                return entry[1]
+        name = CellImage.objects.filter(pk=image_id).values_list("image", flat=True).first()
+        if not name:
+            raise RasterUnavailable(image_id)
+        path = raster_dir(image_id, name)
+        built = False
+        if not os.path.isfile(os.path.join(path, META)):
+            build_raster(image_id, name)
+            built = True
+        raster = Raster(path)
+        raster.touch()
+        with self.lock:
+            self.opened[image_id] = (version, raster)
+            self.opened.move_to_end(image_id)
+            while len(self.opened) > OPEN_RASTERS:
+                self.opened.popitem(last=False)
+        if built:
+            evict(keep=path)
+        return raster
+
+    def forget(self, image_id):
+        with self.lock:
+            self.opened.pop(image_id, None)
+
+
+rasters = RasterCache()
+
+
+def read_region(image_id, x, y, width, height, level=0):
+    """Область изображения (x, y, ширина, высота в координатах уровня level) массивом
+    (высота, ширина, каналы) uint8, не больше RASTER_MAX_REGION_PIXELS. При первом обращении
+    изображение декодируется в кэш растров, если он включён (RASTER_CACHE_ENABLED), иначе
+    декодируется целиком каждый раз"""
+    if settings.RASTER_CACHE_ENABLED:
+        return rasters.get(image_id).region(x, y, width, height, level)
+    name = CellImage.objects.filter(pk=image_id).values_list("image", flat=True).first()
+    if not name:
+        raise RasterUnavailable(image_id)
+    try:
+        with CellImage._meta.get_field("image").storage.open(name) as file, Image.open(file) as picture:
+            picture = normalize_mode(picture)
+            for _ in range(level):
+                picture = picture.reduce(2)
+            box = (max(x, 0), max(y, 0), min(x + width, picture.width), min(y + height, picture.height))
+            if box[2] <= box[0] or box[3] <= box[1]:
+                return np.empty((0, 0, len(picture.getbands())), dtype=np.uint8)
+            check_region_size(box[2] - box[0], box[3] - box[1])
+            region = picture.crop(box)
+            return np.asarray(region).reshape(region.height, region.width, -1)
+    except RegionTooLarge:
+        raise
+    except (OSError, ValueError, Image.DecompressionBombError) as error:
+        raise RasterUnavailable(image_id) from error
+
+
+def encode_region(region, fmt="png"):
+    """Область для передачи по HTTP: PNG или .npy, который читает numpy.load; тип содержимого"""
+    if fmt == "npy":
+        buffer = io.BytesIO()
+        np.save(buffer, np.ascontiguousarray(region))
+        return buffer.getvalue(), "application/octet-stream"
+    return encode(Image.fromarray(region[:, :, 0] if region.shape[2] == 1 else region), PNG), PNG[0]
+
+
+def cache_size():
+    total = 0
+    for directory, _, names in os.walk(settings.RASTER_CACHE_DIR):
+        for name in names:
+            try:
+                total += os.stat(os.path.join(directory, name)).st_size
+            except FileNotFoundError:
+                continue
+    return total
+
+
+def evict(keep=None):
+    """Удаляет растры с самым давним обращением, пока кэш больше EVICT_TO от RASTER_CACHE_BYTES;
+    keep - только что собранный растр. Возвращает количество удалённых растров"""
+    entries = []
+    for image_entry in os.scandir(settings.RASTER_CACHE_DIR) if os.path.isdir(settings.RASTER_CACHE_DIR) else ():
+        for entry in os.scandir(image_entry.path) if image_entry.is_dir() else ():
+            if entry.name.endswith(".tmp"):
+                continue
+            try:
+                accessed = os.stat(os.path.join(entry.path, META)).st_mtime
+                size = sum(file.stat().st_size for file in os.scandir(entry.path))
+            except FileNotFoundError:
+                continue
+            entries.append((accessed, size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    if total > settings.RASTER_CACHE_BYTES:
+        limit = settings.RASTER_CACHE_BYTES * EVICT_TO
+        for _, size, path in sorted(entries):
+            if total <= limit:
+                break
+            if path == keep:
+                continue
+            # открытые другими процессами отображения остаются читаемыми до закрытия
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            removed += 1
+    return removed
+
+
+@receiver(post_delete, sender=CellImage)
+def remove_raster(sender, instance, *args, **kwargs):
+    rasters.forget(instance.pk)
+    shutil.rmtree(os.path.join(settings.RASTER_CACHE_DIR, str(instance.pk)), ignore_errors=True)
@@ -0,0 +1,94 @@
+from django.core.cache import cache
+from django.db.models import Prefetch
+from django.shortcuts import get_object_or_404
+from django.urls import reverse
+
+from .caching import get_models_version, patient_record_key
+from .models import *
+
+# справочники, значения которых выводятся в карточке пациента: их изменение
+# не сбрасывает карточки поштучно, а учитывается через версию таблиц
+RECORD_REFERENCE_MODELS = (Marker, MEPHIUser, ResearchedObject)
+
+
+def load_patient(patient_id):
+    """Загружает пациента со всеми исследованиями, препаратами, изображениями, иммунофенотипированием,
+    морфологией и заключениями за фиксированное число запросов (8) независимо от объёма данных"""
+    queryset = Patient.objects.prefetch_related(
+        Prefetch('research', queryset=PatientResearch.objects.select_related('researcher').order_by('date_begin')),
+        Prefetch('research__medication', queryset=Medication.objects.order_by('pk')),
+        Prefetch('research__medication__cellimage', queryset=CellImage.objects.order_by('pk')),
+        Prefetch('research__medication__morfresearch',
+                 queryset=MorphologicalResearch.objects.select_related('research_obj').order_by('pk')),
+        Prefetch('research__immunophenotyping',
+                 queryset=Immunophenotyping.objects.select_related('marker').order_by('pk')),
+        Prefetch('research__researchresult', queryset=ResearchResult.objects.order_by('pk')),
+        Prefetch('researchresult', queryset=ResearchResult.objects.filter(research__isnull=True).order_by('pk'),
+                 to_attr='unattached_results'),
+    )
+    return get_object_or_404(queryset, pk=patient_id)
+
+
+def serialize_patient(patient):
+    return {
+        'id': patient.pk,
+        'number_ill_history': patient.number_ill_history,
+        'first_name': patient.first_name,
+        'last_name': patient.last_name,
+        'patronymic': patient.patronymic,
+        'birthday': patient.birthday,
+        'sex': patient.get_sex_display(),
+        'researches': [{
+            'id': research.pk,
+            'date_begin': research.date_begin,
+            'date_end': research.date_end,
+            'researcher': str(research.researcher),
+            'medications': [{
+                'id': medication.pk,
+                'medication_type': medication.medication_type,
+                'images': [{
+                    'id': image.pk,
+                    'url': image.image.url if image.image else None,
+                    'preview_url': reverse('image_derivative', args=('preview', image.image.name)) if image.image else None,
+                    'scale': image.scale,
+                } for image in medication.cellimage.all()],
+                'morphological': [{
+                    'id': morf.pk,
+                    'sprout_type': morf.research_obj.get_sprout_type_display(),
+                    'norm': morf.research_obj.norm,
+                    'number_cells': morf.number_cells,
+                    'leukocyte': morf.leukocyte,
+                    'research_type': morf.get_research_type_display(),
+                    'value': morf.value,
+                    'description': morf.description,
+                } for morf in medication.morfresearch.all()],
+            } for medication in research.medication.all()],
+            'immunophenotyping': [{
+                'id': immuno.pk,
+                'marker': immuno.marker.marker_name,
+                'medication_id': immuno.medication_id,
+                'percent_positive_cells': immuno.percent_positive_cells,
+            } for immuno in research.immunophenotyping.all()],
+            'results': [{
+                'id': result.pk,
+                'conclusion': result.conclusion,
+            } for result in research.researchresult.all()],
+        } for research in patient.research.all()],
+        'results': [{
+            'id': result.pk,
+            'conclusion': result.conclusion,
+        } for result in patient.unattached_results],
+    }
+
+
+def get_patient_record(patient_id):
+    """Карточка пациента из кэша; запись сбрасывается сигналами при изменении любой дочерней записи"""
+    reference_version = get_models_version(*RECORD_REFERENCE_MODELS)
+    cached = cache.get(patient_record_key(patient_id))
+    if cached is not None and cached[0] == reference_version:
+        return cached[1]
+
+    record = serialize_patient(load_patient(patient_id))
+    cache.set(patient_record_key(patient_id), (reference_version, record), timeout=None)
+
+    return record
@@ -0,0 +1,166 @@
+import threading
+import time
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.signals import request_started
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.forms import ModelChoiceField
+from django.forms.models import ModelChoiceIterator, ModelChoiceIteratorValue
+
+from .caching import get_model_version, get_model_versions
+from .models import *
+from .search import as_number
+
+# небольшие редко меняющиеся справочники, которые держатся в памяти процесса
+REFERENCE_MODELS = (CellType, Marker, DictCellsCharacteristics, Terms, MEPHIUserCategory, ResearchedObject)
+
+
+class ReferenceTable:
+    """Справочник в памяти процесса: строки - именованные кортежи, подписи - результат __str__.
+    Загружается при первом обращении и перечитывается целиком, когда меняется версия таблицы"""
+
+    def __init__(self, model):
+        self.model = model
+        self.fields = [field.attname for field in model._meta.concrete_fields if field.name != "search_vector"]
+        self.row_class = namedtuple(f"{model.__name__}Row", self.fields)
+        self.version = None
+        self.checked = 0.0
+        # строки, индекс по первичному ключу и подписи заменяются одним присваиванием,
+        # поэтому параллельные потоки видят либо старый, либо новый набор целиком
+        self.data = ((), {}, {})
+        self.lock = threading.Lock()
+
+    def load(self, version):
+        rows = tuple(self.row_class(*values) for values in self.model.objects.order_by(
+            *(self.model._meta.ordering or ["pk"])).values_list(*self.fields))
+        by_pk = {row.id: row for row in rows}
+        labels = {row.id: str(self.build(row)) for row in rows}
+        self.data = (rows, by_pk, labels)
+        self.version = version
+
+    def sync(self, version):
+        """Перечитывает таблицу, если её версия отличается от загруженной"""
+        self.checked = time.monotonic()
+        if version == self.version:
+            return
+        with self.lock:
+            if version != self.version:
+                self.load(version)
+
+    def ensure(self):
+        # версия сверяется в начале каждого запроса (sync_reference_tables); вне запросов -
+        # в командах и фоновых потоках - не реже раза в REFERENCE_CACHE_CHECK_SECONDS
+        if self.version is None or time.monotonic() - self.checked > settings.REFERENCE_CACHE_CHECK_SECONDS:
+            self.sync(get_model_version(self.model))
+        return self.data
+
+    def invalidate(self):
+        self.version = None
+
+    def build(self, row):
+        return self.model.from_db(DEFAULT_DB_ALIAS, self.fields, row)
+
+    def rows(self):
+        return self.ensure()[0]
+
+    def get(self, pk):
+        return self.ensure()[1].get(pk)
+
+    def label(self, pk):
+        return self.ensure()[2].get(pk, "")
+
+    def instance(self, pk):
+        """Экземпляр модели из строки в памяти, None - записи нет"""
+        row = self.get(pk)
+        return self.build(row) if row is not None else None
+
+    def choices(self):
+        rows, by_pk, labels = self.ensure()
+        return [(row.id, labels[row.id]) for row in rows]
+
+
+REFERENCE_TABLES = {model: ReferenceTable(model) for model in REFERENCE_MODELS}
+
+
+def reference(model):
+    return REFERENCE_TABLES[model]
+
+
+def warm_reference_cache():
+    """Загружает все справочники при старте процесса (wsgi.py, asgi.py)"""
+    try:
+        for model, version in get_model_versions(REFERENCE_MODELS).items():
+            REFERENCE_TABLES[model].sync(version)
+    except DatabaseError:
+        # база ещё не создана или недоступна: справочники загрузятся при первом обращении
+        pass
+
+
+@receiver(request_started)
+def sync_reference_tables(sender, **kwargs):
+    # версии всех загруженных справочников сверяются одним обращением к кэшу на запрос
+    loaded = [model for model, table in REFERENCE_TABLES.items() if table.version is not None]
+    if loaded:
+        for model, version in get_model_versions(loaded).items():
+            REFERENCE_TABLES[model].sync(version)
+
+
+def invalidate_reference_table(sender, *args, **kwargs):
+    # изменение в этом процессе видно после фиксации транзакции, в остальных - по версии таблицы,
+    # которая тоже меняется после фиксации (models.bump_cache_versions): до неё перечитанная
+    # таблица содержала бы ещё старые строки. При откате справочник не перечитывается
+    transaction.on_commit(REFERENCE_TABLES[sender].invalidate)
+
+
+for reference_model in REFERENCE_MODELS:
+    post_save.connect(invalidate_reference_table, sender=reference_model)
+    post_delete.connect(invalidate_reference_table, sender=reference_model)
+
+
+def parse_pk(value):
+    """Идентификатор из JSON или формы: целое число или строка из цифр;
+    дробные, логические и прочие значения - None"""
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    if isinstance(value, str):
+        return as_number(value)
+    return None
+
+
+class ReferenceChoiceIterator(ModelChoiceIterator):
+    def __iter__(self):
+        if self.field.empty_label is not None:
+            yield ("", self.field.empty_label)
+        table = self.field.table
+        for pk, label in table.choices():
+            yield ModelChoiceIteratorValue(pk, table.instance(pk)), label
+
+    def __len__(self):
+        return len(self.field.table.rows()) + (1 if self.field.empty_label is not None else 0)
+
+    def __bool__(self):
+        return self.field.empty_label is not None or bool(self.field.table.rows())
+
+
+class ReferenceChoiceField(ModelChoiceField):
+    """Поле выбора записи справочника: варианты, подписи и проверка значения берутся из памяти"""
+    iterator = ReferenceChoiceIterator
+
+    def __init__(self, queryset, **kwargs):
+        self.table = reference(queryset.model)
+        super().__init__(queryset, **kwargs)
+
+    def to_python(self, value):
+        if value in self.empty_values:
+            return None
+        if isinstance(value, self.queryset.model):
+            value = value.pk
+        pk = parse_pk(value)
+        obj = None if pk is None else self.table.instance(pk)
+        if obj is None:
+            raise ValidationError(self.error_messages["invalid_choice"], code="invalid_choice", params={"value": value})
+        return obj
@@ -0,0 +1,162 @@
+import itertools
+import random
+import time
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.urls import Resolver404, resolve
+
+from .caching import get_model_version
+
+PIN_COOKIE_NAME = "primary_pin"
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+
+
+class RoutingState:
+    # состояние маршрутизации текущего запроса. Объект изменяемый, поэтому отметка о записи,
+    # сделанной в потоке sync_to_async, видна middleware асинхронного запроса
+    def __init__(self, replica=False):
+        self.replica = replica
+        self.wrote = False
+
+
+_state = ContextVar("replica_routing_state", default=None)
+
+
+def replica_read(view):
+    """Помечает функцию-представление как читающую из реплики (для классов - атрибут read_replica)"""
+    view.read_replica = True
+    return view
+
+
+class read_from_replica:
+    """Контекстный менеджер для чтения из реплики вне запроса: выгрузки, отчёты, команды"""
+
+    def __init__(self, replica=True):
+        self.replica = replica
+
+    def __enter__(self):
+        self.token = _state.set(RoutingState(replica=self.replica))
+        return self
+
+    def __exit__(self, *exc_info):
+        _state.reset(self.token)
+
+
+def reads_from_replica():
+    """Направлено ли чтение текущего запроса в реплику"""
+    state = _state.get()
+    return state is not None and state.replica
+
+
+def _read_chunk(iterator, replica, chunk_size):
+    with read_from_replica(replica):
+        return list(itertools.islice(iterator, chunk_size))
+
+
+def iter_routed(iterator, replica, chunk_size):
+    """Потоковый ответ: части итератора читаются с маршрутизацией запроса, создавшего ответ.
+    Ответ потребляется уже после выхода из ReplicaRoutingMiddleware, поэтому состояние
+    устанавливается на время чтения каждой части, а не на всё время перебора"""
+    while chunk := _read_chunk(iterator, replica, chunk_size):
+        yield from chunk
+
+
+async def aiter_routed(iterator, replica, chunk_size):
+    # то же под ASGI: синхронный итератор StreamingHttpResponse был бы целиком собран в список
+    # перед отправкой. Части читаются в одном потоке (thread_sensitive), где открыт курсор
+    read_chunk = sync_to_async(_read_chunk)
+    while chunk := await read_chunk(iterator, replica, chunk_size):
+        for item in chunk:
+            yield item
+
+
+class ReplicaRouter:
+    """Чтение в помеченных представлениях идёт в одну из DATABASE_REPLICAS, запись и всё
+    остальное, включая сессии и служебные таблицы Django, - в default. Таблица читается из основной базы, пока с её последнего изменения
+    не прошло REPLICA_MAX_LAG_SECONDS: иначе реплика с задержкой вернула бы данные старее
+    версии таблицы, и они попали бы в кэш фрагментов под новой версией"""
+
+    def db_for_read(self, model, **hints):
+        state = _state.get()
+        if state is None or not state.replica or not settings.DATABASE_REPLICAS:
+            return DEFAULT_DB_ALIAS
+        if model._meta.app_label != "annotate_application":
+            return DEFAULT_DB_ALIAS
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        if time.time_ns() - get_model_version(model) < settings.REPLICA_MAX_LAG_SECONDS * 10 ** 9:
+            return DEFAULT_DB_ALIAS
+        return random.choice(settings.DATABASE_REPLICAS)
+
+    def db_for_write(self, model, **hints):
+        state = _state.get()
+        if state is not None:
+            state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # реплики содержат те же данные, что и основная база
+        return True
+
+
+class ReplicaRoutingMiddleware:
+    """Включает чтение из реплики для GET-запросов к помеченным представлениям. После запроса
+    с записью клиент получает cookie, и в течение REPLICA_PIN_SECONDS все его запросы читают
+    из основной базы (чтение собственных изменений)"""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        state = RoutingState(replica=self.use_replica(request))
+        token = _state.set(state)
+        try:
+            response = self.get_response(request)
+            self.pin(state, response)
+        finally:
+            _state.reset(token)
+
+        return response
+
+    async def __acall__(self, request):
+        state = RoutingState(replica=self.use_replica(request))
+        token = _state.set(state)
+        try:
+            response = await self.get_response(request)
+            self.pin(state, response)
+        finally:
+            _state.reset(token)
+
+        return response
+
+    @staticmethod
+    def use_replica(request):
+        if not settings.DATABASE_REPLICAS or request.method not in SAFE_METHODS:
+            return False
+        try:
+            pinned_until = float(request.COOKIES.get(PIN_COOKIE_NAME, 0))
+        except ValueError:
+            pinned_until = 0
+        if pinned_until > time.time():
+            return False
+        try:
+            match = resolve(request.path_info)
+        except Resolver404:
+            return False
+        view_class = getattr(match.func, "view_class", None)
+        return bool(getattr(view_class, "read_replica", False) or getattr(match.func, "read_replica", False))
+
+    @staticmethod
+    def pin(state, response):
+        if state.wrote and settings.DATABASE_REPLICAS:
+            response.set_cookie(PIN_COOKIE_NAME, str(time.time() + settings.REPLICA_PIN_SECONDS),
+                                max_age=settings.REPLICA_PIN_SECONDS, httponly=True, samesite="Lax")
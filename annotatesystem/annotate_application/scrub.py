@@ -0,0 +1,118 @@
+import hashlib
+import heapq
+import mmap
+import os
+import time
+from collections import namedtuple
+
+from django.conf import settings
+from django.db import connection
+from django.db.models.functions import Collate
+
+from .models import *
+
+# модели с файлами в MEDIA_ROOT; у CellImage есть сохранённый хэш содержимого
+MEDIA_MODELS = (CellImage, Cell)
+# записей, которые курсор на стороне сервера передаёт за одно обращение
+CURSOR_CHUNK = 5000
+MISSING, ORPHAN, PRESENT = "missing", "orphan", "present"
+
+Reference = namedtuple("Reference", "name model pk digest")
+
+
+def skipped_directories():
+    # производные файлы и карантин не ссылаются на записи и не сверяются
+    return {settings.IMAGE_DERIVATIVE_DIR, settings.MEDIA_QUARANTINE_DIR}
+
+
+def references(model):
+    """Ссылки модели на файлы в побайтовом порядке имён, потоком через курсор на стороне
+    сервера (iterator), чтобы память не зависела от количества записей"""
+    order = Collate("image", "C") if connection.vendor == "postgresql" else "image"
+    fields = ("image", "pk", "content_digest") if hasattr(model, "content_digest") else ("image", "pk")
+    for row in model.objects.exclude(image="").order_by(order, "pk").values_list(*fields).iterator(
+            chunk_size=CURSOR_CHUNK):
+        yield Reference(row[0], model, row[1], row[2] if len(row) > 2 else None)
+
+
+def referenced_files():
+    return heapq.merge(*(references(model) for model in MEDIA_MODELS), key=lambda reference: reference.name)
+
+
+def media_files(root=None, prefix=""):
+    """Файлы MEDIA_ROOT в том же побайтовом порядке относительных имён: каталог сортируется
+    как имя с "/" на конце, поэтому его содержимое встаёт ровно на место своих полных путей.
+    В памяти - только списки каталогов текущей ветви обхода"""
+    root = root or settings.MEDIA_ROOT
+    try:
+        entries = list(os.scandir(os.path.join(root, prefix)))
+    except FileNotFoundError:
+        return
+    keyed = []
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            if not prefix and entry.name in skipped_directories():
+                continue
+            keyed.append((entry.name + "/", entry, True))
+        elif entry.is_file(follow_symlinks=False):
+            keyed.append((entry.name, entry, False))
+    keyed.sort(key=lambda item: item[0])
+    for key, entry, is_directory in keyed:
+        if is_directory:
+            yield from media_files(root, prefix + key)
+        else:
+            yield prefix + key, entry.path
+
+
+def diff(references, files):
+    """Слияние двух упорядоченных потоков: (MISSING, ссылка, None), (ORPHAN, None, (имя, путь))
+    и (PRESENT, ссылка, (имя, путь)) для каждой ссылки на существующий файл"""
+    reference, file = next(references, None), next(files, None)
+    previous = ""
+    while reference is not None or file is not None:
+        if reference is not None:
+            if reference.name < previous:
+                raise RuntimeError("Имена файлов из БД пришли не в побайтовом порядке")
+            previous = reference.name
+        if file is None or (reference is not None and reference.name < file[0]):
+            yield MISSING, reference, None
+            reference = next(references, None)
+        elif reference is None or file[0] < reference.name:
+            yield ORPHAN, None, file
+            file = next(files, None)
+        else:
+            yield PRESENT, reference, file
+            reference = next(references, None)
+            # на один файл могут ссылаться несколько записей
+            if reference is None or reference.name != file[0]:
+                file = next(files, None)
+
+
+def file_sha256(path):
+    """SHA-256 файла через mmap: данные читаются страницами ядра без копирования в память
+    процесса, а hashlib отпускает GIL, поэтому файлы хэшируются в потоках параллельно"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        if os.fstat(file.fileno()).st_size:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                if hasattr(mapped, "madvise"):
+                    mapped.madvise(mmap.MADV_SEQUENTIAL)
+                digest.update(mapped)
+    return digest.hexdigest()
+
+
+def is_settled(full_path, min_age):
+    # только что записанный файл может принадлежать сохраняемой прямо сейчас форме
+    try:
+        return time.time() - os.stat(full_path).st_mtime >= min_age
+    except FileNotFoundError:
+        return False
+
+
+def quarantine(name, batch):
+    """Переносит файл в MEDIA_ROOT/MEDIA_QUARANTINE_DIR/<batch>/<имя> с сохранением пути,
+    откуда его можно вернуть на место, если он окажется нужен"""
+    target = os.path.join(settings.MEDIA_ROOT, settings.MEDIA_QUARANTINE_DIR, batch, name)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    os.rename(os.path.join(settings.MEDIA_ROOT, name), target)
+    return target
@@ -0,0 +1,236 @@
+import math
+import re
+import threading
+from collections import defaultdict
+
+from django.contrib.postgres.search import SearchQuery, SearchRank, TrigramSimilarity
+from django.db import connection
+from django.db.models import F, FloatField, Q, Value
+from django.db.models.functions import Greatest
+from django.urls import reverse
+
+from .caching import get_model_version
+from .models import *
+
+SEARCH_CONFIG = 'russian'
+# порог похожести по триграммам, как pg_trgm.similarity_threshold по умолчанию
+TRIGRAM_THRESHOLD = 0.3
+
+WORD_RE = re.compile(r"\w+")
+# длиннее не бывает ни номер истории болезни, ни идентификатор (bigint)
+MAX_NUMBER_DIGITS = 18
+
+# окончания для упрощённого стемминга в резервном индексе, от длинных к коротким
+RUSSIAN_ENDINGS = sorted([
+    "иями", "ями", "ами", "иях", "ях", "ах", "ием", "ем", "ом", "ой", "ей", "ий", "ый", "ая", "яя", "ое", "ее",
+    "ые", "ие", "ого", "его", "ому", "ему", "ыми", "ими", "ых", "их", "ую", "юю", "ия", "ии", "ию", "ья", "ье",
+    "ьи", "ов", "ев", "а", "я", "о", "е", "ы", "и", "у", "ю", "ь", "й",
+], key=len, reverse=True)
+
+
+def stem(word):
+    word = word.lower().replace("ё", "е")
+    for ending in RUSSIAN_ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= 3:
+            return word[:-len(ending)]
+    return word
+
+
+def tokenize(text):
+    return [stem(word) for word in WORD_RE.findall(text or "")]
+
+
+def as_number(text):
+    """Число, если строка состоит из десятичных цифр, иначе None. isdigit пропускает
+    надстрочные цифры вроде "²", которые int не разбирает"""
+    text = text.strip()
+    return int(text) if text.isdecimal() and len(text) <= MAX_NUMBER_DIGITS else None
+
+
+def trigrams(text):
+    text = f"  {(text or '').lower()} "
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class SearchSource:
+    """Таблица, участвующая в поиске: поля tsvector с весами, поля для нечёткого поиска по триграммам
+    и числовое поле для точного совпадения. search_vector заполняет триггер БД
+    (миграция 0034_search_vector_triggers), веса полей там те же"""
+
+    def __init__(self, name, model, label, title, weighted_fields, trigram_fields=(), number_field=None):
+        self.name = name
+        self.model = model
+        self.label = label
+        self.title = title
+        self.weighted_fields = weighted_fields
+        self.trigram_fields = trigram_fields
+        self.number_field = number_field
+
+    def queryset(self, text):
+        query = SearchQuery(text, config=SEARCH_CONFIG, search_type="websearch")
+        condition = Q(search_vector=query)
+        scores = [SearchRank(F("search_vector"), query)]
+        for field in self.trigram_fields:
+            condition |= Q(**{f"{field}__trigram_similar": text})
+            scores.append(TrigramSimilarity(field, text))
+        number = as_number(text)
+        if self.number_field and number is not None:
+            condition |= Q(**{self.number_field: number})
+            scores.append(Value(1.0, output_field=FloatField()))
+        rank = Greatest(*scores) if len(scores) > 1 else scores[0]
+        return self.model.objects.filter(condition).annotate(rank=rank).order_by("-rank", "pk")
+
+    def hit(self, obj, rank):
+        return SearchHit(self, obj, rank)
+
+
+class SearchHit:
+    def __init__(self, source, obj, rank):
+        self.source = source
+        self.object = obj
+        self.rank = rank
+
+    @property
+    def label(self):
+        return self.source.label
+
+    @property
+    def title(self):
+        return self.source.title.format(**vars(self.object))
+
+    @property
+    def url(self):
+        obj = self.object
+        if isinstance(obj, Patient):
+            return reverse("patient_record", kwargs={"pk": obj.pk})
+        if isinstance(obj, ResearchResult):
+            return reverse("patient_record", kwargs={"pk": obj.patient_id}) if obj.patient_id else reverse("add_diagnosis")
+        if isinstance(obj, Terms):
+            return reverse("add_terms")
+        return reverse(f"admin:{obj._meta.app_label}_{obj._meta.model_name}_change", args=[obj.pk])
+
+
+SEARCH_SOURCES = [
+    SearchSource("patient", Patient, "Пациент", "{last_name} {first_name} {patronymic}, история болезни № {number_ill_history}",
+                 [("last_name", "A"), ("first_name", "A"), ("patronymic", "B")],
+                 trigram_fields=("last_name", "first_name"), number_field="number_ill_history"),
+    SearchSource("term", Terms, "Термин", "{term_name}",
+                 [("term_name", "A"), ("definition", "B"), ("description", "C")]),
+    SearchSource("result", ResearchResult, "Заключение", "{conclusion}",
+                 [("conclusion", "A")]),
+    SearchSource("log", SystemLog, "Журнал", "{action_text} ({object_sender})",
+                 [("action_text", "A"), ("description", "B"), ("object_sender", "C")]),
+]
+
+
+class InvertedIndex:
+    """Резервный индекс в памяти процесса для баз без полнотекстового поиска (SQLite).
+    Перестраивается, когда меняется версия таблицы источника"""
+
+    def __init__(self, source):
+        self.source = source
+        self.version = None
+        self.postings = {}
+        self.names = {}
+        self.numbers = {}
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        version = get_model_version(self.source.model)
+        if version == self.version:
+            return
+        with self.lock:
+            if version == self.version:
+                return
+            fields = [field for field, weight in self.source.weighted_fields]
+            values = list(self.source.trigram_fields)
+            if self.source.number_field:
+                values.append(self.source.number_field)
+            weights = {"A": 1.0, "B": 0.4, "C": 0.2, "D": 0.1}
+
+            postings = defaultdict(dict)
+            names = {}
+            numbers = defaultdict(list)
+            size = 0
+            for row in self.source.model.objects.values_list("pk", *fields, *values).iterator():
+                pk, texts, extra = row[0], row[1:len(fields) + 1], row[len(fields) + 1:]
+                size += 1
+                for text, (field, weight) in zip(texts, self.source.weighted_fields):
+                    for token in tokenize(text):
+                        postings[token][pk] = postings[token].get(pk, 0.0) + weights[weight]
+                if self.source.trigram_fields:
+                    names[pk] = [trigrams(value) for value in extra[:len(self.source.trigram_fields)]]
+                if self.source.number_field:
+                    numbers[extra[-1]].append(pk)
+            self.postings, self.names, self.numbers, self.size = dict(postings), names, dict(numbers), size
+            self.version = version
+
+    def search(self, text):
+        self.refresh()
+        scores = defaultdict(float)
+        for token in set(tokenize(text)):
+            docs = self.postings.get(token, {})
+            idf = math.log(1 + self.size / (1 + len(docs)))
+            for pk, tf in docs.items():
+                scores[pk] += tf * idf / 10
+        if self.names:
+            query = trigrams(text)
+            for pk, name_trigrams in self.names.items():
+                for candidate in name_trigrams:
+                    similarity = len(query & candidate) / len(query | candidate)
+                    if similarity >= TRIGRAM_THRESHOLD:
+                        scores[pk] = max(scores[pk], similarity)
+        number = as_number(text)
+        if number is not None:
+            for pk in self.numbers.get(number, []):
+                scores[pk] = max(scores[pk], 1.0)
+        return sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+
+
+_fallback_indexes = {source.name: InvertedIndex(source) for source in SEARCH_SOURCES}
+
+
+def use_fulltext():
+    return connection.vendor == "postgresql"
+
+
+class SearchResults:
+    """Объединённая выдача по всем источникам, отсортированная по релевантности.
+    Поддерживает count() и срезы, поэтому передаётся в Paginator напрямую; из каждого
+    источника читается не больше записей, чем нужно для запрошенной страницы"""
+
+    def __init__(self, text, sources=SEARCH_SOURCES):
+        self.text = text.strip()
+        self.sources = sources
+        self._count = None
+
+    def count(self):
+        if self._count is None:
+            if not self.text:
+                self._count = 0
+            elif use_fulltext():
+                self._count = sum(source.queryset(self.text).count() for source in self.sources)
+            else:
+                self._count = sum(len(_fallback_indexes[source.name].search(self.text)) for source in self.sources)
+        return self._count
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, item):
+        if not isinstance(item, slice):
+            return self[item:item + 1][0]
+        if not self.text:
+            return []
+        stop = item.stop if item.stop is not None else self.count()
+        hits = []
+        for source in self.sources:
+            if use_fulltext():
+                hits.extend(source.hit(obj, obj.rank) for obj in source.queryset(self.text)[:stop])
+            else:
+                ranked = _fallback_indexes[source.name].search(self.text)[:stop]
+                objects = source.model.objects.in_bulk([pk for pk, rank in ranked])
+                hits.extend(source.hit(objects[pk], rank) for pk, rank in ranked if pk in objects)
+        hits.sort(key=lambda hit: -hit.rank)
+        return hits[item]
@@ -0,0 +1,53 @@
+// поля автодополнения: варианты подгружаются по мере ввода, в форму уходит первичный ключ
+document.addEventListener("DOMContentLoaded", function () {
+    document.querySelectorAll(".autocomplete").forEach(function (block) {
+        var value = block.querySelector(".autocomplete-value");
+        var input = block.querySelector(".autocomplete-input");
+        var results = block.querySelector(".autocomplete-results");
+        var timer = null;
+        var request = null;
+
+        function show(items) {
+            results.innerHTML = "";
+            items.forEach(function (item) {
+                var option = document.createElement("button");
+                option.type = "button";
+                option.className = "list-group-item list-group-item-action";
+                option.textContent = item.text;
+                option.addEventListener("click", function () {
+                    value.value = item.id;
+                    input.value = item.text;
+                    results.innerHTML = "";
+                });
+                results.appendChild(option);
+            });
+        }
+
+        function load() {
+            if (request) {
+                request.abort();
+            }
+            request = new AbortController();
+            fetch(block.dataset.lookupUrl + "?q=" + encodeURIComponent(input.value), {signal: request.signal})
+                .then(function (response) { return response.json(); })
+                .then(function (data) { show(data.results); })
+                .catch(function () {});
+        }
+
+        input.addEventListener("input", function () {
+            value.value = "";
+            clearTimeout(timer);
+            timer = setTimeout(load, 250);
+        });
+        input.addEventListener("focus", function () {
+            if (!value.value) {
+                load();
+            }
+        });
+        document.addEventListener("click", function (event) {
+            if (!block.contains(event.target)) {
+                results.innerHTML = "";
+            }
+        });
+    });
+});
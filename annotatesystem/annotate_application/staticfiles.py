@@ -0,0 +1,74 @@
+import gzip
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage, staticfiles_storage
+from django.core.files.base import ContentFile
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# сжимаются только текстовые форматы: изображения уже сжаты
+COMPRESSIBLE_EXTENSIONS = (".css", ".js", ".svg", ".json", ".txt", ".html", ".map")
+# сжатый вариант сохраняется, только если он заметно меньше исходного файла
+MIN_COMPRESSION_RATIO = 0.95
+# сжатые варианты в порядке предпочтения при отдаче: расширение файла и Content-Encoding
+ENCODINGS = ((".br", "br"), (".gz", "gzip"))
+
+
+def compress(content):
+    """Сжатые варианты содержимого: {расширение: байты}; gzip с нулевым mtime, чтобы повторная
+    сборка давала те же файлы"""
+    variants = {".gz": gzip.compress(content, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants[".br"] = brotli.compress(content, quality=11)
+    return {extension: data for extension, data in variants.items()
+            if len(data) < len(content) * MIN_COMPRESSION_RATIO}
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    """Хранилище collectstatic: имена с хэшем содержимого (manifest) и заранее сжатые варианты
+    .gz и .br (если установлен пакет Brotli) для файлов с хэшем, которые отдаёт media.serve_static"""
+    compress_workers = 4
+
+    def post_process(self, paths, dry_run=False, **options):
+        yield from super().post_process(paths, dry_run, **options)
+        if dry_run:
+            return
+        names = sorted({name for name in self.hashed_files.values() if name.endswith(COMPRESSIBLE_EXTENSIONS)})
+        # zlib и brotli освобождают GIL, поэтому файлы сжимаются параллельно
+        with ThreadPoolExecutor(max_workers=self.compress_workers) as pool:
+            for name, written in zip(names, pool.map(self.compress_file, names)):
+                for compressed_name in written:
+                    yield compressed_name, compressed_name, True
+
+    def compress_file(self, name):
+        with self.open(name) as file:
+            content = file.read()
+        written = []
+        for extension, data in compress(content).items():
+            if self.exists(name + extension):
+                self.delete(name + extension)
+            self._save(name + extension, ContentFile(data))
+            written.append(name + extension)
+        return written
+
+
+@lru_cache(maxsize=1)
+def immutable_names():
+    """Имена файлов с хэшем содержимого из manifest: их содержимое по одному адресу неизменно.
+    Manifest меняется только при развёртывании вместе с перезапуском процессов"""
+    return frozenset(getattr(staticfiles_storage, "hashed_files", {}).values())
+
+
+def select_variant(full_path, accept_encoding):
+    """Путь к лучшему заранее сжатому варианту файла, который принимает клиент, и его Content-Encoding"""
+    accepted = {token.split(";")[0].strip() for token in accept_encoding.lower().split(",")
+                if not token.replace(" ", "").endswith(";q=0")}
+    for extension, encoding in ENCODINGS:
+        if encoding in accepted and os.path.isfile(full_path + extension):
+            return full_path + extension, encoding
+    return full_path, None
@@ -0,0 +1,162 @@
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+
+from .caching import get_models_version
+from .models import *
+
+# таблицы, от которых зависит результат: ключ кэша строится по их версиям
+STATISTICS_MODELS = (Immunophenotyping, PatientResearch, Marker)
+PERCENTILES = (5, 25, 50, 75, 95)
+# границы столбцов гистограммы процента позитивных клеток
+HISTOGRAM_BINS = np.linspace(0, 100, 11)
+# коэффициент межквартильного размаха для маркеров без заданного референсного интервала
+IQR_FENCE = 1.5
+
+
+def load_measurements():
+    """Все измерения одним запросом в виде столбцов NumPy, отсортированных по маркеру,
+    пациенту и дате начала исследования"""
+    rows = list(Immunophenotyping.objects.order_by(
+        'marker_id', 'research__patient_id', 'research__date_begin', 'pk'
+    ).values_list('marker_id', 'research__patient_id', 'research_id', 'research__date_begin', 'percent_positive_cells'))
+    if not rows:
+        return None
+    marker, patient, research, date, percent = zip(*rows)
+    return {
+        'marker': np.array(marker, dtype=np.int64),
+        'patient': np.array(patient, dtype=np.int64),
+        'research': np.array(research, dtype=np.int64),
+        # даты хранятся в UTC, часовой пояс отбрасывается после приведения
+        'date': np.array([value.replace(tzinfo=None) for value in date], dtype='datetime64[s]'),
+        'percent': np.array(percent, dtype=np.float64),
+    }
+
+
+def group_bounds(keys):
+    """Начала и длины групп подряд идущих одинаковых ключей (массивы должны быть отсортированы)"""
+    same = np.ones(len(keys[0]) - 1, dtype=bool)
+    for key in keys:
+        same &= key[1:] == key[:-1]
+    starts = np.concatenate(([0], np.flatnonzero(~same) + 1))
+    lengths = np.diff(np.append(starts, len(keys[0])))
+    return starts, lengths
+
+
+def grouped_percentiles(values, starts, lengths, percentiles):
+    """Процентили (линейная интерполяция, как np.percentile) для всех групп сразу;
+    внутри группы значения должны быть отсортированы по возрастанию"""
+    positions = (lengths[:, None] - 1) * (np.asarray(percentiles, dtype=np.float64)[None, :] / 100)
+    lower = np.floor(positions).astype(np.int64)
+    upper = np.minimum(lower + 1, lengths[:, None] - 1)
+    fraction = positions - lower
+    base = starts[:, None]
+    return values[base + lower] * (1 - fraction) + values[base + upper] * fraction
+
+
+def marker_distributions(data, markers):
+    order = np.lexsort((data['percent'], data['marker']))
+    marker, percent = data['marker'][order], data['percent'][order]
+    starts, lengths = group_bounds([marker])
+    marker_ids = marker[starts]
+
+    sums = np.add.reduceat(percent, starts)
+    means = sums / lengths
+    squares = np.add.reduceat((percent - np.repeat(means, lengths)) ** 2, starts)
+    stds = np.sqrt(squares / lengths)
+    quantiles = grouped_percentiles(percent, starts, lengths, PERCENTILES)
+
+    bins = np.clip(np.searchsorted(HISTOGRAM_BINS, percent, side='right') - 1, 0, len(HISTOGRAM_BINS) - 2)
+    group = np.repeat(np.arange(len(starts)), lengths)
+    histograms = np.bincount(group * (len(HISTOGRAM_BINS) - 1) + bins,
+                             minlength=len(starts) * (len(HISTOGRAM_BINS) - 1)).reshape(len(starts), -1)
+
+    return [{
+        'marker_id': int(marker_id),
+        'marker': markers[marker_id]['marker_name'],
+        'count': int(lengths[i]),
+        'mean': float(means[i]),
+        'std': float(stds[i]),
+        'min': float(percent[starts[i]]),
+        'max': float(percent[starts[i] + lengths[i] - 1]),
+        'percentiles': quantiles[i].tolist(),
+        'histogram': histograms[i].tolist(),
+    } for i, marker_id in enumerate(marker_ids)], marker_ids, quantiles
+
+
+def reference_ranges(marker_ids, quantiles, markers):
+    """Референсный интервал маркера: заданный в справочнике, иначе границы Тьюки по квартилям"""
+    q1, q3 = quantiles[:, PERCENTILES.index(25)], quantiles[:, PERCENTILES.index(75)]
+    low, high = q1 - IQR_FENCE * (q3 - q1), q3 + IQR_FENCE * (q3 - q1)
+    given_low = np.array([np.nan if markers[m]['reference_min'] is None else markers[m]['reference_min']
+                          for m in marker_ids], dtype=np.float64)
+    given_high = np.array([np.nan if markers[m]['reference_max'] is None else markers[m]['reference_max']
+                           for m in marker_ids], dtype=np.float64)
+    return np.where(np.isnan(given_low), low, given_low), np.where(np.isnan(given_high), high, given_high)
+
+
+def outliers(data, marker_ids, low, high, markers):
+    index = np.searchsorted(marker_ids, data['marker'])
+    below, above = data['percent'] < low[index], data['percent'] > high[index]
+    found = np.flatnonzero(below | above)
+    return [{
+        'marker': markers[data['marker'][i]]['marker_name'],
+        'patient_id': int(data['patient'][i]),
+        'research_id': int(data['research'][i]),
+        'date': str(data['date'][i].astype('datetime64[D]')),
+        'percent': float(data['percent'][i]),
+        'reference': [float(low[index[i]]), float(high[index[i]])],
+        'direction': 'below' if below[i] else 'above',
+    } for i in found]
+
+
+def trajectories(data, markers):
+    """Изменение каждого маркера у пациента по датам исследований: значения, разница
+    между соседними исследованиями и скорость изменения в процентах за день"""
+    starts, lengths = group_bounds([data['marker'], data['patient']])
+    days = (data['date'] - data['date'].min()).astype('timedelta64[s]').astype(np.float64) / 86400
+    steps = np.diff(data['percent'], prepend=np.nan)
+    steps[starts] = np.nan
+    ends = starts + lengths - 1
+    spans = days[ends] - days[starts]
+    slopes = np.divide(data['percent'][ends] - data['percent'][starts], spans,
+                       out=np.zeros_like(spans), where=spans > 0)
+
+    result = {}
+    for i, (start, end) in enumerate(zip(starts, ends + 1)):
+        if end - start < 2:
+            continue
+        patient_id = int(data['patient'][start])
+        result.setdefault(patient_id, []).append({
+            'marker': markers[data['marker'][start]]['marker_name'],
+            'dates': [str(value) for value in data['date'][start:end].astype('datetime64[D]')],
+            'values': data['percent'][start:end].tolist(),
+            'changes': np.nan_to_num(steps[start:end]).tolist(),
+            'slope_per_day': float(slopes[i]),
+        })
+    return result
+
+
+def compute_statistics():
+    data = load_measurements()
+    if data is None:
+        return {'markers': [], 'outliers': [], 'trajectories': {}}
+    markers = {row['pk']: row for row in Marker.objects.values('pk', 'marker_name', 'reference_min', 'reference_max')}
+    distributions, marker_ids, quantiles = marker_distributions(data, markers)
+    low, high = reference_ranges(marker_ids, quantiles, markers)
+    return {
+        'markers': distributions,
+        'outliers': outliers(data, marker_ids, low, high, markers),
+        'trajectories': trajectories(data, markers),
+    }
+
+
+def get_statistics():
+    """Статистика иммунофенотипирования из кэша; ключ меняется при любом изменении исходных таблиц"""
+    key = f"immuno_statistics:{get_models_version(*STATISTICS_MODELS)}"
+    statistics = cache.get(key)
+    if statistics is None:
+        statistics = compute_statistics()
+        cache.set(key, statistics, timeout=settings.CARD_CACHE_TIMEOUT)
+
+    return statistics
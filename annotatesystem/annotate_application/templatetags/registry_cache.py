@@ -0,0 +1,25 @@
+from django import template
+from django.urls import reverse
+
+from ..caching import get_row_version
+from ..refcache import REFERENCE_TABLES
+
+register = template.Library()
+
+
+@register.filter
+def row_version(obj):
+    return get_row_version(type(obj), obj.pk)
+
+
+@register.filter
+def reference_label(obj, field_name):
+    """Подпись записи справочника по внешнему ключу без запроса к БД: {{ o|reference_label:'marker' }}"""
+    field = obj._meta.get_field(field_name)
+    return REFERENCE_TABLES[field.related_model].label(getattr(obj, field.attname))
+
+
+@register.filter
+def derivative_url(image, kind="preview"):
+    """Адрес снимка для показа в браузере в формате по Accept: {{ o.image|derivative_url:'full' }}"""
+    return reverse("image_derivative", args=(kind, image.name)) if image else ""
@@ -0,0 +1,102 @@
+from django.conf import settings
+from django.db.models import F, Window
+from django.db.models.functions import Lag, Lead, RowNumber
+
+from .models import *
+from .refcache import reference
+
+# Динамика маркеров пациента по исследованиям: для каждого измерения значение предыдущего и
+# следующего измерения того же маркера у того же пациента (LAG/LEAD по дате начала исследования),
+# изменение и интервал в днях, флаги тренда. Окна считает БД за один проход по отсортированным
+# строкам; страница отбирает пациентов целиком, поэтому окна внутри страницы не обрезаются.
+EXPORT_COLUMNS = ('patient_id', 'marker', 'research_id', 'date', 'step', 'value', 'previous', 'change',
+                  'days', 'flags')
+# флаги тренда: первое измерение, рост, снижение, без изменений, локальный максимум и минимум,
+# выше и ниже референсного интервала маркера
+FIRST, UP, DOWN, STABLE, PEAK, TROUGH, ABOVE, BELOW = 'first', 'up', 'down', 'stable', 'peak', 'trough', 'above', 'below'
+
+
+def measurements(patient_ids=None):
+    """Измерения с оконными столбцами в порядке пациент, маркер, дата исследования"""
+    window = {
+        'partition_by': [F('research__patient'), F('marker')],
+        'order_by': [F('research__date_begin').asc(), F('pk').asc()],
+    }
+    queryset = Immunophenotyping.objects.all()
+    if patient_ids is not None:
+        queryset = queryset.filter(research__patient__in=patient_ids)
+    return queryset.annotate(
+        patient_id=F('research__patient'),
+        date=F('research__date_begin'),
+        step=Window(RowNumber(), **window),
+        previous=Window(Lag('percent_positive_cells'), **window),
+        previous_date=Window(Lag('research__date_begin'), **window),
+        next_value=Window(Lead('percent_positive_cells'), **window),
+    ).order_by('research__patient', 'marker', 'research__date_begin', 'pk').values(
+        'patient_id', 'marker_id', 'research_id', 'date', 'step', 'percent_positive_cells', 'previous',
+        'previous_date', 'next_value')
+
+
+def trend_flags(value, previous, next_value, marker):
+    threshold = settings.TRAJECTORY_STABLE_DELTA
+    flags = []
+    if previous is None:
+        flags.append(FIRST)
+    else:
+        change = value - previous
+        flags.append(UP if change > threshold else DOWN if change < -threshold else STABLE)
+        if next_value is not None:
+            if change > threshold and next_value - value < -threshold:
+                flags.append(PEAK)
+            elif change < -threshold and next_value - value > threshold:
+                flags.append(TROUGH)
+    if marker is not None:
+        if marker.reference_max is not None and value > marker.reference_max:
+            flags.append(ABOVE)
+        elif marker.reference_min is not None and value < marker.reference_min:
+            flags.append(BELOW)
+    return flags
+
+
+def trajectory_rows(rows):
+    """Строки отчёта из строк measurements(): разница и дни считаются по уже выбранным LAG"""
+    markers = reference(Marker)
+    for row in rows:
+        marker = markers.get(row['marker_id'])
+        value, previous = row['percent_positive_cells'], row['previous']
+        yield {
+            'patient_id': row['patient_id'],
+            'marker': marker.marker_name if marker is not None else row['marker_id'],
+            'research_id': row['research_id'],
+            'date': row['date'].date(),
+            'step': row['step'],
+            'value': value,
+            'previous': previous,
+            'change': None if previous is None else value - previous,
+            'days': None if previous is None else (row['date'] - row['previous_date']).days,
+            'flags': trend_flags(value, previous, row['next_value'], marker),
+        }
+
+
+def trajectory_patients():
+    """Пациенты с измерениями по возрастанию идентификатора, для постраничного вывода"""
+    return Immunophenotyping.objects.order_by('research__patient').values_list(
+        'research__patient', flat=True).distinct()
+
+
+def patient_trajectories(patient_ids):
+    """Динамика пациентов страницы: {пациент: [{маркер, строки}, ...]} в порядке идентификаторов"""
+    result = {patient_id: [] for patient_id in patient_ids}
+    for row in trajectory_rows(measurements(list(patient_ids))):
+        markers = result[row['patient_id']]
+        if not markers or markers[-1]['marker'] != row['marker']:
+            markers.append({'marker': row['marker'], 'rows': []})
+        markers[-1]['rows'].append(row)
+    return result
+
+
+def export_rows():
+    """Все строки отчёта для выгрузки: чтение курсором на стороне сервера частями"""
+    rows = measurements().iterator(chunk_size=settings.TRAJECTORY_EXPORT_CHUNK)
+    for row in trajectory_rows(rows):
+        yield [' '.join(row[column]) if column == 'flags' else row[column] for column in EXPORT_COLUMNS]
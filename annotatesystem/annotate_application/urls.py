@@ -1,17 +1,23 @@
+from django.conf import settings
 from django.urls import path
 from .views import *
 
 
+def read_view(sync_view, async_view):
+    # под ASGI страницы только для чтения обслуживаются асинхронными вариантами
+    return (async_view if settings.ASYNC_READ_VIEWS else sync_view).as_view()
+
+
 urlpatterns = [
     path('registration/', SignUpView.as_view(), name='signup'),
     path('login/', SignInView.as_view(), name='login'),
     path('logout/', SignOutView.as_view(), name='logout'),
     path('home/', HomePageView.as_view(), name='home'),
-    path('add_patient/', CreatePatientView.as_view(), name='add_patient'),
-    path('add_diagnosis/', CreateDiagnosisView.as_view(), name='add_diagnosis'),
-    path('add_cell_type/', CreateCellTypeView.as_view(), name='add_cell_type'),
-    path('add_image/', AddImageView.as_view(), name='add_image'),
-    path('add_medication/', AddMedicationView.as_view(), name='add_medication'),
+    path('add_patient/', read_view(CreatePatientView, AsyncCreatePatientView), name='add_patient'),
+    path('add_diagnosis/', read_view(CreateDiagnosisView, AsyncCreateDiagnosisView), name='add_diagnosis'),
+    path('add_cell_type/', read_view(CreateCellTypeView, AsyncCreateCellTypeView), name='add_cell_type'),
+    path('add_image/', read_view(AddImageView, AsyncAddImageView), name='add_image'),
+    path('add_medication/', read_view(AddMedicationView, AsyncAddMedicationView), name='add_medication'),
     path('add_dict_characteristics/', AddDictView.as_view(), name='add_dict_characteristics'),
     path('add_terms/', AddTermsView.as_view(), name='add_terms'),
     path('add_cell_characteristic/', AddCellCharacteristicView.as_view(), name='add_cell_characteristic'),
@@ -20,5 +26,24 @@ urlpatterns = [
     path('add_marker/', AddMarkerView.as_view(), name='add_marker'),
     path('add_immunophenotipation/', AddImmunoView.as_view(), name='add_immunophenotipation'),
     path('add_researched_object/', AddResearchedObject.as_view(), name='add_researched_object'),
-    path('<str:username>/', ShowProfileView.as_view(), name='profile')
+    path('patient/<int:pk>/', PatientRecordView.as_view(), name='patient_record'),
+    path('patient/<int:pk>/json/', PatientRecordJsonView.as_view(), name='patient_record_json'),
+    path('lookup/<str:name>/', LookupView.as_view(), name='lookup'),
+    path('statistics/immunophenotyping/', ImmunoStatisticsView.as_view(), name='immuno_statistics'),
+    path('statistics/immunophenotyping/json/', ImmunoStatisticsJsonView.as_view(), name='immuno_statistics_json'),
+    path('statistics/trajectories/', TrajectoryView.as_view(), name='trajectories'),
+    path('statistics/trajectories/csv/', TrajectoryExportView.as_view(), name='trajectories_csv'),
+    path('medication/<int:pk>/myelogram/', MyelogramJsonView.as_view(), name='myelogram'),
+    path('myelograms/', MyelogramListJsonView.as_view(), name='myelograms'),
+    path('derivative/<str:kind>/<path:path>', DerivativeImageView.as_view(), name='image_derivative'),
+    path('image/<int:pk>/overlay/', OverlayManifestView.as_view(), name='overlay_manifest'),
+    path('image/<int:pk>/overlay/<int:version>/<int:zoom>/<int:x>/<int:y>.png', OverlayTileView.as_view(),
+         name='overlay_tile'),
+    path('image/<int:pk>/markings/', ImageMarkingsView.as_view(), name='image_markings'),
+    path('image/<int:pk>/region/', ImageRegionView.as_view(), name='image_region'),
+    path('cohorts/', CohortView.as_view(), name='cohorts'),
+    path('changes/', ChangeFeedView.as_view(), name='changes'),
+    path('api/<str:resource>/', ApiResourceView.as_view(), name='api_resource'),
+    path('search/', SearchView.as_view(), name='search'),
+    path('<str:username>/', read_view(ShowProfileView, AsyncShowProfileView), name='profile')
 ]
@@ -1,4 +1,24 @@
+from hashlib import md5
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.forms import ModelChoiceField
 from django.urls import reverse_lazy
+from django.utils.cache import get_conditional_response, patch_cache_control
+
+from .caching import aget_model_versions, aget_models_version, get_models_version
+from .widgets import is_autocomplete
+
+
+async def aget_request_user(request):
+    # request.user ленивый: первое обращение читает сессию и пользователя из БД,
+    # поэтому в асинхронных представлениях его нужно загрузить в потоке
+    def load_user():
+        request.user.is_authenticated
+        return request.user
+
+    return await sync_to_async(load_user)()
 
 
 class MetaDataMixin:
@@ -10,3 +30,64 @@ class MetaDataMixin:
                                               kwargs={'username': self.request.user.username})
 
         return context
+
+
+class CachedListMixin:
+    # первая модель - модель реестра, остальные - модели, данные которых выводятся в карточках
+    list_models = ()
+
+    def get_cache_context(self, **kwargs):
+        context = kwargs
+        context['list_version'] = get_models_version(*self.list_models)
+        context['card_version'] = get_models_version(*self.list_models[1:])
+        context['card_cache_timeout'] = settings.CARD_CACHE_TIMEOUT
+
+        return context
+
+    async def aget_cache_context(self, **kwargs):
+        # обе версии - одним обращением к кэшу
+        versions = [str(version) for version in (await aget_model_versions(self.list_models)).values()]
+        context = kwargs
+        context['list_version'] = ".".join(versions)
+        context['card_version'] = ".".join(versions[1:])
+        context['card_cache_timeout'] = settings.CARD_CACHE_TIMEOUT
+
+        return context
+
+
+class ReplicaReadMixin:
+    # GET-запросы представления читают из реплики, см. routers.ReplicaRoutingMiddleware
+    read_replica = True
+
+
+class ConditionalListMixin:
+    # отвечает 304 на повторный GET страницы реестра, если не менялись ни записи реестра,
+    # ни справочники формы добавления, ни пользователи. Поля автодополнения не выводят
+    # справочник на странице и в валидатор не входят
+    list_models = ()
+
+    def get_etag_models(self):
+        form_models = [field.queryset.model for field in self.form_class.base_fields.values()
+                       if isinstance(field, ModelChoiceField) and not is_autocomplete(field)]
+        return tuple(self.list_models) + tuple(form_models) + (get_user_model(),)
+
+    def make_etag(self, version):
+        # страница содержит имя пользователя и csrf-токен, поэтому они входят в валидатор
+        validator = "|".join([version, str(self.request.user.pk), self.request.COOKIES.get(settings.CSRF_COOKIE_NAME, "")])
+        return f'"{md5(validator.encode()).hexdigest()}"'
+
+    def get_etag(self):
+        return self.make_etag(get_models_version(*self.get_etag_models()))
+
+    async def aget_etag(self):
+        return self.make_etag(await aget_models_version(*self.get_etag_models()))
+
+    def get(self, request, *args, **kwargs):
+        etag = self.get_etag()
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = super().get(request, *args, **kwargs)
+        response.headers["ETag"] = etag
+        patch_cache_control(response, private=True, no_cache=True)
+
+        return response
@@ -1,14 +1,55 @@
-from django.http import HttpResponseRedirect
+import csv
+import itertools
+import json
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.views import redirect_to_login
+from django.core.cache import cache
+from django.core.cache.utils import make_template_fragment_key
+from django.core.exceptions import PermissionDenied
+from django.core.handlers.asgi import ASGIRequest
+from django.core.paginator import Paginator
+from django.db.models import Prefetch
+from django.forms import ModelChoiceField
+from django.http import HttpResponse, HttpResponseRedirect, HttpResponsePermanentRedirect, Http404, FileResponse, JsonResponse, \
+    StreamingHttpResponse
 from django.urls import reverse_lazy, reverse
-from django.views.generic import TemplateView
+from django.views.generic import TemplateView, View
 from django.views.generic.edit import CreateView, UpdateView, FormView
 from django.views.generic.detail import DetailView
 from django.contrib.auth.views import LoginView, LogoutView
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.shortcuts import get_object_or_404
+from django.shortcuts import get_object_or_404, render
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
 from .forms import *
 from .models import *
-from .utils import MetaDataMixin
+from .media import serve_file, serve_static, aiter_file
+from .staticfiles import immutable_names
+from .api import API_RESOURCES, ApiError, read_page, write_batch
+from .cohorts import query_cohort
+from .changes import CHANGE_FEED_MODELS, ChangeFeedExpired, get_changes, head
+from .refcache import reference
+from .payload import get_markings_payload, load_markings, markings_json
+from .media_paths import moved_name
+from .derivatives import KINDS, PNG, get_derivative, negotiate
+from .rasters import RasterUnavailable, encode_region, read_region
+from .overlays import TILE_FORMATS, get_manifest, get_tile, overlay_version
+from .myelogram import get_myelogram, get_myelograms
+from .records import get_patient_record
+from .routers import aiter_routed, iter_routed, reads_from_replica
+from .search import SearchResults
+from .statistics import PERCENTILES, HISTOGRAM_BINS, get_statistics
+from .trajectories import EXPORT_COLUMNS, export_rows, patient_trajectories, trajectory_patients
+from .widgets import LOOKUPS, is_autocomplete
+from .utils import MetaDataMixin, CachedListMixin, ConditionalListMixin, ReplicaReadMixin, aget_request_user
+
+
+def image_cell_counts():
+    # счётчики клеток по типам для карточек изображений
+    return Prefetch('cellcount', queryset=ImageCellCount.objects.filter(count__gt=0).select_related('cell_type')
+                    .order_by('cell_type__type_name'))
 
 
 class SignUpView(CreateView):
@@ -46,7 +87,7 @@ class ShowProfileView(LoginRequiredMixin, DetailView, MetaDataMixin):
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['caregory'] = MEPHIUserCategory.objects.get(pk=self.object.user_category_id).category_name
+        context['caregory'] = reference(MEPHIUserCategory).get(self.object.user_category_id).category_name
         additional_context = super().get_user_context()
 
         return dict(list(context.items()) + list(additional_context.items()))
@@ -64,69 +105,79 @@ class HomePageView(TemplateView):
     template_name = 'general/home_page.html'
 
 
-class CreatePatientView(CreateView, MetaDataMixin):
+class CreatePatientView(ConditionalListMixin, CreateView, MetaDataMixin, CachedListMixin, ReplicaReadMixin):
     form_class = CreatePatientForm
     template_name = "functions/create_user.html"
     success_url = reverse_lazy('add_patient')
+    list_models = (Patient,)
 
     def get_context_data(self, **kwargs):
         kwargs['object_list'] = Patient.objects.all()
         context = super().get_context_data(**kwargs)
         additional_context = super().get_user_context()
+        cache_context = self.get_cache_context()
 
-        return dict(list(context.items()) + list(additional_context.items()))
+        return dict(list(context.items()) + list(additional_context.items()) + list(cache_context.items()))
 
 
-class CreateDiagnosisView(CreateView, MetaDataMixin):
+class CreateDiagnosisView(ConditionalListMixin, CreateView, MetaDataMixin, CachedListMixin, ReplicaReadMixin):
     form_class = CreateDiagnosisForm
     template_name = "functions/create_diagnosis.html"
     success_url = reverse_lazy('add_diagnosis')
+    list_models = (ResearchResult, Patient)
 
     def get_context_data(self, **kwargs):
         kwargs['object_list'] = ResearchResult.objects.all()
         context = super().get_context_data(**kwargs)
         additional_context = super().get_user_context()
+        cache_context = self.get_cache_context()
 
-        return dict(list(context.items()) + list(additional_context.items()))
+        return dict(list(context.items()) + list(additional_context.items()) + list(cache_context.items()))
 
 
-class CreateCellTypeView(CreateView, MetaDataMixin):
+class CreateCellTypeView(ConditionalListMixin, CreateView, MetaDataMixin, CachedListMixin, ReplicaReadMixin):
     form_class = CreateCellTypeForm
     template_name = "functions/create_cell_type.html"
     success_url = reverse_lazy('add_cell_type')
+    list_models = (CellType,)
 
     def get_context_data(self, **kwargs):
         kwargs['object_list'] = CellType.objects.all()
         context = super().get_context_data(**kwargs)
         additional_context = super().get_user_context()
+        cache_context = self.get_cache_context()
 
-        return dict(list(context.items()) + list(additional_context.items()))
+        return dict(list(context.items()) + list(additional_context.items()) + list(cache_context.items()))
 
 
-class AddImageView(CreateView, MetaDataMixin):
+class AddImageView(ConditionalListMixin, CreateView, MetaDataMixin, CachedListMixin, ReplicaReadMixin):
     form_class = AddImageForm
     template_name = "functions/create_image.html"
     success_url = reverse_lazy('add_image')
+    list_models = (CellImage, Patient, Medication)
 
     def get_context_data(self, **kwargs):
-        kwargs['object_list'] = CellImage.objects.all()
+        kwargs['object_list'] = CellImage.objects.prefetch_related(image_cell_counts())
         context = super().get_context_data(**kwargs)
         additional_context = super().get_user_context()
+        cache_context = self.get_cache_context()
 
-        return dict(list(context.items()) + list(additional_context.items()))
+        return dict(list(context.items()) + list(additional_context.items()) + list(cache_context.items()))
 
 
-class AddMedicationView(CreateView, MetaDataMixin):
+class AddMedicationView(ConditionalListMixin, CreateView, MetaDataMixin, CachedListMixin, ReplicaReadMixin):
     form_class = AddMedicationForm
     template_name = "functions/create_medication.html"
     success_url = reverse_lazy('add_medication')
+    list_models = (Medication, Patient)
 
     def get_context_data(self, **kwargs):
         kwargs['object_list'] = Medication.objects.all()
         context = super().get_context_data(**kwargs)
         additional_context = super().get_user_context()
+        cache_context = self.get_cache_context()
 
-        return dict(list(context.items()) + list(additional_context.items()))
+        return dict(list(context.items()) + list(additional_context.items()) + list(cache_context.items()))
 
 
 class AddResearchView(CreateView, MetaDataMixin):
@@ -142,10 +193,11 @@ class AddResearchView(CreateView, MetaDataMixin):
         return dict(list(context.items()) + list(additional_context.items()))
 
 
-class AddDictView(CreateView, MetaDataMixin):
+class AddDictView(ConditionalListMixin, CreateView, MetaDataMixin):
     form_class = AddDictForm
     template_name = "functions/create_dict.html"
     success_url = reverse_lazy('add_dict_characteristics')
+    list_models = (DictCellsCharacteristics,)
 
     def get_context_data(self, **kwargs):
         kwargs['object_list'] = DictCellsCharacteristics.objects.all()
@@ -155,10 +207,11 @@ class AddDictView(CreateView, MetaDataMixin):
         return dict(list(context.items()) + list(additional_context.items()))
 
 
-class AddTermsView(CreateView, MetaDataMixin):
+class AddTermsView(ConditionalListMixin, CreateView, MetaDataMixin):
     form_class = AddTermForm
     template_name = "functions/create_term.html"
     success_url = reverse_lazy('add_terms')
+    list_models = (Terms,)
 
     def get_context_data(self, **kwargs):
         kwargs['object_list'] = Terms.objects.all()
@@ -168,10 +221,11 @@ class AddTermsView(CreateView, MetaDataMixin):
         return dict(list(context.items()) + list(additional_context.items()))
 
 
-class AddCellCharacteristicView(CreateView, MetaDataMixin):
+class AddCellCharacteristicView(ConditionalListMixin, CreateView, MetaDataMixin):
     form_class = AddCellCharacteristicForm
     template_name = "functions/create_cell_characteristic.html"
     success_url = reverse_lazy('add_cell_characteristic')
+    list_models = (CellCharacteristic, DictCellsCharacteristics, Cell)
 
     def get_context_data(self, **kwargs):
         kwargs['object_list'] = CellCharacteristic.objects.all()
@@ -181,10 +235,11 @@ class AddCellCharacteristicView(CreateView, MetaDataMixin):
         return dict(list(context.items()) + list(additional_context.items()))
 
 
-class AddSystemSettingsView(CreateView, MetaDataMixin):
+class AddSystemSettingsView(ConditionalListMixin, CreateView, MetaDataMixin):
     form_class = AddSystemSettingsForm
     template_name = "functions/create_system_settings.html"
     success_url = reverse_lazy('add_system_settings')
+    list_models = (SystemSettings, Medication)
 
     def get_context_data(self, **kwargs):
         kwargs['object_list'] = SystemSettings.objects.all()
@@ -194,10 +249,11 @@ class AddSystemSettingsView(CreateView, MetaDataMixin):
         return dict(list(context.items()) + list(additional_context.items()))
 
 
-class AddPatientResearchView(CreateView, MetaDataMixin):
+class AddPatientResearchView(ConditionalListMixin, CreateView, MetaDataMixin):
     form_class = AddPatientResearchForm
     template_name = "functions/create_patient_research.html"
     success_url = reverse_lazy('add_patient_research')
+    list_models = (PatientResearch, Patient, MEPHIUser)
 
     def get_context_data(self, **kwargs):
         kwargs['object_list'] = PatientResearch.objects.all()
@@ -207,10 +263,11 @@ class AddPatientResearchView(CreateView, MetaDataMixin):
         return dict(list(context.items()) + list(additional_context.items()))
 
 
-class AddMarkerView(CreateView, MetaDataMixin):
+class AddMarkerView(ConditionalListMixin, CreateView, MetaDataMixin):
     form_class = AddMarkerForm
     template_name = "functions/create_marker.html"
     success_url = reverse_lazy('add_marker')
+    list_models = (Marker,)
 
     def get_context_data(self, **kwargs):
         kwargs['object_list'] = Marker.objects.all()
@@ -220,10 +277,11 @@ class AddMarkerView(CreateView, MetaDataMixin):
         return dict(list(context.items()) + list(additional_context.items()))
 
 
-class AddImmunoView(CreateView, MetaDataMixin):
+class AddImmunoView(ConditionalListMixin, CreateView, MetaDataMixin):
     form_class = AddImmunophenotypingForm
     template_name = "functions/create_immuno.html"
     success_url = reverse_lazy('add_marker')
+    list_models = (Immunophenotyping, Marker, Medication, PatientResearch)
 
     def get_context_data(self, **kwargs):
         kwargs['object_list'] = Immunophenotyping.objects.all()
@@ -233,14 +291,500 @@ class AddImmunoView(CreateView, MetaDataMixin):
         return dict(list(context.items()) + list(additional_context.items()))
 
 
-class AddResearchedObject(CreateView, MetaDataMixin):
+class AddResearchedObject(ConditionalListMixin, CreateView, MetaDataMixin):
     form_class = AddResearchedObjectForm
     template_name = "functions/create_researched_object.html"
     success_url = reverse_lazy('add_marker')
+    list_models = (ResearchedObject,)
 
     def get_context_data(self, **kwargs):
         kwargs['object_list'] = ResearchedObject.objects.all()
         context = super().get_context_data(**kwargs)
         additional_context = super().get_user_context()
 
-        return dict(list(context.items()) + list(additional_context.items()))
\ No newline at end of file
+        return dict(list(context.items()) + list(additional_context.items()))
+
+
+class MediaFileView(LoginRequiredMixin, View):
+    # загруженные файлы никогда не перезаписываются (хранилище выбирает новое имя),
+    # поэтому содержимое по одному пути неизменно и его можно кэшировать на год
+    cache_max_age = 60 * 60 * 24 * 365
+    raise_exception = True
+
+    def get(self, request, path):
+        full_path = safe_join(settings.MEDIA_ROOT, path)
+        if not (CellImage.objects.filter(image=path).exists() or Cell.objects.filter(image=path).exists()):
+            # файл перенесён в раскладку по хэшу: прежний адрес из закладок и кэшей ведёт на новый
+            moved = moved_name(path)
+            if moved is None:
+                raise Http404
+            return HttpResponsePermanentRedirect(reverse('media', kwargs={'path': moved}))
+
+        return serve_file(request, full_path, path, max_age=self.cache_max_age, immutable=True)
+
+
+class DerivativeImageView(LoginRequiredMixin, View):
+    # снимок для показа в браузере: превью или полный размер в лучшем формате из Accept
+    # (AVIF, WebP). Оригинал для скачивания и анализа остаётся по адресу MediaFileView
+    cache_max_age = MediaFileView.cache_max_age
+    # пока производная не готова, отдаётся оригинал, который браузер не должен запоминать надолго
+    fallback_max_age = 60
+    raise_exception = True
+
+    def get(self, request, kind, path):
+        if kind not in KINDS:
+            raise Http404
+        if not (CellImage.objects.filter(image=path).exists() or Cell.objects.filter(image=path).exists()):
+            moved = moved_name(path)
+            if moved is None:
+                raise Http404
+            return HttpResponsePermanentRedirect(reverse('image_derivative', args=(kind, moved)))
+        fmt = negotiate(request.META.get('HTTP_ACCEPT', ''))
+        if fmt is None and kind == 'preview':
+            # уменьшенная копия нужна и клиентам без WebP и AVIF
+            fmt = PNG
+        name = get_derivative(path, kind, fmt) if fmt is not None else None
+        if name is not None:
+            response = serve_file(request, safe_join(settings.MEDIA_ROOT, name), name,
+                                  max_age=self.cache_max_age, immutable=True)
+        elif fmt is None:
+            response = serve_file(request, safe_join(settings.MEDIA_ROOT, path), path,
+                                  max_age=self.cache_max_age, immutable=True)
+        else:
+            response = serve_file(request, safe_join(settings.MEDIA_ROOT, path), path, max_age=self.fallback_max_age)
+        patch_vary_headers(response, ('Accept',))
+
+        return response
+
+
+class OverlayManifestView(LoginRequiredMixin, View):
+    raise_exception = True
+
+    def get(self, request, pk):
+        manifest = get_manifest(pk)
+        if manifest is None:
+            raise Http404
+        manifest['tile_url'] = reverse('overlay_tile', args=(pk, manifest['version'], 0, 0, 0)).replace(
+            '/0/0/0.png', '/{z}/{x}/{y}.png')
+        response = JsonResponse(manifest)
+        patch_cache_control(response, private=True, no_cache=True)
+
+        return response
+
+
+class OverlayTileView(LoginRequiredMixin, View):
+    # версия оверлея входит в путь плитки, поэтому содержимое по одному адресу неизменно
+    cache_max_age = 60 * 60 * 24 * 365
+    raise_exception = True
+
+    def get(self, request, pk, version, zoom, x, y):
+        current = overlay_version(pk)
+        if version != current:
+            return HttpResponseRedirect(reverse('overlay_tile', args=(pk, current, zoom, x, y)))
+        # адрес плитки один, формат выбирается по Accept: WebP без потерь или PNG
+        fmt = negotiate(request.META.get('HTTP_ACCEPT', ''), TILE_FORMATS[1:]) or PNG
+        etag = f'"{current:x}-{zoom}-{x}-{y}{fmt[2]}"'
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            tile = get_tile(pk, current, zoom, x, y, fmt)
+            if tile is None:
+                raise Http404
+            response = HttpResponse(tile, content_type=fmt[0])
+        response.headers['ETag'] = etag
+        patch_vary_headers(response, ('Accept',))
+        patch_cache_control(response, private=True, max_age=self.cache_max_age, immutable=True)
+
+        return response
+
+
+class ImageMarkingsView(LoginRequiredMixin, View, ReplicaReadMixin):
+    # по умолчанию двоичный столбцовый формат payload.py, ?format=json - объект на каждую
+    # маркировку для отладки, ?delta=0 - координаты без разностного кодирования
+    raise_exception = True
+
+    def get(self, request, pk):
+        if not CellImage.objects.filter(pk=pk).exists():
+            raise Http404
+        if request.GET.get('format') == 'json':
+            return JsonResponse(markings_json(pk, load_markings(pk)))
+
+        delta = request.GET.get('delta') != '0'
+        payload, version = get_markings_payload(pk, delta=delta)
+        etag = f'"{version}-{int(delta)}"'
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = HttpResponse(payload, content_type='application/octet-stream')
+        response.headers['ETag'] = etag
+        patch_cache_control(response, private=True, no_cache=True)
+
+        return response
+
+
+class ImageRegionView(LoginRequiredMixin, View):
+    # ?x=&y=&w=&h= - область в координатах уровня ?level= (0 - исходный размер, N - уменьшение
+    # в 2 ** N раз) из кэша растров; PNG, ?format=npy - массив NumPy для скриптов анализа
+    raise_exception = True
+
+    def get(self, request, pk):
+        try:
+            x, y, width, height = (int(request.GET[name]) for name in ('x', 'y', 'w', 'h'))
+            level = int(request.GET.get('level', 0))
+        except (KeyError, ValueError):
+            return JsonResponse({'error': 'x, y, w и h должны быть целыми числами'}, status=400)
+        try:
+            region = read_region(pk, x, y, width, height, level)
+        except RasterUnavailable:
+            raise Http404
+        except ValueError as error:
+            return JsonResponse({'error': str(error)}, status=400)
+        if not region.size:
+            return JsonResponse({'error': 'Область вне изображения'}, status=400)
+        content, content_type = encode_region(region, request.GET.get('format', 'png'))
+        response = HttpResponse(content, content_type=content_type)
+        patch_cache_control(response, private=True, no_cache=True)
+
+        return response
+
+
+class ChangeFeedView(LoginRequiredMixin, View):
+    # ?since=<токен> - изменения после токена, ?limit= - размер страницы,
+    # ?models=patient,cell - только указанные таблицы. Лента читается только с основной БД:
+    # реплика может отставать дольше CHANGE_FEED_SETTLE_SECONDS и показать запись с большим
+    # номером раньше записи с меньшим, которую клиент после этого пропустит навсегда
+    raise_exception = True
+
+    def get(self, request):
+        try:
+            since = int(request.GET.get('since', 0))
+            limit = int(request.GET['limit']) if request.GET.get('limit') else None
+        except ValueError:
+            return JsonResponse({'error': 'since и limit должны быть целыми числами'}, status=400)
+        models = [name for name in request.GET.get('models', '').split(',') if name]
+        unknown = set(models) - set(CHANGE_FEED_MODELS)
+        if unknown or since < 0 or (limit is not None and limit <= 0):
+            return JsonResponse({'error': 'Неверные параметры запроса', 'models': sorted(CHANGE_FEED_MODELS)}, status=400)
+        try:
+            return JsonResponse(get_changes(since, limit, models))
+        except ChangeFeedExpired:
+            # изменения после токена уже удалены: клиент выгружает таблицы целиком и продолжает с head
+            return JsonResponse({'error': 'Токен устарел, требуется полная выгрузка', 'head': head()}, status=410)
+
+
+class ApiResourceView(LoginRequiredMixin, View, ReplicaReadMixin):
+    # GET: ?fields=id,first_name - выбранные поля, ?cursor= и ?limit= - постраничное чтение;
+    # POST: {"items": [...]} - пачка создаваемых и изменяемых записей в одной транзакции
+    raise_exception = True
+
+    def dispatch(self, request, *args, **kwargs):
+        self.resource = API_RESOURCES.get(kwargs['resource'])
+        if self.resource is None:
+            return JsonResponse({'error': 'Неизвестный ресурс', 'resources': sorted(API_RESOURCES)}, status=404)
+        try:
+            return super().dispatch(request, *args, **kwargs)
+        except ApiError as error:
+            return JsonResponse(dict(error.details, error=str(error)), status=error.status)
+
+    def get(self, request, resource):
+        fields = [name for name in request.GET.get('fields', '').split(',') if name]
+        try:
+            limit = int(request.GET['limit']) if request.GET.get('limit') else None
+        except ValueError:
+            raise ApiError('limit должен быть целым числом')
+        if limit is not None and limit <= 0:
+            raise ApiError('limit должен быть положительным')
+
+        return JsonResponse(read_page(self.resource, fields, request.GET.get('cursor'), limit))
+
+    def post(self, request, resource):
+        try:
+            body = json.loads(request.body)
+        except ValueError:
+            raise ApiError('Тело запроса не является JSON')
+        result = write_batch(self.resource, body.get('items') if isinstance(body, dict) else body)
+
+        return JsonResponse(result, status=200 if result['saved'] else 400)
+
+
+class CohortView(LoginRequiredMixin, View, ReplicaReadMixin):
+    # ?spec=<описание когорты JSON, см. cohorts.py>, ?cursor= и ?limit= - постраничное чтение
+    raise_exception = True
+
+    def get(self, request):
+        try:
+            spec = json.loads(request.GET.get('spec', ''))
+        except ValueError:
+            return JsonResponse({'error': 'spec должен быть JSON'}, status=400)
+        try:
+            limit = int(request.GET['limit']) if request.GET.get('limit') else None
+        except ValueError:
+            return JsonResponse({'error': 'limit должен быть целым числом'}, status=400)
+        if limit is not None and limit <= 0:
+            return JsonResponse({'error': 'limit должен быть положительным'}, status=400)
+        try:
+            return JsonResponse(query_cohort(spec, request.GET.get('cursor'), limit))
+        except ApiError as error:
+            return JsonResponse(dict(error.details, error=str(error)), status=error.status)
+
+
+class StaticAssetView(View):
+    # статика из STATIC_ROOT без отдельного веб-сервера (при DEBUG её отдаёт runserver)
+    def get(self, request, path):
+        return serve_static(request, safe_join(settings.STATIC_ROOT, path), immutable=path in immutable_names())
+
+
+class PatientRecordView(LoginRequiredMixin, TemplateView, MetaDataMixin, ReplicaReadMixin):
+    template_name = "functions/patient_record.html"
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['record'] = get_patient_record(self.kwargs['pk'])
+        additional_context = super().get_user_context()
+
+        return dict(list(context.items()) + list(additional_context.items()))
+
+
+class PatientRecordJsonView(LoginRequiredMixin, View, ReplicaReadMixin):
+    raise_exception = True
+
+    def get(self, request, pk):
+        return JsonResponse(get_patient_record(pk))
+
+
+class LookupView(LoginRequiredMixin, View, ReplicaReadMixin):
+    raise_exception = True
+
+    def get(self, request, name):
+        lookup = LOOKUPS.get(name)
+        if lookup is None:
+            raise Http404
+        results = [{'id': obj.pk, 'text': str(obj)} for obj in lookup.search(request.GET.get('q', ''))]
+
+        return JsonResponse({'results': results})
+
+
+class ImmunoStatisticsView(LoginRequiredMixin, TemplateView, MetaDataMixin, ReplicaReadMixin):
+    template_name = "functions/immuno_statistics.html"
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['statistics'] = get_statistics()
+        context['percentiles'] = PERCENTILES
+        context['histogram_bins'] = [int(value) for value in HISTOGRAM_BINS[:-1]]
+        additional_context = super().get_user_context()
+
+        return dict(list(context.items()) + list(additional_context.items()))
+
+
+class ImmunoStatisticsJsonView(LoginRequiredMixin, View, ReplicaReadMixin):
+    raise_exception = True
+
+    def get(self, request):
+        return JsonResponse(get_statistics())
+
+
+class TrajectoryView(LoginRequiredMixin, TemplateView, MetaDataMixin, ReplicaReadMixin):
+    template_name = "functions/trajectories.html"
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        paginator = Paginator(trajectory_patients(), settings.TRAJECTORY_PAGE_SIZE)
+        context['page_obj'] = paginator.get_page(self.request.GET.get('page'))
+        context['trajectories'] = patient_trajectories(context['page_obj'].object_list).items()
+        additional_context = super().get_user_context()
+
+        return dict(list(context.items()) + list(additional_context.items()))
+
+
+class Echo:
+    # csv.writer пишет строку в "файл" и возвращает её, не накапливая выгрузку в памяти
+    def write(self, value):
+        return value
+
+
+class TrajectoryExportView(LoginRequiredMixin, View, ReplicaReadMixin):
+    raise_exception = True
+
+    def get(self, request):
+        writer = csv.writer(Echo())
+        rows = (writer.writerow(row) for row in itertools.chain([EXPORT_COLUMNS], export_rows()))
+        # строки читаются после выхода из представления: маршрутизация запроса передаётся итератору
+        iterate = aiter_routed if isinstance(request, ASGIRequest) else iter_routed
+        content = iterate(rows, reads_from_replica(), settings.TRAJECTORY_EXPORT_CHUNK)
+        response = StreamingHttpResponse(content, content_type='text/csv; charset=utf-8')
+        response['Content-Disposition'] = 'attachment; filename="trajectories.csv"'
+        return response
+
+
+class MyelogramJsonView(LoginRequiredMixin, View, ReplicaReadMixin):
+    raise_exception = True
+
+    def get(self, request, pk):
+        get_object_or_404(Medication, pk=pk)
+        return JsonResponse(get_myelogram(pk))
+
+
+class MyelogramListJsonView(LoginRequiredMixin, View, ReplicaReadMixin):
+    # миелограммы нескольких препаратов: /myelograms/?medication=1&medication=2
+    raise_exception = True
+    max_medications = 1000
+
+    def get(self, request):
+        try:
+            medication_ids = [int(value) for value in request.GET.getlist('medication')][:self.max_medications]
+        except ValueError:
+            return JsonResponse({'error': 'medication must be an integer'}, status=400)
+        myelograms = get_myelograms(medication_ids)
+
+        return JsonResponse({str(medication_id): myelogram for medication_id, myelogram in myelograms.items()})
+
+
+class SearchView(LoginRequiredMixin, TemplateView, MetaDataMixin, ReplicaReadMixin):
+    template_name = "functions/search.html"
+    paginate_by = 20
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        query = self.request.GET.get('q', '')
+        paginator = Paginator(SearchResults(query), self.paginate_by)
+        context['query'] = query
+        context['page_obj'] = paginator.get_page(self.request.GET.get('page'))
+        additional_context = super().get_user_context()
+
+        return dict(list(context.items()) + list(additional_context.items()))
+
+
+# Асинхронные варианты страниц только для чтения, подключаются в urls.py при ASYNC_READ_VIEWS = True.
+# Под ASGI запрос не занимает поток на время обращений к БД, а шаблон рендерится по уже загруженным
+# данным. Асинхронные вызовы ORM в Django 4.2 выполняются через sync_to_async(thread_sensitive=True)
+# в одном общем потоке, поэтому запросы одного представления идут последовательно и ожидаются по очереди.
+
+class AsyncShowProfileView(View, MetaDataMixin):
+    template_name = ShowProfileView.template_name
+
+    async def get(self, request, username):
+        user = await aget_request_user(request)
+        if not user.is_authenticated:
+            return redirect_to_login(request.get_full_path())
+        profile = await MEPHIUser.objects.select_related('user_category').filter(username=username).afirst()
+        if profile is None:
+            raise Http404
+
+        context = {'object': profile, 'caregory': profile.user_category.category_name, 'view': self}
+        context.update(self.get_user_context())
+
+        return render(request, self.template_name, context)
+
+
+class AsyncRegistryView(ConditionalListMixin, View, MetaDataMixin, CachedListMixin, ReplicaReadMixin):
+    # синхронное представление реестра: из него берутся форма, шаблон и модели, ему же передаётся POST
+    sync_view = None
+    # имя фрагмента {% cache %} со списком карточек в шаблоне
+    list_fragment = None
+    # связи, выводимые в карточках
+    list_related = ()
+    list_prefetch = ()
+
+    @property
+    def form_class(self):
+        return self.sync_view.form_class
+
+    @property
+    def list_models(self):
+        return self.sync_view.list_models
+
+    async def get(self, request, *args, **kwargs):
+        await aget_request_user(request)
+        etag = await self.aget_etag()
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = await self.render_registry(request)
+        response.headers["ETag"] = etag
+        patch_cache_control(response, private=True, no_cache=True)
+
+        return response
+
+    async def post(self, request, *args, **kwargs):
+        return await sync_to_async(self.sync_view.as_view())(request, *args, **kwargs)
+
+    async def render_registry(self, request):
+        form = self.form_class()
+        cache_context = await self.aget_cache_context()
+        choice_fields = [field for field in form.fields.values()
+                         if isinstance(field, ModelChoiceField) and not is_autocomplete(field)]
+        # если список уже в кэше фрагментов, записи реестра не нужны
+        list_cached = await cache.ahas_key(make_template_fragment_key(self.list_fragment,
+                                                                      [cache_context['list_version']]))
+        list_queryset = self.list_models[0].objects.select_related(*self.list_related).prefetch_related(
+            *self.list_prefetch)
+
+        object_list = await self.afetch(list_queryset.none() if list_cached else list_queryset)
+        for field in choice_fields:
+            objects = await self.afetch(field.queryset)
+            empty_choice = [] if field.empty_label is None else [("", field.empty_label)]
+            field.choices = empty_choice + [(obj.pk, field.label_from_instance(obj)) for obj in objects]
+
+        context = {'form': form, 'object_list': object_list, 'view': self}
+        context.update(self.get_user_context())
+        context.update(cache_context)
+
+        # {% cache %} в шаблоне читает и пишет кэш фрагментов синхронно, поэтому шаблон рендерится в потоке
+        return await sync_to_async(render)(request, self.sync_view.template_name, context)
+
+    @staticmethod
+    async def afetch(queryset):
+        return [obj async for obj in queryset]
+
+
+class AsyncCreatePatientView(AsyncRegistryView):
+    sync_view = CreatePatientView
+    list_fragment = "patient_list"
+
+
+class AsyncCreateDiagnosisView(AsyncRegistryView):
+    sync_view = CreateDiagnosisView
+    list_fragment = "diagnosis_list"
+    list_related = ('patient',)
+
+
+class AsyncCreateCellTypeView(AsyncRegistryView):
+    sync_view = CreateCellTypeView
+    list_fragment = "cell_type_list"
+
+
+class AsyncAddImageView(AsyncRegistryView):
+    sync_view = AddImageView
+    list_fragment = "image_list"
+    list_related = ('patient', 'medication')
+
+    @property
+    def list_prefetch(self):
+        return (image_cell_counts(),)
+
+
+class AsyncAddMedicationView(AsyncRegistryView):
+    sync_view = AddMedicationView
+    list_fragment = "medication_list"
+    list_related = ('patient',)
+
+
+class AsyncMediaFileView(View):
+    cache_max_age = MediaFileView.cache_max_age
+
+    async def get(self, request, path):
+        full_path = safe_join(settings.MEDIA_ROOT, path)
+        user = await aget_request_user(request)
+        if not user.is_authenticated:
+            raise PermissionDenied
+        if not (await CellImage.objects.filter(image=path).aexists()
+                or await Cell.objects.filter(image=path).aexists()):
+            moved = await sync_to_async(moved_name)(path)
+            if moved is None:
+                raise Http404
+            return HttpResponsePermanentRedirect(reverse('media', kwargs={'path': moved}))
+
+        response = await sync_to_async(serve_file, thread_sensitive=False)(
+            request, full_path, path, max_age=self.cache_max_age, immutable=True)
+        if isinstance(response, FileResponse) and response.file_to_stream is not None:
+            response.streaming_content = aiter_file(response.file_to_stream, response.block_size)
+
+        return response
@@ -0,0 +1,110 @@
+from django import forms
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from django.urls import reverse
+
+from .models import *
+from .refcache import reference
+from .search import as_number
+
+# сколько вариантов возвращает поиск для поля автодополнения
+AUTOCOMPLETE_LIMIT = 20
+
+
+class Lookup:
+    """Поиск записей справочника для поля автодополнения: по началу строки в индексированных
+    текстовых полях и по точному совпадению числовых полей"""
+
+    def __init__(self, model, prefix_fields=(), number_fields=("pk",), related=(), order_by=("pk",)):
+        self.model = model
+        self.prefix_fields = prefix_fields
+        self.number_fields = number_fields
+        self.related = related
+        self.order_by = order_by
+
+    def search(self, text, limit=AUTOCOMPLETE_LIMIT):
+        text = text.strip()
+        queryset = self.model.objects.select_related(*self.related).order_by(*self.order_by)
+        if not text:
+            return queryset[:limit]
+        condition = Q()
+        for field in self.prefix_fields:
+            condition |= Q(**{f"{field}__istartswith": text})
+        number = as_number(text)
+        if number is not None:
+            for field in self.number_fields:
+                condition |= Q(**{field: number})
+        if not condition:
+            return queryset.none()
+        return queryset.filter(condition)[:limit]
+
+
+class ReferenceLookup(Lookup):
+    """Поиск по справочнику, загруженному в память (refcache.py), без запроса к БД"""
+
+    def search(self, text, limit=AUTOCOMPLETE_LIMIT):
+        text = text.strip().casefold()
+        table = reference(self.model)
+        rows = sorted(table.rows(), key=lambda row: tuple(getattr(row, field) for field in self.order_by))
+        number = as_number(text)
+        if text:
+            rows = [row for row in rows
+                    if any(str(getattr(row, field)).casefold().startswith(text) for field in self.prefix_fields)
+                    or (number is not None and any(getattr(row, field) == number for field in self.number_fields))]
+        return [table.build(row) for row in rows[:limit]]
+
+
+LOOKUPS = {
+    "patient": Lookup(Patient, prefix_fields=("last_name",),
+                      number_fields=("pk", "number_ill_history"), order_by=("last_name", "pk")),
+    "medication": Lookup(Medication, prefix_fields=("medication_type",), order_by=("medication_type", "pk")),
+    "patient_research": Lookup(PatientResearch, prefix_fields=("patient__last_name",),
+                               number_fields=("pk", "patient__number_ill_history"), order_by=("-date_begin", "pk")),
+    "researcher": Lookup(MEPHIUser, prefix_fields=("username", "last_name"), order_by=("username",)),
+    "marker": ReferenceLookup(Marker, prefix_fields=("marker_name",), number_fields=("id",), order_by=("marker_name", "id")),
+    "cell": Lookup(Cell),
+    "dictcharcteristics": ReferenceLookup(DictCellsCharacteristics, prefix_fields=("characteristic_name",),
+                                          number_fields=("id",), order_by=("characteristic_name", "id")),
+}
+
+
+class AutocompleteSelect(forms.Widget):
+    """Поле выбора записи без списка <option>: скрытое поле с первичным ключом и строка поиска,
+    варианты для которой подгружаются с /lookup/<name>/. Отрисовка читает из таблицы
+    не больше одной записи - уже выбранную"""
+    template_name = "widgets/autocomplete.html"
+
+    def __init__(self, lookup, attrs=None):
+        super().__init__(attrs)
+        self.lookup = lookup
+        # ModelChoiceField подставляет сюда свой ModelChoiceIterator; он не перебирается
+        self.choices = []
+
+    def selected_label(self, value):
+        if value in (None, ""):
+            return ""
+        table = getattr(getattr(self.choices, "field", None), "table", None)
+        if table is not None:
+            # справочник из памяти процесса, см. refcache.ReferenceChoiceField
+            try:
+                return table.label(int(value))
+            except (TypeError, ValueError):
+                return ""
+        queryset = getattr(self.choices, "queryset", None)
+        if queryset is None:
+            return ""
+        try:
+            obj = queryset.filter(pk=value).first()
+        except (ValueError, TypeError, ValidationError):
+            return ""
+        return self.choices.field.label_from_instance(obj) if obj is not None else ""
+
+    def get_context(self, name, value, attrs):
+        context = super().get_context(name, value, attrs)
+        context["widget"]["label"] = self.selected_label(context["widget"]["value"])
+        context["widget"]["lookup_url"] = reverse("lookup", kwargs={"name": self.lookup})
+        return context
+
+
+def is_autocomplete(field):
+    return isinstance(field.widget, AutocompleteSelect)
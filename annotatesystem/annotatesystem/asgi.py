@@ -14,3 +14,8 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'annotatesystem.settings')
 
 application = get_asgi_application()
+
+# справочники загружаются в память процесса при старте, а не первым запросом
+from annotate_application.refcache import warm_reference_cache  # noqa: E402
+
+warm_reference_cache()
@@ -36,7 +36,8 @@ INSTALLED_APPS = [
     'django.contrib.contenttypes',
     'django.contrib.sessions',
     'django.contrib.messages',
-    'django.contrib.staticfiles',
+    'annotate_application.apps.AnnotateStaticFilesConfig',
+    'django.contrib.postgres',
     'annotate_application.apps.AnnotateApplicationConfig'
 ]
 
@@ -48,6 +49,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'annotate_application.routers.ReplicaRoutingMiddleware',
 ]
 
 ROOT_URLCONF = 'annotatesystem.urls'
@@ -70,6 +72,10 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'annotatesystem.wsgi.application'
 
+# асинхронные варианты страниц только для чтения (профиль, реестры, медиафайлы),
+# включать при запуске под ASGI-сервером (asgi.py)
+ASYNC_READ_VIEWS = False
+
 
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
@@ -85,6 +91,55 @@ DATABASES = {
     }
 }
 
+# реплики только для чтения: алиасы из DATABASES, в которые ReplicaRouter направляет чтение
+# представлений с read_replica = True. Пример: DATABASES['replica'] = dict(DATABASES['default'],
+# HOST='replica-host', TEST={'MIRROR': 'default'}); DATABASE_REPLICAS = ['replica']
+DATABASE_REPLICAS = []
+DATABASE_ROUTERS = ['annotate_application.routers.ReplicaRouter']
+# сколько секунд после запроса с записью клиент читает только из основной базы
+REPLICA_PIN_SECONDS = 10
+# сколько секунд после изменения таблицы её чтение не направляется в реплики (допустимое отставание)
+REPLICA_MAX_LAG_SECONDS = 10
+
+
+# Cache
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+
+# default - отрендеренные карточки и фрагменты, тайлы, карточки пациентов, страницы когорт;
+# versions - версии таблиц и строк (caching.py). Версии вынесены в отдельный кэш без вытеснения:
+# вытесненная версия даёт новый номер и промах по всем зависящим от неё записям default.
+# FileBasedCache при каждой записи просматривает каталог, поэтому в рабочей среде с большим числом
+# строк оба алиаса лучше перевести на общий Redis или Memcached с теми же именами.
+if DEBUG:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'annotatesystem',
+            'OPTIONS': {'MAX_ENTRIES': 50000, 'CULL_FREQUENCY': 10},
+        },
+        'versions': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'annotatesystem-versions',
+            'OPTIONS': {'MAX_ENTRIES': 10 ** 7},
+        },
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': os.path.join(BASE_DIR, 'cache'),
+            'OPTIONS': {'MAX_ENTRIES': 200000, 'CULL_FREQUENCY': 10},
+        },
+        'versions': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': os.path.join(BASE_DIR, 'cache_versions'),
+            'OPTIONS': {'MAX_ENTRIES': 10 ** 7},
+        },
+    }
+
+# время хранения отрендеренных карточек реестров, секунды
+CARD_CACHE_TIMEOUT = 60 * 60 * 24
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
@@ -123,9 +178,92 @@ USE_TZ = True
 STATIC_URL = 'static/'
 STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 
+# collectstatic добавляет в имена файлов хэш содержимого и сохраняет рядом сжатые варианты .gz и .br
+STORAGES = {
+    'default': {
+        'BACKEND': 'django.core.files.storage.FileSystemStorage',
+    },
+    'staticfiles': {
+        'BACKEND': 'annotate_application.staticfiles.CompressedManifestStaticFilesStorage',
+    },
+}
+
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 MEDIA_URL = '/media/'
 
+# способ отдачи медиафайлов после проверки доступа:
+# 'python' - потоковая отдача приложением (Range, sendfile через wsgi.file_wrapper),
+# 'x-accel' - nginx, internal location MEDIA_ACCEL_PREFIX с alias на MEDIA_ROOT,
+# 'x-sendfile' - apache mod_xsendfile
+MEDIA_SERVE_MODE = 'python'
+MEDIA_ACCEL_PREFIX = '/protected-media/'
+
+# раскладка загружаемых файлов по каталогам: функция (префикс, запись, имя файла) -> путь;
+# media_paths.sharded_path - два уровня каталогов по хэшу, media_paths.dated_path - по дате загрузки
+MEDIA_PATH_STRATEGY = 'annotate_application.media_paths.sharded_path'
+
+# поиск близких дубликатов изображений: каталог снимков индекса перцептивных хэшей
+# и допустимые расстояния Хэмминга между 64-битными pHash и dHash
+IMAGE_HASH_INDEX_DIR = os.path.join(BASE_DIR, 'index')
+IMAGE_PHASH_DISTANCE = 8
+IMAGE_DHASH_DISTANCE = 12
+
+# плитки оверлея маркировок: размер стороны в пикселях и количество потоков предварительной отрисовки
+OVERLAY_TILE_SIZE = 256
+OVERLAY_RENDER_WORKERS = 4
+
+# производные снимков для браузера (AVIF/WebP по заголовку Accept, превью): каталог внутри MEDIA_ROOT,
+# наибольший объём каталога в байтах, сторона превью, качество сжатия, потоки перекодирования
+# и сколько секунд запрос ждёт перекодирования, прежде чем отдать оригинал
+IMAGE_DERIVATIVE_DIR = 'derivatives'
+IMAGE_DERIVATIVE_CACHE_BYTES = 2 * 1024 ** 3
+IMAGE_PREVIEW_SIZE = 400
+IMAGE_DERIVATIVE_QUALITY = 90
+IMAGE_DERIVATIVE_WORKERS = 2
+IMAGE_DERIVATIVE_WAIT_SECONDS = 5
+
+# кэш растров для чтения областей изображений без повторного декодирования: включён ли,
+# каталог несжатых массивов, наибольший объём в байтах и сторона плитки в пикселях
+RASTER_CACHE_ENABLED = True
+RASTER_CACHE_DIR = os.path.join(BASE_DIR, 'rasters')
+RASTER_CACHE_BYTES = 20 * 1024 ** 3
+RASTER_TILE_SIZE = 512
+# наибольшая область, которую отдаёт image_region за один запрос (ширина * высота)
+RASTER_MAX_REGION_PIXELS = 4096 * 4096
+
+# загрузка каталогов изображений (команда ingest_images): каталог журналов, по которым
+# прерванная загрузка продолжается с места остановки
+INGEST_JOURNAL_DIR = os.path.join(BASE_DIR, 'ingest')
+
+# каталог внутри MEDIA_ROOT, куда команда scrub_media переносит файлы без ссылок из БД
+MEDIA_QUARANTINE_DIR = 'quarantine'
+
+# лента изменений: размер страницы по умолчанию и наибольший, задержка перед выдачей
+# изменения (должна превышать длительность самой долгой транзакции записи) и срок хранения
+CHANGE_FEED_PAGE_SIZE = 500
+CHANGE_FEED_MAX_PAGE_SIZE = 5000
+CHANGE_FEED_SETTLE_SECONDS = 5
+CHANGE_FEED_RETENTION_DAYS = 90
+
+# JSON API: размер страницы чтения по умолчанию и наибольший, наибольшее число записей в пачке
+API_PAGE_SIZE = 100
+API_MAX_PAGE_SIZE = 1000
+API_MAX_BATCH_SIZE = 5000
+
+# когорты пациентов (cohorts.py): размер страницы по умолчанию и наибольший, наибольшее число условий
+COHORT_PAGE_SIZE = 100
+COHORT_MAX_PAGE_SIZE = 1000
+COHORT_MAX_CONDITIONS = 20
+
+# динамика маркеров (trajectories.py): изменение в процентных пунктах, которое не считается ростом
+# или снижением, пациентов на странице отчёта, строк за одно обращение курсора при выгрузке
+TRAJECTORY_STABLE_DELTA = 5
+TRAJECTORY_PAGE_SIZE = 20
+TRAJECTORY_EXPORT_CHUNK = 2000
+
+# справочники в памяти процесса (refcache.py): как часто вне запросов сверяется версия таблицы, секунды
+REFERENCE_CACHE_CHECK_SECONDS = 5
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
@@ -1,12 +1,17 @@
 from django.contrib import admin
-from django.urls import path, include
+from django.urls import path, include, re_path
 from django.conf import settings
 from django.conf.urls.static import static
 
+from annotate_application.views import MediaFileView, AsyncMediaFileView, StaticAssetView
+
 urlpatterns = [
     path('admin/', admin.site.urls),
+    re_path(r'^%s(?P<path>.*)$' % settings.MEDIA_URL.lstrip('/'), (AsyncMediaFileView if settings.ASYNC_READ_VIEWS else MediaFileView).as_view(), name='media'),
     path('', include('annotate_application.urls'))
 ] + static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
 
-if settings.DEBUG:
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+if not settings.DEBUG:
+    # собранная collectstatic статика: сжатые варианты и долгое кэширование файлов с хэшем в имени
+    urlpatterns.insert(0, re_path(r'^%s(?P<path>.*)$' % settings.STATIC_URL.lstrip('/'), StaticAssetView.as_view(),
+                                  name='static'))